@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+audio_engine.py
+
+录音用的常驻音频引擎：程序启动时打开一次 PyAudio 和麦克风输入流，一直采集到程序退出。
+原来每个 AudioRecorder 都新建 pyaudio.PyAudio()、停止时 terminate()，每次 "Start Record Speech" 都要等设备打开，
+刚开口的几个音节经常录不到；现在：
+- 输入流用回调模式，PortAudio 线程里把每块音频放进环形缓冲（只保留最近 AUDIO_PREROLL_MS 毫秒）；
+- 开始录音时先把环形缓冲里的音频（按下按钮之前的 pre-roll）放进这次录音，之后的音频接着追加；
+- 开始/停止录音只是改列表引用，不打开也不关闭设备，立即返回。
+
+用法：
+    engine = AudioEngine().start()      # main() 里创建一次
+    take = engine.start_take()          # 开始录音（含 pre-roll）
+    pcm = engine.stop_take(take)        # 停止录音，返回 16 位 PCM 字节
+    engine.write_wav('a.wav', pcm)
+    engine.stop()                       # 程序退出时关闭设备
+"""
+import threading
+import wave
+from collections import deque
+
+import pyaudio
+
+AUDIO_FORMAT     = pyaudio.paInt16
+AUDIO_CHANNELS   = 1
+AUDIO_RATE       = 16000
+AUDIO_CHUNK      = 512    # 每块帧数（16kHz 下 32ms）；块越小 pre-roll 的粒度越细
+AUDIO_PREROLL_MS = 500    # 开始录音时带上之前多少毫秒的音频
+
+
+class AudioEngine:
+    def __init__(self, rate=AUDIO_RATE, channels=AUDIO_CHANNELS, chunk=AUDIO_CHUNK, preroll_ms=AUDIO_PREROLL_MS):
+        self.rate = rate
+        self.channels = channels
+        self.chunk = chunk
+        n = max(1, -(-preroll_ms * rate // (1000 * chunk)))   # 向上取整
+        self.ring = deque(maxlen=n)
+        self.takes = []         # 正在录音的列表；回调里追加到每一个
+        self.lock = threading.Lock()
+        self.audio = None
+        self.stream = None
+
+    def start(self):
+        """打开设备并开始采集；已经打开时直接返回"""
+        if self.stream is not None:
+            return self
+        self.audio = pyaudio.PyAudio()
+        try:
+            self.stream = self.audio.open(format=AUDIO_FORMAT,
+                                          channels=self.channels,
+                                          rate=self.rate,
+                                          input=True,
+                                          frames_per_buffer=self.chunk,
+                                          stream_callback=self._callback)
+        except Exception:
+            self.audio.terminate()
+            self.audio = None
+            raise
+        self.stream.start_stream()
+        print(f"[DEBUG] Audio engine started ({self.rate} Hz, pre-roll {self.ring.maxlen * self.chunk * 1000 // self.rate} ms).")
+        return self
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.audio is not None:
+            self.audio.terminate()
+            self.audio = None
+
+    @property
+    def sample_width(self):
+        return pyaudio.get_sample_size(AUDIO_FORMAT)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        # PortAudio 线程：只追加字节，不做其他事
+        with self.lock:
+            self.ring.append(in_data)
+            for take in self.takes:
+                take.append(in_data)
+        return (None, pyaudio.paContinue)
+
+    def start_take(self):
+        """开始一段录音：返回的列表先放入 pre-roll，之后采集到的音频继续追加"""
+        self.start()
+        with self.lock:
+            take = list(self.ring)
+            self.takes.append(take)
+        return take
+
+    def stop_take(self, take):
+        """结束录音，返回这段的 PCM 字节"""
+        with self.lock:
+            self.takes = [t for t in self.takes if t is not take]
+        return b''.join(take)
+
+    def write_wav(self, filename, pcm):
+        with wave.open(filename, 'wb') as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(self.sample_width)
+            wf.setframerate(self.rate)
+            wf.writeframes(pcm)
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark-pipeline.py
+
+匹配与构建流程的基准测试：
+1. 用当前目录的 retry*/step* 截图（Stage1 自带 retry1~retry4）以及合成扰动后的截图
+   （标签栏平移 / 整体缩放 / 局部遮挡）回放给 orb_homography_score、orb_homography_and_bbox、
+   tiered_match，并测 build_data 本身。
+2. 输出每项的延迟分位数 (p50/p90/p99)、吞吐量、峰值内存 (tracemalloc) 和匹配准确率。
+3. 与保存的基线比较，延迟或准确率退化超过容差时打印 [FAIL] 并以退出码 1 结束。
+
+用法（在 retry* 所在目录运行）：
+    python benchmark-pipeline.py --save-baseline          # 记录基线
+    python benchmark-pipeline.py                          # 与基线比较
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import rpa_runtime  # noqa: E402
+from frame_codec import read_frame  # noqa: E402
+
+BASELINE_FILE   = "benchmark-baseline.json"
+TAB_BAND        = 80     # 标签栏高度（像素），"shift" 扰动只平移这一条
+TAB_SHIFT       = 60     # 标签栏水平平移量
+SCALE_FACTOR    = 0.9    # "scale" 扰动的缩放比例
+CLICK_TOLERANCE = 30     # 定位中心与真实点击位置的最大允许距离（像素）
+LATENCY_TOL     = 0.25   # p50 延迟允许比基线慢 25%
+ACCURACY_TOL    = 0.02   # 准确率允许比基线低 0.02
+
+
+def load_build_module():
+    """form-execute-script.py 文件名带连字符，只能按路径导入"""
+    spec = importlib.util.spec_from_file_location("form_execute_script", os.path.join(HERE, "form-execute-script.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+#######################
+# 合成扰动
+#######################
+def perturb_none(img, pt):
+    return img, pt
+
+def perturb_shift_tabs(img, pt):
+    """标签栏整体右移（模拟新开/关闭标签页后标签位置变化）"""
+    out = img.copy()
+    out[:TAB_BAND] = np.roll(img[:TAB_BAND], TAB_SHIFT, axis=1)
+    if pt is not None and pt[1] < TAB_BAND:
+        pt = ((pt[0] + TAB_SHIFT) % img.shape[1], pt[1])
+    return out, pt
+
+def perturb_scale(img, pt):
+    """整体缩放（模拟不同分辨率 / DPI 的运行机器）"""
+    out = cv2.resize(img, None, fx=SCALE_FACTOR, fy=SCALE_FACTOR, interpolation=cv2.INTER_AREA)
+    if pt is not None:
+        pt = (int(pt[0] * SCALE_FACTOR), int(pt[1] * SCALE_FACTOR))
+    return out, pt
+
+def perturb_occlude(img, pt):
+    """在远离点击位置的一侧用灰块遮住 1/3 x 1/3 的区域（模拟弹窗 / 通知）"""
+    out = img.copy()
+    h, w = img.shape[:2]
+    cx = pt[0] if pt is not None else w // 2
+    x1 = 0 if cx > w // 2 else w - w // 3
+    y1 = h - h // 3
+    out[y1:y1 + h // 3, x1:x1 + w // 3] = 128
+    return out, pt
+
+PERTURBATIONS = {
+    'orig': perturb_none,
+    'shift': perturb_shift_tabs,
+    'scale': perturb_scale,
+    'occlude': perturb_occlude,
+}
+
+
+#######################
+# 统计
+#######################
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.array(values), q))
+
+def run_bench(name, cases, fn):
+    """
+    cases: [(label, args)]；fn(*args) 返回 True/False 表示是否判断正确。
+    先不开 tracemalloc 计时，再开 tracemalloc 跑一遍取峰值内存。
+    """
+    lat, correct = [], 0
+    t_all = time.perf_counter()
+    for _, args in cases:
+        t0 = time.perf_counter()
+        ok = fn(*args)
+        lat.append(time.perf_counter() - t0)
+        correct += 1 if ok else 0
+    total = time.perf_counter() - t_all
+
+    tracemalloc.start()
+    for _, args in cases:
+        fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    n = len(cases)
+    return {
+        'name': name,
+        'n': n,
+        'p50_ms': 1000 * percentile(lat, 50),
+        'p90_ms': 1000 * percentile(lat, 90),
+        'p99_ms': 1000 * percentile(lat, 99),
+        'throughput_per_s': n / total if total > 0 else 0.0,
+        'peak_mem_mb': peak / (1024 * 1024),
+        'accuracy': correct / n if n else 0.0,
+    }
+
+
+#######################
+# 用例
+#######################
+def load_cases(data, build):
+    """
+    每个 (retry, step) 截图 × 每种扰动 => 一个用例。
+    返回 screens: [(label, sid, folder, img, click_pt)]
+    """
+    screens = []
+    for sid, info in sorted(data.items(), key=lambda kv: int(kv[0])):
+        for (folder, path) in info['overall_imgs']:
+            img = read_frame(path)
+            if img is None:
+                continue
+            pt = None
+            for c in parse_folder_commands(build, folder, sid):
+                pt = build.find_xy(c) or pt
+            for pname, pfn in PERTURBATIONS.items():
+                p_img, p_pt = pfn(img, pt)
+                screens.append((f"{folder}/step{sid}/{pname}", sid, folder, p_img, p_pt))
+    return screens
+
+def parse_folder_commands(build, folder, sid):
+    return build.parse_step_file(os.path.join(folder, 'motion-record.txt')).get(sid, [])
+
+def overall_cases(data, screens):
+    """整体匹配：用其他 retry 的参考图给截图打分，得分最高的 step 应是截图所属 step"""
+    refs = []
+    for sid, info in data.items():
+        for (folder, path) in info['overall_imgs']:
+            img = read_frame(path)
+            if img is not None:
+                refs.append((sid, folder, img))
+    return [(label, (sid, folder, img, refs)) for (label, sid, folder, img, _) in screens]
+
+def classify_overall(sid, folder, img, refs):
+    best_sid, best_sc = None, -1
+    for (r_sid, r_folder, r_img) in refs:
+        if r_folder == folder:
+            continue  # leave-one-retry-out
+        sc = rpa_runtime.orb_homography_score(r_img, img, 5.0)
+        if sc > best_sc:
+            best_sid, best_sc = r_sid, sc
+    return best_sid == sid
+
+def local_cases(data, screens):
+    """局部定位：同一 retry 的局部截图应定位到（扰动后的）点击位置"""
+    crops = {}
+    for sid, info in data.items():
+        for (folder, roi) in info['local_imgs']:
+            crops[(sid, folder)] = roi
+    out = []
+    for (label, sid, folder, img, pt) in screens:
+        roi = crops.get((sid, folder))
+        if roi is not None and pt is not None:
+            out.append((label, (roi, img, pt)))
+    return out
+
+def near(center, pt):
+    return center is not None and abs(center[0] - pt[0]) <= CLICK_TOLERANCE and abs(center[1] - pt[1]) <= CLICK_TOLERANCE
+
+def locate_sift(roi, img, pt):
+    sc, bbox, center = rpa_runtime.orb_homography_and_bbox(roi, img, 5.0)
+    return sc >= 10 and near(center, pt)
+
+def locate_tiered(roi, img, pt):
+    ok, bbox, center, tier, sc = rpa_runtime.tiered_match(roi, img, 5.0, 10.0)
+    return ok and near(center, pt)
+
+
+#######################
+# 基线
+#######################
+def compare_with_baseline(results, baseline):
+    failed = False
+    base = {r['name']: r for r in baseline.get('results', [])}
+    for r in results:
+        b = base.get(r['name'])
+        if b is None:
+            print(f"[INFO] {r['name']}: no baseline entry.")
+            continue
+        if b['p50_ms'] > 0 and r['p50_ms'] > b['p50_ms'] * (1 + LATENCY_TOL):
+            print(f"[FAIL] {r['name']}: p50 {r['p50_ms']:.1f} ms > baseline {b['p50_ms']:.1f} ms (+{100 * LATENCY_TOL:.0f}% allowed)")
+            failed = True
+        if r['accuracy'] < b['accuracy'] - ACCURACY_TOL:
+            print(f"[FAIL] {r['name']}: accuracy {r['accuracy']:.3f} < baseline {b['accuracy']:.3f}")
+            failed = True
+    return failed
+
+def print_table(results):
+    print(f"{'benchmark':<36}{'n':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'ops/s':>9}{'peak MB':>9}{'acc':>7}")
+    for r in results:
+        print(f"{r['name']:<36}{r['n']:>5}{r['p50_ms']:>10.1f}{r['p90_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{r['throughput_per_s']:>9.2f}{r['peak_mem_mb']:>9.1f}{r['accuracy']:>7.3f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark matchers and build_data on retry* recordings.")
+    ap.add_argument('--baseline', default=BASELINE_FILE, help="baseline json path")
+    ap.add_argument('--save-baseline', action='store_true', help="write the results as the new baseline")
+    ap.add_argument('--json', default=None, help="also write the results to this json file")
+    args = ap.parse_args()
+
+    build = load_build_module()
+
+    # build_data 本身
+    holder = {}
+    def run_build():
+        holder['data'] = build.build_data()
+        return bool(holder['data'])
+    results = [run_bench('build_data', [('build', ())], run_build)]
+    data = holder['data']
+    if not data:
+        print("[ERROR] No retry* data in the current directory.")
+        return 1
+
+    screens = load_cases(data, build)
+    ov = overall_cases(data, screens)
+    loc = local_cases(data, screens)
+    # 每种扰动单独统计，便于看出是哪类画面变化让匹配变慢 / 变差
+    for pname in PERTURBATIONS:
+        pick = lambda cases: [c for c in cases if c[0].endswith('/' + pname)]
+        results.append(run_bench(f'orb_homography_score[{pname}]', pick(ov), classify_overall))
+        results.append(run_bench(f'orb_homography_and_bbox[{pname}]', pick(loc), locate_sift))
+        results.append(run_bench(f'tiered_match[{pname}]', pick(loc), locate_tiered))
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'results': results}, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2)
+        print(f"[INFO] Baseline saved: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"[INFO] No baseline at {args.baseline}; run with --save-baseline first.")
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if compare_with_baseline(results, baseline):
+        print("[FAIL] Benchmark regressed against baseline.")
+        return 1
+    print("[INFO] No regression against baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
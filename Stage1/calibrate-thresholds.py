@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+calibrate-thresholds.py
+
+按当前目录的 retry* 录制校准每个 step 的匹配阈值，并打印报告（不生成脚本）：
+- 参考图先按生成脚本时的规则聚成原型，每张 retry 截图都与运行时一样给各 step 的原型打分
+  （同 step 打分前把该截图的 retry 从原型里去掉，leave-one-retry-out）；
+- 阈值放在同 step 最低得分下方 --margin 处，并高于其他 step 截图的最高得分；
+- 报告默认阈值与校准阈值各自的期望轮询次数，以及校准阈值下其他 step 截图的误触发次数。
+form-execute-script.py 生成脚本时会做同样的校准，并把阈值写入 data[sid]['thresholds']。
+
+用法（在 retry* 所在目录运行）：
+    python calibrate-thresholds.py
+    python calibrate-thresholds.py --margin 0.2 --json thresholds-report.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+
+def load_build_module():
+    """form-execute-script.py 文件名带连字符，只能按路径导入"""
+    spec = importlib.util.spec_from_file_location("form_execute_script", os.path.join(HERE, "form-execute-script.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def main():
+    build = load_build_module()
+    ap = argparse.ArgumentParser(description="Calibrate per-step match thresholds from retry* recordings.")
+    ap.add_argument('--margin', type=float, default=build.CALIB_MARGIN,
+                    help="threshold sits this fraction below the weakest same-step score")
+    ap.add_argument('--json', default=None, help="also write the report and thresholds to this json file")
+    args = ap.parse_args()
+
+    data = build.build_data()
+    if not data:
+        print("[ERROR] No retry* data in the current directory.")
+        return 1
+    build.select_local_crops(data)  # 与生成脚本时选出的局部截图一致
+    step_feats = build.build_orb_features(data)  # 与生成脚本时选出的 ORB 设置一致
+    build.cluster_references(data, step_feats, None)  # 原型与生成脚本时一致（不保存特征文件）
+    report = build.calibrate_thresholds(data, step_feats, margin=args.margin)
+    build.print_calibration(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'margin': args.margin,
+                       'thresholds': {sid: info.get('thresholds', {}) for sid, info in data.items()},
+                       'report': report}, f, indent=2)
+        print(f"[INFO] Report saved: {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+codec-benchmark.py
+
+比较 frame_codec 支持的截图编码格式：用当前目录的 retry*/step* 截图（Stage1 自带 retry1~retry4），
+每种格式测编码耗时、解码耗时（p50/p90）、文件大小和压缩比，并检查解码结果与原图逐像素一致。
+录制时写盘线程的瓶颈是编码耗时，选格式时看 encode 一列；build_data / 回放读取时看 decode 一列。
+
+用法（在 retry* 所在目录运行）：
+    python codec-benchmark.py
+    python codec-benchmark.py --repeat 5 --codecs png png-fast webp --json codec-report.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import frame_codec  # noqa: E402
+
+
+def load_frames():
+    """retry*/step* => [(路径, PIL.Image RGB)]"""
+    frames = []
+    for folder in sorted(d for d in os.listdir('.') if os.path.isdir(d) and d.startswith('retry')):
+        for fname in sorted(os.listdir(folder)):
+            if frame_codec.FRAME_RE.match(fname):
+                path = os.path.join(folder, fname)
+                bgr = frame_codec.read_frame(path)
+                if bgr is not None:
+                    frames.append((path, Image.fromarray(np.ascontiguousarray(bgr[:, :, ::-1]))))
+    return frames
+
+def bench_codec(codec, frames, repeat):
+    enc_ms, dec_ms, sizes, lossless = [], [], [], True
+    for (_, img) in frames:
+        ref = np.asarray(img)[:, :, ::-1]
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            data = frame_codec.encode_frame(img, codec)
+            t1 = time.perf_counter()
+            out = frame_codec.decode_frame(data)
+            t2 = time.perf_counter()
+            enc_ms.append(1000 * (t1 - t0))
+            dec_ms.append(1000 * (t2 - t1))
+        sizes.append(len(data))
+        lossless = lossless and out is not None and np.array_equal(out, ref)
+    raw_bytes = sum(img.width * img.height * len(img.getbands()) for (_, img) in frames)
+    return {
+        'codec': codec,
+        'encode_p50_ms': float(np.percentile(enc_ms, 50)),
+        'encode_p90_ms': float(np.percentile(enc_ms, 90)),
+        'decode_p50_ms': float(np.percentile(dec_ms, 50)),
+        'decode_p90_ms': float(np.percentile(dec_ms, 90)),
+        'mean_kb': float(np.mean(sizes)) / 1024,
+        'ratio': raw_bytes / max(1, sum(sizes)),
+        'lossless': lossless,
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark screenshot codecs on the retry* recordings.")
+    ap.add_argument('--codecs', nargs='+', default=sorted(frame_codec.CODECS), choices=sorted(frame_codec.CODECS))
+    ap.add_argument('--repeat', type=int, default=3, help="encode/decode each frame this many times")
+    ap.add_argument('--json', default=None, help="also write the results to this json file")
+    args = ap.parse_args()
+
+    frames = load_frames()
+    if not frames:
+        print("[ERROR] No retry*/step* frames in the current directory.")
+        return 1
+    w, h = frames[0][1].size
+    print(f"[INFO] {len(frames)} frames ({w}x{h}), repeat={args.repeat}")
+
+    rows = [bench_codec(codec, frames, max(1, args.repeat)) for codec in args.codecs]
+    print(f"{'codec':<10} {'enc p50':>9} {'enc p90':>9} {'dec p50':>9} {'dec p90':>9} {'size KB':>9} {'ratio':>7}  lossless")
+    for r in rows:
+        print(f"{r['codec']:<10} {r['encode_p50_ms']:>7.1f}ms {r['encode_p90_ms']:>7.1f}ms "
+              f"{r['decode_p50_ms']:>7.1f}ms {r['decode_p90_ms']:>7.1f}ms {r['mean_kb']:>9.0f} "
+              f"{r['ratio']:>6.1f}x  {'yes' if r['lossless'] else 'NO'}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'frames': len(frames), 'size': [w, h], 'results': rows}, f, indent=2)
+        print(f"[INFO] Report saved: {args.json}")
+    return 0 if all(r['lossless'] for r in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,6 +10,23 @@ train.py
    - 在 gpt2 脚本中使用 GPT-4 Vision (gpt-4-vision-preview)，对压缩后的截图和条件进行判断。
 3. nogpt脚本每次截图都会打印与 stepX-overall.png 的 inliers。
 4. gpt1 脚本使用 GPT 生成并去除三空格缩进和多余解释行。
+5. nogpt/gpt2 共用的匹配函数放在 rpa_runtime.py，生成时把源码嵌入脚本；
+   局部匹配先在缩小灰度图上做模板匹配，分数不明确时才升级为 SIFT + RANSAC，并打印各级命中率。
+6. 生成前按各 retry 的截图（leave-one-retry-out）校准每个 step 的阈值，写入 data[sid]['thresholds']；
+   calibrate-thresholds.py 只打印校准报告，不生成脚本。
+7. 同一 step 的相近参考图聚成原型（合并描述子），运行时只给原型打分；重复的局部截图只保存一份。
+8. 命令字符串在构建时编译成动作 (data[sid]['actions'])，运行时由 ActionExecutor 直接调用 pyautogui（停顿 ACTION_PAUSE）。
+9. 动作执行后等待点击区域（或下一个 step 的学习区域）画面稳定再继续，不再固定等待。
+10. 参考图统一缩放到录制时最常见的分辨率 (data[sid]['ref_size'])，并为 SCALE_LEVELS 中的各个屏幕比例预先提取特征；
+    运行时启动时检测一次屏幕比例并选用对应的一层，换了分辨率 / DPI 缩放的电脑上也能匹配。
+11. 局部截图不再固定为点击位置周围 184x92 的框：构建时在多种尺寸/偏移中选出与画面其他位置、其他 step 截图
+    区分得开的最小的框，点击位置相对框中心的偏移写入 data[sid]['local_offsets']。
+12. 录制时 main_function_full.py 已在后台为每张截图预计算特征、缩略图、候选框特征点数 (stepN-cache.npz)，
+    以及与之前截图两两之间的 ORB 得分、局部截图混淆度 (precompute.sqlite)，见 step_precompute.py；
+    构建时直接读取，只有没有缓存的部分才现场计算。
+13. data 里的参考图路径统一用 '/' 分隔（原来在 Windows 上是 'retry1\\step1.png'，换到其他系统运行就找不到文件）；
+    构建结果另外打包成单个文件 train-model/workflow.rpab（见 workflow_bundle.py），带内容哈希、可直接 mmap，
+    运行时脚本有这个文件时从中载入数据、特征和局部截图，部署时只需复制脚本和这一个文件。
 """
 import json
 import os
@@ -19,11 +36,16 @@ import shutil
 import base64
 import numpy as np
 import time
+from collections import Counter
 from textwrap import dedent
-from openai import OpenAI
 
-
-client = OpenAI(api_key='YOUR_API')
+import rpa_runtime
+from session_catalog import SessionCatalog
+from frame_codec import read_frame  # 录制截图可能是 png / webp / raw，按文件头解码
+import step_precompute  # 录制时后台预计算的特征缓存
+from workflow_bundle import write_bundle  # 单文件工作流 (train-model/workflow.rpab)
+from llm_router import get_router, resolve_llm  # 多提供方路由；在界面进程里运行时与界面共用耗时统计
+from prompt_compiler import PROMPT_BUDGET_SCRIPT, compile_steps, count_tokens, print_prompt_report
 
 
 LOCAL_HALF_SIZE     = 46
@@ -31,6 +53,29 @@ OVERALL_THRESH      = 15.0
 LOCAL_THRESH        = 10.0
 HIGH_MATCH_THRESH   = 50.0
 
+# 候选的 ORB 设置，按开销从小到大排列；构建时为每个 step 选出能区分各 retry 的最便宜的一种
+ORB_CANDIDATES = [
+    {'nfeatures': 250,  'grid': [2, 4]},
+    {'nfeatures': 500,  'grid': [3, 6]},
+    {'nfeatures': 1000, 'grid': [4, 8]},
+    {'nfeatures': 2000, 'grid': [6, 12]},
+]
+
+CLUSTER_SIM          = 0.6    # 参考图相似度（内点数/特征点数）>= 此值 => 归入同一簇
+CLUSTER_MAX_FEATURES = 4000   # 原型合并后的特征点数上限
+LOCAL_DUP_NCC        = 0.98   # 局部截图相关系数 >= 此值 => 视为重复
+
+# 候选的局部截图尺寸 (宽, 高)，从小到大；最后一个即原来的固定尺寸 (4*LOCAL_HALF_SIZE, 2*LOCAL_HALF_SIZE)
+LOCAL_CROP_SIZES    = [(64, 32), (96, 48), (128, 64), (4 * LOCAL_HALF_SIZE, 2 * LOCAL_HALF_SIZE)]
+LOCAL_MIN_MARGIN    = 0.2   # 局部截图在画面其他位置、其他 step 截图上的最高相关系数至少比 1 低这么多
+LOCAL_MIN_KEYPOINTS = 8     # 局部截图至少要有这么多 SIFT 特征点，模板匹配不明确时 SIFT 才靠得住
+LOCAL_FALSE_TEMPLATE = 1000.0  # 模板匹配直接命中了错误位置（不经过局部阈值）时记的误命中得分
+
+CHECK_INTERVAL      = 5.0   # 与生成脚本一致，用于估算等待时间
+CALIB_MARGIN        = 0.3   # 校准阈值放在同 step 最低得分下方 30% 处
+CALIB_FLOOR_OVERALL = 8.0   # 整体阈值下限，再低容易被随机匹配触发
+CALIB_FLOOR_LOCAL   = 6.0   # 局部阈值下限
+
 def parse_step_file(txt_path):
     """解析 'Step X: ...' => { '1': [...], '2': [...], ... }"""
     if not os.path.exists(txt_path):
@@ -57,16 +102,57 @@ def find_xy(cmd: str):
         return int(m.group(1)), int(m.group(2))
     return None
 
+def read_reference(path, size=None):
+    """
+    读取录制截图并缩放到参考分辨率 size=(宽, 高) => (图像, 缩放比例)；
+    录制坐标乘以缩放比例即为参考图坐标。读取失败时图像为 None。
+    """
+    img = read_frame(path)
+    if img is None or not size or img.shape[1] == size[0]:
+        return img, 1.0
+    s = size[0] / float(img.shape[1])
+    interp = cv2.INTER_AREA if s < 1.0 else cv2.INTER_LINEAR
+    return cv2.resize(img, (int(size[0]), int(size[1])), interpolation=interp), s
+
+def reference_features(path, img, cfg, level=1.0):
+    """参考图在某 ORB 设置、某屏幕比例下的特征：录制时后台预计算过的直接读取，否则现场提取"""
+    cfg = step_precompute.orb_tuple(cfg)
+    feats = step_precompute.cached_features(path, cfg, level, img.shape)
+    if feats is None:
+        feats = rpa_runtime.orb_features(rpa_runtime.rescale(img, level), *cfg)
+    return feats
+
+def pair_score(path_a, path_b, feats_a, feats_b, cfg, shape):
+    """两张参考图在同一 ORB 设置下的 RANSAC 内点数；录制时后台算过的直接从 precompute.sqlite 读取"""
+    key = f"{step_precompute.feature_key(cfg, 1.0)}:{shape[1]}x{shape[0]}"
+    return int(step_precompute.pair_value('orb', key, path_a, path_b,
+                                          lambda: rpa_runtime.orb_score_features(feats_a, feats_b)))
+
+def merge_region(region, box):
+    """合并点击区域 => 该 step 的学习区域 (x1,y1,x2,y2)，运行时 OCR 只在这个区域内进行"""
+    if region is None:
+        return tuple(int(v) for v in box)
+    return (min(region[0], box[0]), min(region[1], box[1]),
+            max(region[2], box[2]), max(region[3], box[3]))
+
 def build_data():
     """
-    在当前目录 => 找 retry* 文件夹
+    在当前目录 => 找 retry* 文件夹（从 sessions.sqlite 目录库查询，手动拷贝进来的新文件夹先补录）
     若 retry0 中只有 condition.txt 无 motion-record.txt => skip motion
+    各 retry 在每个 step 的第一个点击坐标（录制坐标）写入 data[sid]['clicks'][folder]，之后不必再读 motion-record.txt
     """
     data = {}
-    retry_folders = [d for d in os.listdir('.') if os.path.isdir(d) and d.startswith('retry')]
+    catalog = SessionCatalog()
+    catalog.sync()
+    retry_folders = [name for (name, number, _) in catalog.sessions() if number is not None]
     if not retry_folders:
         print("[WARNING] No retry* folders found.")
         return data
+    # 参考分辨率 = 录制截图中最常见的分辨率；其他分辨率的录制缩放到这一分辨率
+    sizes = Counter((w, h) for (_, _, _, w, h, _) in catalog.frames() if w and h)
+    ref_size = list(sizes.most_common(1)[0][0]) if sizes else None
+    if len(sizes) > 1:
+        print(f"[INFO] Recordings have {len(sizes)} resolutions => normalize references to {ref_size[0]}x{ref_size[1]}")
 
     condition_map = {}
     skip_retry0_motion = False
@@ -82,46 +168,46 @@ def build_data():
         skip_motion = (folder=='retry0' and skip_retry0_motion)
         motion_map  = {}
         if not skip_motion:
-            mfile = os.path.join(folder,'motion-record.txt')
-            if os.path.exists(mfile):
-                motion_map = parse_step_file(mfile)
-            else:
+            for (_, step, text) in catalog.events(session=folder):
+                motion_map.setdefault(str(step), []).append(text)
+            if not motion_map:
                 print(f"[INFO] {folder} => no motion-record.txt => skip parse.")
         else:
             print(f"[INFO] Skipping motion-record in {folder} => only condition used.")
 
-        for fname in os.listdir(folder):
-            mm = re.match(r'^step(\d+)\.png$', fname, flags=re.IGNORECASE)
-            if mm:
-                sid = mm.group(1)
-                data.setdefault(sid,{
-                    'overall_imgs': [],
-                    'local_imgs': [],
-                    'commands': [],
-                    'conditions': []
-                })
-                full_path = os.path.join(folder,fname)
-                data[sid]['overall_imgs'].append((folder, full_path))
-
-                # parse motion
-                if sid in motion_map:
-                    for c in motion_map[sid]:
-                        if c not in data[sid]['commands']:
-                            data[sid]['commands'].append(c)
-                        xy = find_xy(c)
-                        if xy:
-                            x,y = xy
-                            img= cv2.imread(full_path)
-                            if img is not None:
-                                h,w = img.shape[:2]
-                                half= LOCAL_HALF_SIZE
-                                x1= max(0, x- half* 2)
-                                x2= min(w, x+half*2)
-                                y1= max(0, y-half)
-                                y2= min(h, y+half)
-                                roi= img[y1:y2, x1:x2]
-                                if roi.size>0:
-                                    data[sid]['local_imgs'].append((folder, roi))
+        for (_, step, full_path, _, _, _) in catalog.frames(session=folder):
+            sid = str(step)
+            data.setdefault(sid,{
+                'overall_imgs': [],
+                'local_imgs': [],
+                'commands': [],
+                'conditions': [],
+                'region': None,
+                'clicks': {}
+            })
+            data[sid]['overall_imgs'].append((folder, full_path.replace(os.sep, '/')))
+
+            # parse motion
+            if sid in motion_map:
+                for c in motion_map[sid]:
+                    if c not in data[sid]['commands']:
+                        data[sid]['commands'].append(c)
+                    xy = find_xy(c)
+                    if xy:
+                        data[sid]['clicks'].setdefault(folder, list(xy))
+                        img, s = read_reference(full_path, ref_size)
+                        x,y = int(round(xy[0] * s)), int(round(xy[1] * s))
+                        if img is not None:
+                            h,w = img.shape[:2]
+                            half= LOCAL_HALF_SIZE
+                            x1= max(0, x- half* 2)
+                            x2= min(w, x+half*2)
+                            y1= max(0, y-half)
+                            y2= min(h, y+half)
+                            roi= img[y1:y2, x1:x2]
+                            if roi.size>0:
+                                data[sid]['local_imgs'].append((folder, roi))
+                                data[sid]['region'] = merge_region(data[sid]['region'], (x1, y1, x2, y2))
 
     # merge condition
     for sid, cond_list in condition_map.items():
@@ -129,14 +215,465 @@ def build_data():
             'overall_imgs':[],
             'local_imgs': [],
             'commands': [],
-            'conditions': []
+            'conditions': [],
+            'region': None,
+            'clicks': {}
         })
         for c in cond_list:
             if c not in data[sid]['conditions']:
                 data[sid]['conditions'].append(c)
 
+    for info in data.values():
+        info['ref_size'] = ref_size
+    catalog.close()
     return data
 
+def load_runtime_source() -> str:
+    """读取 rpa_runtime.py 源码，嵌入到生成的脚本中，使生成脚本可以单独运行"""
+    runtime_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rpa_runtime.py')
+    with open(runtime_path, 'r', encoding='utf-8') as f:
+        src = f.read()
+    src = src.replace('# -*- coding: utf-8 -*-\n', '', 1)
+    return f"# ---- rpa_runtime.py (embedded) ----\n{src.strip()}\n# ---- end rpa_runtime.py ----"
+
+def build_orb_features(data):
+    """
+    为每个 step 选择 ORB 特征数和网格布局，返回 {sid: {folder: 参考图特征}}（由 cluster_references 合并后保存）。
+    同一 step 不同 retry 之间的最低得分要达到运行时阈值，且要高于与其他 step 截图的最高得分；
+    满足条件的设置中取特征数最少的；都不满足时取达到阈值且区分度最大的。
+    """
+    imgs, paths = {}, {}
+    for sid, info in data.items():
+        for (folder, path) in info['overall_imgs']:
+            img, _ = read_reference(path, info.get('ref_size'))
+            if img is not None:
+                imgs[(sid, folder)] = img
+                paths[(sid, folder)] = path
+
+    step_feats = {}
+    for sid, info in data.items():
+        own = [k for k in imgs if k[0] == sid]
+        if not own:
+            continue
+        need = HIGH_MATCH_THRESH if rpa_runtime.step_has_xy(info) else OVERALL_THRESH
+        tried = []
+        for cfg in ORB_CANDIDATES:
+            feats = {k: reference_features(paths[k], img, cfg) for k, img in imgs.items()}
+            score = lambda a, b: pair_score(paths[a], paths[b], feats[a], feats[b], cfg, imgs[a].shape)
+            pos = [score(a, b) for a in own for b in own if a != b]
+            neg = [score(a, b) for a in own for b in feats if b[0] != sid]
+            pos_min = min(pos) if pos else need  # 只有一次录制时无法比较，只看是否能提取到特征
+            neg_max = max(neg) if neg else 0
+            print(f"[INFO] step{sid} ORB {cfg['nfeatures']}/{cfg['grid']} => same-step min={pos_min}, other-step max={neg_max}")
+            tried.append((pos_min >= need, pos_min - neg_max, cfg, feats))
+            if pos_min >= need and pos_min > neg_max:
+                break
+        ok = [t for t in tried if t[0]] or tried
+        _, margin, cfg, feats = next((t for t in ok if t[1] > 0), max(ok, key=lambda t: t[1]))
+        info['orb'] = dict(cfg)
+        step_feats[sid] = {folder: feats[(s, folder)] for (s, folder) in own}
+        print(f"[INFO] step{sid} => ORB nfeatures={cfg['nfeatures']}, grid={cfg['grid']}, margin={margin}")
+    return step_feats
+
+def cluster_sim(fa, fb):
+    """两张参考图的相似度 = RANSAC 内点数 / 较少一方的特征点数"""
+    n = min(len(fa[0]), len(fb[0]))
+    return rpa_runtime.orb_score_features(fa, fb) / n if n else 0.0
+
+def merge_features(base, other):
+    """
+    把 other 中没有与 base 匹配上的特征点通过单应性映射到 base 的坐标系后追加进来，
+    得到原型的合并描述子集合；无法估计单应性时只保留 base。
+    """
+    (pts_b, des_b), (pts_o, des_o) = base, other
+    if des_b is None or des_o is None or len(des_b) < 4 or len(des_o) < 4:
+        return base
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(des_o, des_b)
+    if len(matches) < 4:
+        return base
+    src = np.float32([pts_o[m.queryIdx] for m in matches])
+    dst = np.float32([pts_b[m.trainIdx] for m in matches])
+    H, _ = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+    if H is None:
+        return base
+    seen = set(m.queryIdx for m in matches)
+    extra = [i for i in range(len(des_o)) if i not in seen]
+    if not extra:
+        return base
+    moved = cv2.perspectiveTransform(pts_o[extra].reshape(-1, 1, 2), H).reshape(-1, 2)
+    return np.vstack([pts_b, moved]).astype(np.float32), np.vstack([des_b, des_o[extra]])
+
+def merge_cluster(feats, medoid, members):
+    """簇内各图的特征合并到原型上，特征点数不超过 CLUSTER_MAX_FEATURES"""
+    merged = feats[medoid]
+    for f in members:
+        if f != medoid and f in feats and len(merged[0]) < CLUSTER_MAX_FEATURES:
+            merged = merge_features(merged, feats[f])
+    return merged[0][:CLUSTER_MAX_FEATURES], merged[1][:CLUSTER_MAX_FEATURES]
+
+def pyramid_features(info, protos):
+    """
+    原型在其他屏幕比例下的特征 => {'folder@0.8': (pts, des)}：簇内各图按 SCALE_LEVELS 缩放后提取特征再合并，
+    与运行时在该比例的屏幕上截到的图一致（比例 1 的特征由 cluster_references 保存）。
+    """
+    cfg = rpa_runtime.orb_config(info.get('orb'))
+    paths = dict(info['overall_imgs'])
+    imgs = {f: read_reference(paths[f], info.get('ref_size'))[0] for members in protos.values() for f in members}
+    out = {}
+    for level in rpa_runtime.SCALE_LEVELS:
+        if abs(level - 1.0) < 1e-3:
+            continue
+        feats = {f: reference_features(paths[f], img, cfg, level) for f, img in imgs.items() if img is not None}
+        for medoid, members in protos.items():
+            if medoid in feats:
+                out[rpa_runtime.level_key(medoid, level)] = merge_cluster(feats, medoid, members)
+    return out
+
+def cluster_references(data, step_feats, out_dir):
+    """
+    同一 step 的整体参考图按特征相似度聚类（全连接：与簇内每张图的相似度都 >= CLUSTER_SIM 才加入），
+    每簇保留一个原型（与簇内其他图相似度之和最大的那张），其特征为簇内各图合并后的描述子集合，
+    不与任何图相似的离群图单独成簇。运行时只给原型打分 => 每次截图的匹配次数随不同画面的数量增长，而不是随 retry 数量。
+    结果：data[sid]['prototypes'] = {原型 folder: [簇内 folder]}，特征（含各屏幕比例的特征层）保存为 train-model/stepX-features.npz。
+    """
+    for sid, feats in step_feats.items():
+        info = data[sid]
+        folders = [f for (f, _) in info['overall_imgs'] if f in feats]
+        sim = {(a, b): cluster_sim(feats[a], feats[b]) for a in folders for b in folders if a < b}
+        sim_of = lambda a, b: sim.get((min(a, b), max(a, b)), 1.0)
+        clusters = []
+        for f in folders:
+            for cl in clusters:
+                if all(sim_of(f, g) >= CLUSTER_SIM for g in cl):
+                    cl.append(f)
+                    break
+            else:
+                clusters.append([f])
+
+        protos, store = {}, {}
+        for cl in clusters:
+            medoid = max(cl, key=lambda a: sum(sim_of(a, b) for b in cl if b != a))
+            protos[medoid] = sorted(cl)
+            store[medoid] = merge_cluster(feats, medoid, cl)
+        info['prototypes'] = protos
+        if out_dir:
+            store.update(pyramid_features(info, protos))
+            info['features'] = f"step{sid}-features.npz"
+            rpa_runtime.save_feature_store(os.path.join(out_dir, info['features']), store)
+        print(f"[INFO] step{sid} => {len(folders)} overall refs => {len(protos)} prototypes {sorted(protos)}")
+
+def local_prototypes(local_imgs):
+    """
+    局部截图去重：尺寸相同且归一化相关系数 >= LOCAL_DUP_NCC 的视为同一张 => {folder: 原型 folder}。
+    重复的局部截图共用原型的文件，运行时同一次截图里同一个文件只匹配一次。
+    """
+    alias, kept = {}, []
+    for (folder, roi) in local_imgs:
+        for (pf, proi) in kept:
+            if proi.shape == roi.shape and cv2.matchTemplate(roi, proi, cv2.TM_CCOEFF_NORMED).max() >= LOCAL_DUP_NCC:
+                alias[folder] = pf
+                break
+        else:
+            alias[folder] = folder
+            kept.append((folder, roi))
+    return alias
+
+def crop_candidates(x, y, w, h):
+    """点击位置 (x, y) 周围的候选框 (x1, y1, x2, y2)，按面积从小到大；框不超出截图，点击位置总在框内"""
+    boxes = []
+    for (cw, ch) in LOCAL_CROP_SIZES:
+        for (ox, oy) in [(0, 0), (-cw // 4, 0), (cw // 4, 0), (0, -ch // 4), (0, ch // 4)]:
+            x1 = min(max(0, x - cw // 2 + ox), max(0, w - cw))
+            y1 = min(max(0, y - ch // 2 + oy), max(0, h - ch))
+            box = (x1, y1, min(w, x1 + cw), min(h, y1 + ch))
+            if box[0] <= x < box[2] and box[1] <= y < box[3] and box not in boxes:
+                boxes.append(box)
+    return boxes
+
+def crop_confusion(q_small, box, screens_small, at=None):
+    """
+    局部截图（缩小灰度图）在各截图上、除目标所在位置以外的最高相关系数 —— 与运行时模板匹配的次高峰一致。
+    at 为目标在这些截图上的左上角 (x, y)，缺省为框本身的位置：
+    其他 step 的截图在同一位置出现同样的元素不算混淆（同一界面）；
+    同一 step 其他 retry 的截图里目标可能在别处（如标签页换了位置），由调用方按那次录制的点击位置给出；
+    两次录制常点在同一元素的不同位置，所以目标附近 LOCAL_HALF_SIZE 以内都算目标（与 crop_false_hit、校准时的判定一致）。
+    """
+    s = rpa_runtime.TM_SCALE
+    qh, qw = q_small.shape[:2]
+    x, y = [int(v * s) for v in (at or box[:2])]
+    pad = int(LOCAL_HALF_SIZE * s) if at is not None else 0
+    worst = 0.0
+    for t in screens_small:
+        if qh > t.shape[0] or qw > t.shape[1]:
+            continue
+        res = cv2.matchTemplate(t, q_small, cv2.TM_CCOEFF_NORMED)
+        res[max(0, y - qh // 2 - pad):y + qh // 2 + pad + 1, max(0, x - qw // 2 - pad):x + qw // 2 + pad + 1] = -1.0
+        worst = max(worst, float(res.max()))
+    return worst
+
+def crop_pair_confusion(path, img, box, neg_path, neg_small, at=None):
+    """crop_confusion 只对一张截图 (neg_path) 的版本；录制时后台算过的直接从 precompute.sqlite 读取"""
+    key = f"{','.join(str(v) for v in box)}:{img.shape[1]}x{img.shape[0]}"
+    if at is not None and tuple(at) != tuple(box[:2]):
+        key += f"@{at[0]},{at[1]}"
+    return step_precompute.pair_value(
+        'crop', key, path, neg_path,
+        lambda: crop_confusion(rpa_runtime.to_small_gray(img[box[1]:box[3], box[0]:box[2]]), box, [neg_small], at))
+
+def crop_false_hit(path, img, box, neg_path, neg_img, neg_small, neg_feats, target):
+    """
+    局部截图在同一 step 另一次录制的截图上按运行时的分级匹配 (tiered_match) 定位；
+    target 为按那次录制的点击位置推算的局部截图中心。定位到的中心离 target 超过 LOCAL_HALF_SIZE => 误命中，
+    返回其得分（模板匹配直接命中 => LOCAL_FALSE_TEMPLATE）；没有定位到或定位正确 => 0。
+    neg_feats() 返回 neg 截图的 SIFT 特征，只在需要计算时调用。结果记在 precompute.sqlite。
+    """
+    key = f"{','.join(str(v) for v in box)}:{img.shape[1]}x{img.shape[0]}@{target[0]},{target[1]}"
+
+    def compute():
+        ok, _, center, tier, sc = rpa_runtime.tiered_match(img[box[1]:box[3], box[0]:box[2]], neg_img, 5.0, 0.0,
+                                                           neg_small, neg_feats())
+        if not ok or (abs(center[0] - target[0]) <= LOCAL_HALF_SIZE and abs(center[1] - target[1]) <= LOCAL_HALF_SIZE):
+            return 0.0
+        return LOCAL_FALSE_TEMPLATE if tier == 'template' else float(sc)
+    return step_precompute.pair_value('crophit', key, path, neg_path, compute)
+
+def select_local_crops(data):
+    """
+    为有坐标的 step 重新选择局部截图：在点击位置周围按 crop_candidates 的尺寸/偏移截取候选框，
+    用运行时同样的缩小灰度图做模板匹配，求它在本截图其他位置、同一 step 其他 retry 截图上目标以外的位置
+    （目标位置按那次录制的点击位置推算）和其他 step 截图上的最高相关系数（混淆度）；
+    再在同一 step 其他 retry 的截图上按运行时的分级匹配定位一次，定位到目标以外的得分记为误命中 (crop_false_hit)。
+    取混淆度 <= 1 - LOCAL_MIN_MARGIN、SIFT 特征点够多且误命中得分 < LOCAL_THRESH 的最小的框；
+    都不满足时取误命中得分最低的框（同分时取混淆度最低的）：误命中得分在别的分辨率下会变高，离阈值越远越稳。
+    结果写回 info['local_imgs']，点击位置相对框中心的偏移写入 info['local_offsets'][folder]。
+    需在 build_data 之后、calibrate_thresholds 之前调用。返回报告行列表。
+    """
+    screens, factor, paths = {}, {}, {}
+    for sid, info in data.items():
+        for (folder, path) in info['overall_imgs']:
+            img, s = read_reference(path, info.get('ref_size'))
+            if img is not None:
+                screens[(sid, folder)] = img
+                factor[(sid, folder)] = s
+                paths[(sid, folder)] = path
+    small = {}
+    for k, img in screens.items():
+        cached = step_precompute.cached_small(paths[k], img.shape)
+        small[k] = cached if cached is not None else rpa_runtime.to_small_gray(img)
+    sift = cv2.SIFT_create()
+    sift_feats = {}
+
+    def sift_of(k):
+        """截图的整图 SIFT 特征：优先用录制时的缓存，每张只算一次"""
+        if k not in sift_feats:
+            feats = step_precompute.cached_sift(paths[k], screens[k].shape)
+            if feats is None:
+                kp, des = sift.detectAndCompute(screens[k], None)
+                feats = (np.float32([p.pt for p in kp]).reshape(-1, 2), des)
+            sift_feats[k] = feats
+        return sift_feats[k]
+
+    report = []
+    for sid, info in sorted(data.items(), key=lambda kv: int(kv[0])):
+        if not info['local_imgs']:
+            continue
+        new_loc, offsets = [], {}
+        for (folder, _) in info['overall_imgs']:
+            pt = info['clicks'].get(folder)
+            if pt is None or (sid, folder) not in screens:
+                continue
+            img = screens[(sid, folder)]
+            h, w = img.shape[:2]
+            x, y = int(round(pt[0] * factor[(sid, folder)])), int(round(pt[1] * factor[(sid, folder)]))
+            # 同 step 其他 retry 的截图：目标（按那次的点击位置）以外的地方也不能像这个框
+            same = {}
+            for k in small:
+                pt2 = info['clicks'].get(k[1]) if k[0] == sid and k[1] != folder else None
+                if pt2 is not None:
+                    same[k] = (int(round(pt2[0] * factor[k])) - x, int(round(pt2[1] * factor[k])) - y)
+            negs = [(sid, folder)] + list(same) + [k for k in small if k[0] != sid]
+            kp_cached = step_precompute.cached_crop_keypoints(paths[(sid, folder)], img.shape) if factor[(sid, folder)] == 1.0 else {}
+            best = None
+            for box in crop_candidates(x, y, w, h):
+                conf = max(crop_pair_confusion(paths[(sid, folder)], img, box, paths[k], small[k],
+                                               (box[0] + same[k][0], box[1] + same[k][1]) if k in same else None)
+                           for k in negs)
+                cx, cy = (box[0] + box[2]) // 2, (box[1] + box[3]) // 2
+                false = max([crop_false_hit(paths[(sid, folder)], img, box, paths[k], screens[k], small[k],
+                                            lambda k=k: sift_of(k), (cx + same[k][0], cy + same[k][1]))
+                             for k in same] + [0.0])
+                n_kp = kp_cached.get(box)
+                if n_kp is None:
+                    roi = img[box[1]:box[3], box[0]:box[2]]
+                    n_kp = len(sift.detect(cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY), None))
+                ok = conf <= 1.0 - LOCAL_MIN_MARGIN and n_kp >= LOCAL_MIN_KEYPOINTS and false < LOCAL_THRESH
+                cand = (ok, box, conf, n_kp, false)
+                if ok:
+                    best = cand
+                    break  # 候选按面积从小到大，第一个满足条件的就是最小的
+                if best is None or (false, conf) < (best[4], best[2]):
+                    best = cand
+            ok, box, conf, n_kp, false = best
+            new_loc.append((folder, img[box[1]:box[3], box[0]:box[2]]))
+            offsets[folder] = [int(x - (box[0] + box[2]) // 2), int(y - (box[1] + box[3]) // 2)]
+            report.append({'step': sid, 'folder': folder, 'size': [box[2] - box[0], box[3] - box[1]],
+                           'offset': offsets[folder], 'confusion': round(conf, 3), 'keypoints': n_kp,
+                           'false_hit': round(false, 1), 'ok': ok})
+            print(f"[INFO] step{sid} {folder} => local crop {box[2] - box[0]}x{box[3] - box[1]} "
+                  f"offset={offsets[folder]} confusion={conf:.3f} keypoints={n_kp} false_hit={false:g}"
+                  + ("" if ok else " (no candidate separates => least confused)"))
+        if new_loc:
+            info['local_imgs'] = new_loc
+            info['local_offsets'] = offsets
+    return report
+
+def pick_threshold(pos, neg, default, floor, margin=CALIB_MARGIN):
+    """
+    pos: 同 step 截图的得分，neg: 其他 step 截图的得分（都是 leave-one-retry-out）。
+    阈值放在同 step 最低得分下方 margin 处，但要高于其他 step 的最高得分，放不下时取两者中点；
+    两者重叠或没有同 step 得分时无法校准 => 保留默认阈值。返回 (阈值, 是否校准)。
+    """
+    if not pos:
+        return default, False
+    lo = max(neg) if neg else 0
+    hi = min(pos)
+    if hi <= lo:
+        return default, False
+    thr = max(floor, hi * (1 - margin))
+    if thr <= lo:
+        thr = (lo + hi) / 2.0
+    return round(float(thr), 1), True
+
+def expected_polls(pos, thr):
+    """同 step 截图按阈值的命中率 => 期望轮询次数（命中率为 0 时为 None，即会一直等待）"""
+    hit = sum(1 for sc in pos if sc >= thr) / len(pos) if pos else 0.0
+    return round(1.0 / hit, 2) if hit > 0 else None
+
+def click_point(catalog, folder, sid):
+    """目录库里某个 retry 在某 step 的第一个点击坐标（录制坐标）；没有时返回 None"""
+    for (_, _, text) in catalog.events(session=folder, step=sid):
+        xy = find_xy(text)
+        if xy:
+            return xy
+    return None
+
+def quantize_features(feat):
+    """与 save_feature_store / load_feature_store 往返一次相同：坐标取整为 uint16 再转回 float32"""
+    pts, des = feat
+    return np.round(pts).clip(0, 65535).astype(np.uint16).astype(np.float32), des
+
+def prototype_store(info, feats, out_dir=None, exclude=None):
+    """
+    运行时给这个 step 打分用的原型特征（比例 1）=> {原型 folder: (pts, des)}。
+    exclude=None 且特征文件已保存时直接读取 train-model/stepX-features.npz（运行时载入的就是它）；
+    exclude 为某个 folder 时把它从所在簇里去掉后重新合并（leave-one-retry-out），簇里只有它时该原型不参与。
+    """
+    protos = info.get('prototypes') or {f: [f] for f in feats}
+    if exclude is None and out_dir and info.get('features'):
+        fname = os.path.join(out_dir, info['features'])
+        rpa_runtime.FEATURE_STORES.pop(fname, None)  # 同一进程里重复构建时不用上一次的缓存
+        saved = rpa_runtime.load_feature_store(fname)
+        return {m: saved[m] for m in protos if m in saved}
+    store = {}
+    for medoid, members in protos.items():
+        members = [f for f in members if f != exclude and f in feats]
+        if members:
+            m = medoid if medoid in members else members[0]
+            store[m] = quantize_features(merge_cluster(feats, m, members))
+    return store
+
+def calibrate_thresholds(data, step_feats, out_dir=None, margin=CALIB_MARGIN):
+    """
+    leave-one-retry-out 校准每个 step 的阈值，写入 data[sid]['thresholds']。
+    - 整体：与运行时一样给该 step 的原型打分（合并后的描述子集合，见 prototype_store），每张截图取最高分；
+      同 step 截图为正例（打分前把该截图的 retry 从原型里去掉），其他 step 截图为反例（用保存的原型）。
+      有坐标的 step 校准 'high'，否则校准 'overall'。
+    - 局部：有坐标的 step 用 retry A 的局部截图在其他 retry 的同 step 截图上做 SIFT 定位，
+      定位到 A 的点击位置附近时的得分为正例，校准 'local'。
+    需在 cluster_references 之后、局部截图保存为文件之前调用（info['local_imgs'] 仍是图像）。
+    step_feats 为 build_orb_features 的结果；out_dir 为保存特征文件的目录（None => 在内存里合并原型）。返回报告行列表。
+    """
+    screens, factor, paths = {}, {}, {}  # 参考图、录制坐标 => 参考图坐标的缩放比例、截图路径
+    for sid, info in data.items():
+        for (folder, path) in info['overall_imgs']:
+            img, s = read_reference(path, info.get('ref_size'))
+            if img is not None:
+                screens[(sid, folder)] = img
+                factor[(sid, folder)] = s
+                paths[(sid, folder)] = path
+
+    feat_cache = {}
+    def feats_of(key, cfg):
+        if (key, cfg) not in feat_cache:
+            feat_cache[(key, cfg)] = reference_features(paths[key], screens[key], cfg)
+        return feat_cache[(key, cfg)]
+
+    report = []
+    for sid, info in sorted(data.items(), key=lambda kv: int(kv[0])):
+        cfg = rpa_runtime.orb_config(info.get('orb'))
+        feats = step_feats.get(sid, {})
+        full = prototype_store(info, feats, out_dir)
+        pos, neg = [], []
+        for key in screens:
+            store = prototype_store(info, feats, exclude=key[1]) if key[0] == sid else full
+            scores = [rpa_runtime.orb_score_features(pf, feats_of(key, cfg)) for pf in store.values()]
+            if scores:
+                (pos if key[0] == sid else neg).append(int(max(scores)))
+
+        has_xy = rpa_runtime.step_has_xy(info)
+        kind, default = ('high', HIGH_MATCH_THRESH) if has_xy else ('overall', OVERALL_THRESH)
+        thr, ok = pick_threshold(pos, neg, default, CALIB_FLOOR_OVERALL, margin)
+        th = {kind: thr}
+        report.append({'step': sid, 'kind': kind, 'default': default, 'threshold': thr, 'calibrated': ok,
+                       'n': len(pos), 'pos_min': min(pos) if pos else None, 'neg_max': max(neg) if neg else None,
+                       'polls_default': expected_polls(pos, default), 'polls': expected_polls(pos, thr),
+                       'false_fire': sum(1 for sc in neg if sc >= thr)})
+
+        if has_xy:
+            loc_pos, loc_neg, tries = [], [], 0
+            for (folder, roi) in info['local_imgs']:
+                off = (info.get('local_offsets') or {}).get(folder, (0, 0))
+                for (s2, f2), img in screens.items():
+                    pt = info['clicks'].get(f2)
+                    if s2 != sid or f2 == folder or pt is None:
+                        continue
+                    f = factor.get((s2, f2), 1.0)
+                    pt = (pt[0] * f - off[0], pt[1] * f - off[1])  # 那次录制的点击位置 => 局部截图中心应在的位置
+                    tries += 1
+                    train = step_precompute.cached_sift(paths[(s2, f2)], img.shape)
+                    sc, _, center = rpa_runtime.orb_homography_and_bbox(roi, img, 5.0, train)
+                    if center is None:
+                        continue
+                    if abs(center[0] - pt[0]) <= LOCAL_HALF_SIZE and abs(center[1] - pt[1]) <= LOCAL_HALF_SIZE:
+                        loc_pos.append(sc)
+                    else:
+                        loc_neg.append(sc)  # 定位到了目标以外的位置：阈值要高于这些得分
+            thr, ok = pick_threshold(loc_pos, loc_neg, LOCAL_THRESH, CALIB_FLOOR_LOCAL, margin)
+            th['local'] = thr
+            # 定位失败的尝试按 0 分计入命中率
+            padded = loc_pos + [0] * (tries - len(loc_pos))
+            report.append({'step': sid, 'kind': 'local', 'default': LOCAL_THRESH, 'threshold': thr, 'calibrated': ok,
+                           'n': tries, 'pos_min': min(loc_pos) if loc_pos else None,
+                           'neg_max': max(loc_neg) if loc_neg else None,
+                           'polls_default': expected_polls(padded, LOCAL_THRESH), 'polls': expected_polls(padded, thr),
+                           'false_fire': sum(1 for sc in loc_neg if sc >= thr)})
+        info['thresholds'] = th
+    return report
+
+def print_calibration(report):
+    """打印校准结果与期望轮询次数（每次轮询间隔 CHECK_INTERVAL 秒）"""
+    fmt = lambda v: '-' if v is None else (f"{v:g}" if isinstance(v, (int, float)) else str(v))
+    print(f"{'step':<6}{'kind':<9}{'default':>9}{'calib':>8}{'n':>4}{'pos_min':>9}{'neg_max':>9}"
+          f"{'polls(def)':>12}{'polls':>8}{'false':>7}")
+    for r in report:
+        print(f"{r['step']:<6}{r['kind']:<9}{fmt(r['default']):>9}{fmt(r['threshold']):>8}{r['n']:>4}"
+              f"{fmt(r['pos_min']):>9}{fmt(r['neg_max']):>9}{fmt(r['polls_default']):>12}{fmt(r['polls']):>8}"
+              f"{r['false_fire']:>7}")
+        if not r['calibrated']:
+            print(f"[WARNING] step{r['step']} {r['kind']}: same-step scores do not separate from other steps => keep default {fmt(r['default'])}.")
+        elif r['polls'] is not None:
+            print(f"[INFO] step{r['step']} {r['kind']}: expected wait ~{(r['polls'] - 1) * CHECK_INTERVAL:.1f}s before match.")
+
 def prepare_train_model_folder():
     out_dir = "train-model"
     if os.path.exists(out_dir):
@@ -144,17 +681,17 @@ def prepare_train_model_folder():
     os.makedirs(out_dir)
     return out_dir
 
-def call_gpt_for_script_gen(prompt_text: str) -> str:
+def call_gpt_for_script_gen(prompt_text: str, llm=None) -> str:
     """
-    调用 gpt-4 生成脚本；若错误则返回最小脚本。
+    调用 llm（界面下拉框的选项，如 "Claude 3.5"；None => 环境变量 RPA_LLM，都没有时用 gpt-4）生成脚本；若错误则返回最小脚本。
     此函数修改了 "role":"system","content" ，
     以让 GPT 输出一个具有完整运行逻辑、可直接运行的 Python 脚本，
     无多余解释语句，并能根据输入条件生成 PyAutoGUI 代码。
     """
+    provider, model = resolve_llm(llm or os.environ.get('RPA_LLM'))
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
+        code = get_router().chat(
+            [
                 {
                     "role": "system",
                     "content": (
@@ -171,9 +708,9 @@ def call_gpt_for_script_gen(prompt_text: str) -> str:
                     "role": "user",
                     "content": prompt_text
                 }
-            ]
+            ],
+            provider, model
         )
-        code = resp.choices[0].message.content.strip()
         if not code:
             code = "#!/usr/bin/env python\nprint('No script content')"
         return code
@@ -215,156 +752,96 @@ def generate_nogpt_script(data: dict) -> str:
 
     data = {data}
 
-    def orb_homography_score(img_query, img_train, ransac_thresh=5.0):
-        orb = cv2.ORB_create()
-        kp_q, des_q = orb.detectAndCompute(img_query, None)
-        kp_t, des_t = orb.detectAndCompute(img_train, None)
-        if des_q is None or des_t is None or len(des_q)<4 or len(des_t)<4:
-            return 0
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-        matches = bf.match(des_q, des_t)
-        if len(matches)<4:
-            return 0
-        matches = sorted(matches, key=lambda x: x.distance)
-        pts_q= np.float32([kp_q[m.queryIdx].pt for m in matches])
-        pts_t= np.float32([kp_t[m.trainIdx].pt for m in matches])
-        H, mask= cv2.findHomography(pts_q, pts_t, cv2.RANSAC, ransac_thresh)
-        if H is None:
-            return 0
-        return mask.ravel().sum()
-
-
-    def execute_commands_once(cmds):
-        executed=False
-        if not isinstance(cmds, list):
-            cmds=[cmds]
-        for c in cmds:
-            if executed:
-                break
-            print(f"[ACTION] => {{c}}")
-            xy = re.search(r'\((-?\d+),\s*(-?\d+)\)', c)
-            if xy:
-                xx= int(xy.group(1))
-                yy= int(xy.group(2))
-                print(f"pyautogui.click({{xx}}, {{yy}})")
-                pyautogui.click(xx, yy)
-                executed=True
-            elif "key pressed:" in c:
-                parts= c.split(".")
-                if len(parts)>1:
-                    key_char= parts[-1].strip()
-                    print(f"pyautogui.press('{{key_char}}')")
-                    pyautogui.press(key_char)
-                    executed=True
-        return executed
-    
-    def orb_homography_and_bbox(img_query, img_train, ransac_thresh=5.0):
-        #使用 SIFT 特征点匹配和单应性矩阵计算图像区域。返回匹配分数和边界框 (x1, y1, x2, y2)
-        sift = cv2.SIFT_create()
-        kp_q, des_q = sift.detectAndCompute(img_query, None)
-        kp_t, des_t = sift.detectAndCompute(img_train, None)
-    
-        if des_q is None or des_t is None:
-            return 0, None, None
-    
-        bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=True)
-        matches = bf.match(des_q, des_t)
-    
-        if len(matches) < 4:  # 匹配点不足
-            return len(matches), None, None
-    
-        matches = sorted(matches, key=lambda x: x.distance)
-        pts_q = np.float32([kp_q[m.queryIdx].pt for m in matches])
-        pts_t = np.float32([kp_t[m.trainIdx].pt for m in matches])
-    
-        H, mask = cv2.findHomography(pts_q, pts_t, cv2.RANSAC, ransac_thresh)
-    
-        if H is None:
-            return len(matches), None, None
-    
-        h, w = img_query.shape[:2]
-        corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
-        transformed_corners = cv2.perspectiveTransform(corners, H)
-    
-        x_coords = transformed_corners[:, 0, 0]
-        y_coords = transformed_corners[:, 0, 1]
-        x1, y1, x2, y2 = int(x_coords.min()), int(y_coords.min()), int(x_coords.max()), int(y_coords.max())
-    
-        # 计算中心点
-        cx = (x1 + x2) // 2
-        cy = (y1 + y2) // 2
-    
-        return mask.ravel().sum(), (x1, y1, x2, y2), (cx, cy)
-
-
+    """)
+    code += "\n\n" + load_runtime_source() + "\n\n"
+    code += dedent("""
     def main():
+        global data
+        data = load_workflow(data)  # 有 workflow.rpab 时从中载入数据、特征和局部截图（校验内容哈希）
         step_ids = sorted(data.keys(), key=lambda x: int(x))  # 排序 Step ID
         idx = 0
+        start_tracing()  # 每个阶段的耗时写入 runtime-trace.jsonl
+        detect_screen_scale(pyautogui, data)  # 屏幕与参考图的比例只检测一次，选用对应的特征层
+        executor = ActionExecutor(pyautogui, ACTION_PAUSE)  # 构建时编译好的动作，直接调用 pyautogui
     
         while idx < len(step_ids):
             sid = step_ids[idx]  # 当前 Step ID
             info = data[sid]     # 当前 Step 数据
             ov_list = info.get('overall_imgs', [])  # 整体图片列表
             loc_list = info.get('local_imgs', [])   # 局部图片列表
-            cmds = info.get('commands', [])         # 对应的命令
             conds = info.get('conditions', [])      # 条件
     
             if not ov_list:
                 # 如果整体图片不存在，报错并终止脚本
-                print(f"[ERROR] step{{sid}} => no overall images found. Exiting.")
+                print(f"[ERROR] step{sid} => no overall images found. Exiting.")
                 return
     
-            print(f"[INFO] Checking step{{sid}}...")
-            sc = pyautogui.screenshot()  # 截取当前屏幕
-            scr_cv = cv2.cvtColor(np.array(sc), cv2.COLOR_RGB2BGR)  # 转换为 OpenCV 格式
+            print(f"[INFO] Checking step{sid}...")
+            trace_context(step=sid, ref=None)
+            with span('capture'):
+                sc = pyautogui.screenshot()  # 截取当前屏幕
+            with span('convert'):
+                scr_cv = cv2.cvtColor(np.array(sc), cv2.COLOR_RGB2BGR)  # 转换为 OpenCV 格式
+                scr_small = to_small_gray(scr_cv)  # 模板匹配用的缩小灰度图，每次截图只算一次
+            frame = FrameFeatures(scr_cv)  # 截图特征按 step 的 ORB 设置只提取一次，所有参考图共用
     
-            has_xy = any(re.search(r'\((\d+),\s*(\d+)\)', c) for c in cmds)  # 检查命令是否包含坐标
-            matched = False
+            # 当前 step 与后面 LOOKAHEAD_STEPS 个 step 一起打分；界面已经前进时（人工点击/页面自动跳转）直接跳过去
+            score_cache = {}  # 本次截图的整体匹配分数，跳转判断和后面的匹配共用
+            new_idx = evaluate_lookahead(data, step_ids, idx, frame, score_cache, LOOKAHEAD_STEPS,
+                                         RANSAC_THRESH, OVERALL_THRESH, HIGH_MATCH_THRESH)
+            if new_idx != idx:
+                print(f"   => screen already at step{step_ids[new_idx]} => skip step{sid}")
+                idx = new_idx
+                sid = step_ids[idx]
+                info = data[sid]
+                loc_list = info.get('local_imgs', [])
+                conds = info.get('conditions', [])
+                trace_context(step=sid)
     
-            for (folder, rel_png) in ov_list:
-                # 构造整体图片路径
-                ovpath = os.path.join('..',  rel_png)
-                if not os.path.exists(ovpath):
-                    print(f"[ERROR] not found: {{ovpath}} => skip.")
-                    continue
+            has_xy = step_has_xy(info)  # 检查命令是否包含坐标
+            # 该 step 的阈值（构建时按录制数据校准，未校准时用上面的全局阈值）
+            th_ov, th_loc, th_high = step_thresholds(info, OVERALL_THRESH, LOCAL_THRESH, HIGH_MATCH_THRESH)
+            matched = False
     
-                ref_ov = cv2.imread(ovpath)
-                if ref_ov is None:
-                    print(f"[ERROR] cannot read {{ovpath}} => skip.")
-                    continue
+            # 文字类条件先用本地 OCR 判断（只在学习区域内），明确不满足时不做图像匹配
+            if check_text_conditions(conds, scr_cv, info.get('region')) is False:
+                print(f"   => text condition not met => wait {CHECK_INTERVAL}s.")
+                with span('wait'):
+                    time.sleep(CHECK_INTERVAL)
+                continue
     
-                sc_ov = orb_homography_score(ref_ov, scr_cv, RANSAC_THRESH)  # 计算整体匹配分数
-                print(f"   => match with {{ovpath}}, inliers={{sc_ov}}")
+            tried_loc = set()  # 本次截图已经匹配过的局部截图（重复的局部截图共用一个文件）
+            for (folder, rel_png, sc_ov) in iter_step_scores(info, frame, score_cache, RANSAC_THRESH):
+                # 已在 evaluate_lookahead 中算过的分数直接复用
+                print(f"   => match with {rel_png}, inliers={sc_ov}")
     
                 if has_xy:
-                    if sc_ov >= HIGH_MATCH_THRESH:
+                    if sc_ov >= th_high:
                         # 整体匹配成功后，尝试局部匹配
+                        members = step_members(info, folder)
                         for (fld2, localfile) in loc_list:
-                            if fld2 != folder:
-                                continue  # 只匹配同一个 folder 的局部图片
+                            if fld2 not in members or localfile in tried_loc:
+                                continue  # 只匹配与该原型同簇的 folder 的局部图片，每个文件只匹配一次
+                            tried_loc.add(localfile)
     
                             local_path = os.path.join( localfile)
-                            if not os.path.exists(local_path):
-                                print(f"[ERROR] Local file not found: {{local_path}}")
-                                continue
-    
-                            ref_loc = cv2.imread(local_path)
+                            ref_loc = load_scaled(local_path)  # 局部截图只读取、按屏幕比例缩放一次（文件缺失时返回 None）
                             if ref_loc is None:
-                                print(f"[ERROR] Cannot read local image: {{local_path}}")
                                 continue
     
-                            # 计算局部匹配分数并找到区域
-                            sc_loc, bbox, center = orb_homography_and_bbox(ref_loc, scr_cv, RANSAC_THRESH)
-                            print(f"       => local match {{local_path}}, inliers={{sc_loc}}")
+                            # 先在上次定位的位置附近跟踪；跟丢时分级匹配：先模板匹配，分数不明确时再 SIFT + RANSAC
+                            trace_context(ref=localfile)
+                            with span('match', kind='local') as sp:
+                                ok, bbox, center, tier, sc_loc = tracked_match(localfile, ref_loc, scr_cv, RANSAC_THRESH, th_loc, scr_small)
+                                sp.set(score=round(float(sc_loc), 3), tier=tier)
+                            print(f"       => local match {local_path}, tier={tier}, score={sc_loc:.2f}")
     
-                            if sc_loc >= LOCAL_THRESH and bbox is not None:
+                            if ok:
                                 # 计算局部区域的中心点
-                                (x1, y1, x2, y2) = bbox
-                                center_x, center_y = int((x1 + x2) / 2), int((y1 + y2) / 2)
-                                cmds_with_coords = [
-                                    f"Mouse clicked at ({{center_x}}, {{center_y}}) with Button.left"
-                                ]
-                                done = execute_commands_once(cmds_with_coords)
+                                # 点击位置 = 定位到的局部区域中心 + 构建时记录的偏移
+                                center_x, center_y = screen_point(*local_click_point(info, fld2, bbox))
+                                button = next((a['button'] for a in step_actions(info) if a and a['op'] == 'click'), 'left')
+                                done = executor.run([{'op': 'click', 'x': center_x, 'y': center_y, 'button': button}])
                                 if done:
                                     matched = True
                                     break
@@ -373,19 +850,26 @@ def generate_nogpt_script(data: dict) -> str:
                             break  # 跳出 folder 匹配
     
                 else:
-                    if sc_ov >= OVERALL_THRESH:
+                    if sc_ov >= th_ov:
                         # 无坐标的情况，整体匹配成功后直接执行命令
-                        done = execute_commands_once(cmds)
+                        done = executor.run_once(step_actions(info))
                         if done:
                             matched = True
                             break
     
             if matched:
+                report_match_stats()
                 idx += 1  # 进入下一 Step
+                # 等界面对动作做出响应并稳定下来，再截图匹配下一个 step（代替固定等待）
+                settle_after(pyautogui, executor.last, data[step_ids[idx]] if idx < len(step_ids) else None)
             else:
-                print(f"   => not matched => wait {{CHECK_INTERVAL}}s.")
-                time.sleep(CHECK_INTERVAL)  # 等待下一次匹配
+                print(f"   => not matched => wait {CHECK_INTERVAL}s.")
+                with span('wait'):
+                    time.sleep(CHECK_INTERVAL)  # 等待下一次匹配
     
+        report_match_stats()
+        report_action_stats()
+        stop_tracing()
         print("[INFO] All steps done. Exit.")
 
 
@@ -398,22 +882,25 @@ def generate_nogpt_script(data: dict) -> str:
 
 
 ###########################
-def build_prompt_for_gpt1(data: dict)->str:
-    data_info=""
-    for sid, val in data.items():
-        data_info += f"Step {sid}: overall={len(val['overall_imgs'])}, local={len(val['local_imgs'])}, commands={len(val['commands'])}, conditions={len(val['conditions'])}\\n"
-
-    data_info= data_info[:2000]
-    prompt= f"""
-Generate "train-pyautogui-gpt1.py"
-No extra indentation or explanation
-When script runs in train-model => stepX.png in ../retry*
-If stepX has coords => match>=50 => local => do once => next
-Else => match>=OVERALL_THRESH => do once => next
-Data info (partial):
-{data_info}
-"""
-    return dedent(prompt).strip()
+def build_prompt_for_gpt1(data: dict, budget=PROMPT_BUDGET_SCRIPT)->str:
+    """
+    生成 gpt1 脚本的提示词：固定的说明 + 各 step 的紧凑摘要（动作、条件、合并后的坐标）。
+    整个提示词不超过 budget 个 token，摘要超出时按优先级丢弃细节行（见 prompt_compiler.py）。
+    """
+    instructions= dedent("""
+    Generate "train-pyautogui-gpt1.py"
+    No extra indentation or explanation
+    When script runs in train-model => stepX.png in ../retry*
+    If stepX has coords => match>=50 => local => do once => next
+    Else => match>=OVERALL_THRESH => do once => next
+    After each action do not use a fixed time.sleep; poll small screenshots of the clicked area every 0.05s until unchanged 3 times (max 3s)
+    Steps (S<id>: actions | when: conditions | match: references and thresholds):
+    """).strip()
+    data_info, report= compile_steps(data, budget - count_tokens(instructions) - 1)
+    prompt= instructions + "\n" + data_info
+    report.update(tokens=count_tokens(prompt), budget=budget)
+    print_prompt_report('gpt1 script', report)
+    return prompt
 
 ###########################
 def generate_gpt2_script_code(data: dict)->str:
@@ -447,24 +934,9 @@ def generate_gpt2_script_code(data: dict)->str:
 
     data = {data}
 
-    def orb_homography_score(img_query, img_train, ransac_thresh=5.0):
-        orb= cv2.ORB_create()
-        kp_q, des_q= orb.detectAndCompute(img_query, None)
-        kp_t, des_t= orb.detectAndCompute(img_train, None)
-        if des_q is None or des_t is None or len(des_q)<4 or len(des_t)<4:
-            return 0
-        bf= cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-        matches= bf.match(des_q, des_t)
-        if len(matches)<4:
-            return 0
-        matches= sorted(matches, key=lambda x: x.distance)
-        pts_q= np.float32([kp_q[m.queryIdx].pt for m in matches])
-        pts_t= np.float32([kp_t[m.trainIdx].pt for m in matches])
-        H, mask= cv2.findHomography(pts_q, pts_t, cv2.RANSAC, ransac_thresh)
-        if H is None:
-            return 0
-        return mask.ravel().sum()
-
+    """)
+    code += "\n\n" + load_runtime_source() + "\n\n"
+    code += dedent("""
     def compress_screenshot(img, max_width=400, max_height=300):
         h,w= img.shape[:2]
         scale_w= max_width/ w if w>max_width else 1.0
@@ -481,106 +953,104 @@ def generate_gpt2_script_code(data: dict)->str:
         # model="gpt-4-vision-preview"
         _, buf= cv2.imencode('.jpg', compressed_img, [cv2.IMWRITE_JPEG_QUALITY,70])
         b64= base64.b64encode(buf).decode('utf-8')
-        prompt= f\"\"\"You are GPT-4 Vision. step{{step_id}} conditions:\\n{{cond_str}}\\nBelow is a compressed screenshot base64:\\n{{b64}}\\nReply EXECUTE or NOEXECUTE.\"\"\"
+        prompt= f\"\"\"You are GPT-4 Vision. step{step_id} conditions:\\n{cond_str}\\nBelow is a compressed screenshot base64:\\n{b64}\\nReply EXECUTE or NOEXECUTE.\"\"\"
 
         try:
-            resp= client.chat.completions.create(
-                model="gpt-4-vision-preview",
-                messages=[
-                    {{"role":"system","content":"You are GPT-4 Vision."}},
-                    {{"role":"user","content":prompt}}
-                ]
-            )
+            with span('model', model="gpt-4-vision-preview"):
+                resp= client.chat.completions.create(
+                    model="gpt-4-vision-preview",
+                    messages=[
+                        {"role":"system","content":"You are GPT-4 Vision."},
+                        {"role":"user","content":prompt}
+                    ]
+                )
             ans= resp.choices[0].message.content.strip()
             if ans.upper().startswith("EXECUTE"):
                 return True
             return False
         except Exception as e:
-            print(f"[ERROR] GPT => {{e}} => fallback NOEXECUTE")
+            print(f"[ERROR] GPT => {e} => fallback NOEXECUTE")
             return False
 
-    def execute_commands_once(cmds):
-        executed=False
-        if not isinstance(cmds,list):
-            cmds=[cmds]
-        for c in cmds:
-            if executed:
-                break
-            print(f"[ACTION] => {{c}}")
-            xy= re.search(r'\\\\((\\\\d+),\\\\s*(\\\\d+)\\\\)', c)
-            if xy:
-                xx= int(xy.group(1))
-                yy= int(xy.group(2))
-                print(f"pyautogui.click({{xx}},{{yy}})")
-                pyautogui.click(xx, yy)
-                executed= True
-            elif "Key pressed:" in c:
-                parts= c.split(":")
-                if len(parts)>1:
-                    key_char= parts[-1].strip()
-                    print(f"pyautogui.press('{{key_char}}')")
-                    pyautogui.press(key_char)
-                    executed= True
-        return executed
-
     def main():
+        global data
+        data= load_workflow(data)
         step_ids= sorted(data.keys(), key=lambda x:int(x))
         idx=0
+        start_tracing()
+        detect_screen_scale(pyautogui, data)
+        executor= ActionExecutor(pyautogui, ACTION_PAUSE)
         while idx< len(step_ids):
             sid= step_ids[idx]
             info= data[sid]
             ov_list= info.get('overall_imgs',[])
             loc_list= info.get('local_imgs',[])
-            cmds   = info.get('commands',[])
             conds  = info.get('conditions',[])
             if not ov_list:
-                print(f"[WARN] step{{sid}} => no overall => skip.")
+                print(f"[WARN] step{sid} => no overall => skip.")
                 idx+=1
                 continue
 
-            print(f"[INFO] Checking step{{sid}}...")
-            sc= pyautogui.screenshot()
-            sc_cv= cv2.cvtColor(np.array(sc), cv2.COLOR_RGB2BGR)
-            sc_cv_small= compress_screenshot(sc_cv,400,300)
-
-            has_xy= any(re.search(r'\\\\((\\\\d+),\\\\s*(\\\\d+)\\\\)', c) for c in cmds)
+            print(f"[INFO] Checking step{sid}...")
+            trace_context(step=sid, ref=None)
+            with span('capture'):
+                sc= pyautogui.screenshot()
+            with span('convert'):
+                sc_cv= cv2.cvtColor(np.array(sc), cv2.COLOR_RGB2BGR)
+                sc_cv_small= compress_screenshot(sc_cv,400,300)
+                sc_gray_small= to_small_gray(sc_cv)
+            frame= FrameFeatures(sc_cv)
+
+            # 同时与后面 LOOKAHEAD_STEPS 个 step 打分，界面已经前进时直接跳过去
+            score_cache= {}
+            new_idx= evaluate_lookahead(data, step_ids, idx, frame, score_cache, LOOKAHEAD_STEPS,
+                                        RANSAC_THRESH, OVERALL_THRESH, HIGH_MATCH_THRESH)
+            if new_idx!=idx:
+                print(f"    => screen already at step{step_ids[new_idx]} => skip step{sid}")
+                idx= new_idx
+                sid= step_ids[idx]
+                info= data[sid]
+                loc_list= info.get('local_imgs',[])
+                conds  = info.get('conditions',[])
+                trace_context(step=sid)
+
+            has_xy= step_has_xy(info)
+            th_ov, th_loc, th_high= step_thresholds(info, OVERALL_THRESH, LOCAL_THRESH, HIGH_MATCH_THRESH)
             matched=False
+            # 本地 OCR 判断文字类条件：False => 不必问 GPT；True => 条件只涉及文字，直接执行；None => 仍交给 GPT
+            text_dec= check_text_conditions(conds, sc_cv, info.get('region'))
+            if text_dec is False:
+                print(f"    => text condition not met => wait {CHECK_INTERVAL}s.")
+                with span('wait'):
+                    time.sleep(CHECK_INTERVAL)
+                continue
 
-            for (folder, rel_path) in ov_list:
-                ovpath= os.path.join('..', rel_path)
-                if not os.path.exists(ovpath):
-                    print(f"[ERROR] cannot find {{ovpath}} => skip.")
-                    continue
-                ref_ov= cv2.imread(ovpath)
-                if ref_ov is None:
-                    print(f"[ERROR] cannot read {{ovpath}} => skip.")
-                    continue
-                sc_ov= orb_homography_score(ref_ov, sc_cv, RANSAC_THRESH)
-                print(f"    overall {{ovpath}} => inliers={{sc_ov}}")
+            for (folder, rel_path, sc_ov) in iter_step_scores(info, frame, score_cache, RANSAC_THRESH):
+                print(f"    overall {rel_path} => inliers={sc_ov}")
 
                 if has_xy:
-                    if sc_ov>=HIGH_MATCH_THRESH:
+                    if sc_ov>=th_high:
                         # local check
                         loc_ok=True
                         for (fld2, localp) in loc_list:
-                            localpath= os.path.join('..', localp)
-                            if not os.path.exists(localpath):
-                                loc_ok=False
-                                break
-                            ref_loc= cv2.imread(localpath)
+                            localpath= localp
+                            ref_loc= load_scaled(localpath)
                             if ref_loc is None:
                                 loc_ok=False
                                 break
-                            sc_loc= orb_homography_score(ref_loc, sc_cv, RANSAC_THRESH)
-                            print(f"    local => inliers={{sc_loc}}")
-                            if sc_loc<LOCAL_THRESH:
+                            trace_context(ref=localp)
+                            with span('match', kind='local') as sp:
+                                ok, _, _, tier, sc_loc= tracked_match(localp, ref_loc, sc_cv, RANSAC_THRESH, th_loc, sc_gray_small)
+                                sp.set(score=round(float(sc_loc), 3), tier=tier)
+                            print(f"    local => tier={tier}, score={sc_loc:.2f}")
+                            if not ok:
                                 loc_ok=False
                                 break
                         if loc_ok:
                             cond_str= "\\n".join(conds)[:500] if isinstance(conds,list) else "(no cond)"
-                            dec= call_gpt_vision(sid, sc_cv_small, cond_str)
+                            dec= text_dec if text_dec is not None else call_gpt_vision(sid, sc_cv_small, cond_str)
                             if dec:
-                                done= execute_commands_once(cmds)
+                                done= executor.run_once(step_actions(info))
                                 if done:
                                     matched=True
                                     idx+=1
@@ -589,22 +1059,28 @@ def generate_gpt2_script_code(data: dict)->str:
                                 print("[INFO] GPT => NOEXECUTE => not skip step => wait next screenshot.")
                     # else sc_ov<50 => do nothing, keep same step
                 else:
-                    # no coords => sc_ov>=OVERALL_THRESH => GPT => if EXECUTE => do => next
-                    if sc_ov>=OVERALL_THRESH:
+                    # no coords => sc_ov>=th_ov => GPT => if EXECUTE => do => next
+                    if sc_ov>=th_ov:
                         cond_str= "\\n".join(conds)[:500] if isinstance(conds,list) else "(no cond)"
-                        dec= call_gpt_vision(sid, sc_cv_small, cond_str)
+                        dec= text_dec if text_dec is not None else call_gpt_vision(sid, sc_cv_small, cond_str)
                         if dec:
-                            done= execute_commands_once(cmds)
+                            done= executor.run_once(step_actions(info))
                             if done:
                                 matched=True
                                 idx+=1
                                 break
                         else:
                             print("[INFO] GPT => NOEXECUTE => keep same step => wait next screenshot.")
-            if not matched:
-                print(f"    => not matched => wait {{CHECK_INTERVAL}}s.")
-                time.sleep(CHECK_INTERVAL)
+            if matched:
+                settle_after(pyautogui, executor.last, data[step_ids[idx]] if idx < len(step_ids) else None)
+            else:
+                print(f"    => not matched => wait {CHECK_INTERVAL}s.")
+                with span('wait'):
+                    time.sleep(CHECK_INTERVAL)
 
+        report_match_stats()
+        report_action_stats()
+        stop_tracing()
         print("[INFO] All steps done. Exit.")
 
     if __name__=='__main__':
@@ -614,22 +1090,47 @@ def generate_gpt2_script_code(data: dict)->str:
     return code.strip("\n")
 
 
-def main():
+def main(llm=None):
     print("[INFO] Building data from current directory's retry* folders...")
     data= build_data()
 
     out_dir= prepare_train_model_folder()
 
-    # 保存 local => train-model
+    # 命令 => 动作（运行时不再解析命令字符串）
+    for sid, info in data.items():
+        info['actions']= [rpa_runtime.compile_command(c) for c in info['commands']]
+        for c, a in zip(info['commands'], info['actions']):
+            if a is None:
+                print(f"[WARNING] step{sid} => cannot compile command: {c}")
+
+    # 每个 step 在点击位置周围选出区分度够的最小局部截图
+    select_local_crops(data)
+
+    # 每个 step 的 ORB 设置与参考图特征
+    step_feats= build_orb_features(data)
+
+    # 相近的参考图聚成原型，运行时只给原型打分
+    cluster_references(data, step_feats, out_dir)
+
+    # 按录制数据校准每个 step 的阈值（对保存的原型打分，与运行时一致；写入 data，随脚本一起生成）
+    print_calibration(calibrate_thresholds(data, step_feats, out_dir))
+
+    # 保存 local => train-model（重复的局部截图只保存一份）
     for sid, info in data.items():
+        alias= local_prototypes(info['local_imgs'])
         new_loc= []
         for (folder, roi_np) in info['local_imgs']:
-            out_name= f"step{sid}-local-{folder}.png"
-            out_path= os.path.join(out_dir, out_name)
-            cv2.imwrite(out_path, roi_np)
+            out_name= f"step{sid}-local-{alias[folder]}.png"
+            if alias[folder] == folder:
+                cv2.imwrite(os.path.join(out_dir, out_name), roi_np)
             new_loc.append((folder, out_name))
         info['local_imgs']= new_loc
 
+    # 单文件工作流：data + 特征 + 局部截图，带内容哈希
+    bundle_path= os.path.join(out_dir, rpa_runtime.BUNDLE_NAME)
+    digest= write_bundle(bundle_path, data, out_dir)
+    print(f"[INFO] Created: {bundle_path} ({os.path.getsize(bundle_path) / 1024:.0f} KB, sha256 {digest})")
+
     # 1) nogpt
     nogpt_code= generate_nogpt_script(data)
     nogpt_path= os.path.join(out_dir,"train-pyautogui-nogpt.py")
@@ -641,7 +1142,7 @@ def main():
     # 2) gpt1
     #    构建prompt => GPT => strip => remove extra
     prompt_gpt1= build_prompt_for_gpt1(data)
-    script_gpt1= call_gpt_for_script_gen(prompt_gpt1)
+    script_gpt1= call_gpt_for_script_gen(prompt_gpt1, llm)
     if not script_gpt1:
         script_gpt1= "#!/usr/bin/env python\nprint('No GPT1 content')"
 
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+frame_codec.py
+
+录制截图的编码格式。PIL 默认的 PNG（zlib 6 级压缩）写一张全屏截图要上百毫秒，
+录制时写盘线程跟不上连续的点击；可以换成更快的编码：
+- png:      PIL 默认 PNG（原来的格式）；
+- png-fast: PNG，zlib 1 级压缩，仍是无损 PNG，体积稍大、编码快很多；
+- webp:     无损 WebP（method 0，最快的一档）；Stage1 的截图上体积和速度都不如 png-fast，供其他界面对比；
+- raw-zlib: 原始像素 + zlib 1 级压缩，编码最快（自定义 .raw 文件，只有本模块能读）；
+- raw-lz4:  原始像素 + LZ4（需安装 lz4，未安装时不可用）。
+录制使用的格式记在会话目录库 (sessions.sqlite) 里；读取时按文件头判断格式，
+build_data / 回放 / 基准测试统一用 read_frame()，不需要知道录制时用的是哪种格式。
+生成的运行时脚本只读取构建时保存的特征 (stepX-features.npz) 和局部截图 PNG，不直接读取录制截图。
+
+用法：
+    path = save_frame(img, 'retry5/step1.png', 'webp')   # => 'retry5/step1.webp'
+    bgr = read_frame(path)                                # 与 cv2.imread 一样返回 BGR 数组
+    python codec-benchmark.py                             # 比较各格式的编码/解码耗时和体积
+"""
+import io
+import os
+import re
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2  # 有 OpenCV 时用它解码 PNG/WebP（比 PIL 快）
+except ImportError:
+    cv2 = None
+
+try:
+    import lz4.frame as lz4f  # 可选：更快的通用压缩
+except ImportError:
+    lz4f = None
+
+FRAME_CODEC = 'png'     # 录制默认格式（与原来的截图一致）
+RAW_MAGIC   = b'RAWF'   # .raw 文件头：魔数 + 压缩方式(4 字节) + 宽 + 高 + 通道数
+RAW_HEADER  = struct.Struct('<4s4sIIB')
+HEAD_BYTES  = 32        # 判断格式、读取分辨率需要的文件头长度
+FRAME_RE    = re.compile(r'^step(\d+)\.(png|webp|raw)$', flags=re.IGNORECASE)
+
+
+def _pil_bytes(img, fmt, **params):
+    buf = io.BytesIO()
+    img.save(buf, fmt, **params)
+    return buf.getvalue()
+
+def _raw_bytes(img, method, compress):
+    arr = np.asarray(img.convert('RGB') if img.mode not in ('RGB', 'L') else img)
+    h, w = arr.shape[:2]
+    c = 1 if arr.ndim == 2 else arr.shape[2]
+    return RAW_HEADER.pack(RAW_MAGIC, method, w, h, c) + compress(np.ascontiguousarray(arr).tobytes())
+
+
+# 格式名 => (扩展名, PIL.Image => bytes)
+CODECS = {
+    'png':      ('.png',  lambda img: _pil_bytes(img, 'PNG')),
+    'png-fast': ('.png',  lambda img: _pil_bytes(img, 'PNG', compress_level=1)),
+    'webp':     ('.webp', lambda img: _pil_bytes(img, 'WEBP', lossless=True, quality=50, method=0)),
+    'raw-zlib': ('.raw',  lambda img: _raw_bytes(img, b'zlib', lambda b: zlib.compress(b, 1))),
+}
+if lz4f is not None:
+    CODECS['raw-lz4'] = ('.raw', lambda img: _raw_bytes(img, b'lz4 ', lz4f.compress))
+
+
+def check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError(f"unknown frame codec {codec!r}, choose from {sorted(CODECS)}")
+    return codec
+
+def frame_path(path, codec=FRAME_CODEC):
+    """把路径的扩展名换成格式对应的扩展名：'retry5/step1.png' + 'webp' => 'retry5/step1.webp'"""
+    return os.path.splitext(path)[0] + CODECS[check_codec(codec)][0]
+
+def encode_frame(img, codec=FRAME_CODEC):
+    """PIL.Image => 编码后的 bytes"""
+    return CODECS[check_codec(codec)][1](img)
+
+def save_frame(img, path, codec=FRAME_CODEC):
+    """按格式保存截图，返回实际写入的路径（扩展名随格式变化）"""
+    path = frame_path(path, codec)
+    data = encode_frame(img, codec)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def decode_frame(data):
+    """bytes => BGR 数组（灰度图为二维数组）；按文件头判断格式，无法解码时返回 None"""
+    if data[:4] == RAW_MAGIC:
+        _, method, w, h, c = RAW_HEADER.unpack_from(data)
+        payload = data[RAW_HEADER.size:]
+        if method == b'zlib':
+            raw = zlib.decompress(payload)
+        elif method == b'lz4 ' and lz4f is not None:
+            raw = lz4f.decompress(payload)
+        else:
+            print(f"[ERROR] Cannot decode raw frame compressed with {method!r}")
+            return None
+        arr = np.frombuffer(raw, np.uint8).reshape((h, w, c) if c > 1 else (h, w))
+        return arr[:, :, 2::-1].copy() if c >= 3 else arr.copy()
+    if cv2 is not None:
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    try:
+        return np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))[:, :, ::-1].copy()
+    except OSError:
+        return None
+
+def read_frame(path):
+    """读取任意格式的录制截图 => BGR 数组（与 cv2.imread 一致）；文件缺失或无法解码时返回 None"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    return decode_frame(data)
+
+
+def frame_size(path):
+    """只读文件头取截图分辨率 (宽, 高)，不解码像素；无法识别时返回 (None, None)"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEAD_BYTES)
+    except OSError:
+        return None, None
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) >= 24:
+        return tuple(struct.unpack('>II', head[16:24]))
+    if head[:4] == RAW_MAGIC and len(head) >= RAW_HEADER.size:
+        return RAW_HEADER.unpack_from(head)[2:4]
+    try:
+        with Image.open(path) as img:  # WebP 等：PIL 打开时只解析文件头
+            return img.size
+    except OSError:
+        return None, None
+
+def frame_codec_of(path):
+    """按文件头判断已保存截图的格式（PNG 无法区分压缩级别，统一记为 'png'）"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEAD_BYTES)
+    except OSError:
+        return None
+    if head[:4] == RAW_MAGIC:
+        return 'raw-zlib' if head[4:8] == b'zlib' else 'raw-lz4'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    return None
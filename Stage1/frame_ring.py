@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+frame_ring.py
+
+录制时的截图环形缓冲：后台线程以较低帧率持续截屏，只在内存里保留最近的若干帧（按内存预算限制帧数）。
+鼠标/键盘回调里不再截图，只记下事件时间，交给写盘线程保存"事件发生之前最近的一帧"：
+- 回调线程没有截图和写 PNG 的开销；
+- 保存的画面是点击之前的界面，不会因为界面已经响应了点击而截到变化后的画面。
+截图按 codec 编码保存（见 frame_codec.py），实际文件的扩展名随格式变化。
+
+用法：
+    ring = FrameRing(fps=4, budget_mb=128, codec='png-fast')
+    ring.start()
+    ring.save_before(time.time(), 'retry5/step1.png')   # 在鼠标/键盘回调里调用，立即返回；按 codec 换扩展名
+    ring.stop()                                          # 等待所有截图写完
+"""
+import queue
+import threading
+import time
+from collections import deque
+
+from frame_codec import FRAME_CODEC, check_codec, save_frame
+
+RING_FPS       = 4      # 每秒截图次数
+RING_BUDGET_MB = 128    # 环形缓冲最多占用的内存（MB）
+
+
+class FrameRing:
+    def __init__(self, fps=RING_FPS, budget_mb=RING_BUDGET_MB, grab=None, codec=FRAME_CODEC):
+        if grab is None:
+            import pyautogui
+            grab = pyautogui.screenshot
+        self.grab = grab
+        self.codec = check_codec(codec)
+        self.interval = 1.0 / max(0.1, fps)
+        self.budget = budget_mb * 1024 * 1024
+        self.frames = deque(maxlen=2)   # (时间, PIL.Image)；第一帧之后按内存预算调整长度
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.running = False
+        self.capture_thread = None
+        self.writer_thread = None
+
+    def start(self):
+        self.running = True
+        self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.capture_thread.start()
+        self.writer_thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """停止截图；wait=True 时等待已提交的截图全部写完（在回调线程里停止时传 False）"""
+        self.running = False
+        self.jobs.put(None)
+        if wait:
+            self.writer_thread.join()
+            self.capture_thread.join(timeout=2 * self.interval + 1)
+
+    def _capture_loop(self):
+        while self.running:
+            t0 = time.time()
+            try:
+                img = self.grab()
+            except Exception as e:
+                print(f"[ERROR] Frame capture failed: {e}")
+                img = None
+            if img is not None:
+                with self.lock:
+                    if len(self.frames) == 0:
+                        self._resize(img)
+                    self.frames.append((t0, img))
+            time.sleep(max(0.0, self.interval - (time.time() - t0)))
+
+    def _resize(self, img):
+        """按第一帧的大小计算内存预算内能保留多少帧"""
+        w, h = img.size
+        frame_bytes = w * h * len(img.getbands())
+        n = max(2, int(self.budget // max(1, frame_bytes)))
+        self.frames = deque(self.frames, maxlen=n)
+        print(f"[DEBUG] Frame ring: {w}x{h}, keep {n} frames (~{n * frame_bytes / 1e6:.0f} MB)")
+
+    def before(self, t):
+        """时间 t 之前最近的一帧 (时间, 图像)；没有时返回 None"""
+        with self.lock:
+            for (ft, img) in reversed(self.frames):
+                if ft <= t:
+                    return ft, img
+        return None
+
+    def save_before(self, t, path, on_saved=None):
+        """
+        提交保存任务：立即取出 t 之前最近的一帧交给写盘线程。任务持有这一帧，
+        写盘排队期间这一帧被环形缓冲淘汰也不会丢失。
+        缓冲里没有 t 之前的帧时，写盘线程现场截一张。这是事件之后的画面，会打印警告，帧时间晚于 t。
+        on_saved(实际路径, (宽, 高), 帧时间) 在写盘线程里调用；帧时间 > t 即为事件之后的截图。
+        """
+        self.jobs.put((t, path, on_saved, self.before(t)))
+
+    def _writer_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            t, path, on_saved, hit = job
+            try:
+                if hit is None:
+                    print(f"[WARNING] No buffered frame before the event for {path} => saving a post-event screenshot")
+                    hit = (time.time(), self.grab())
+                ft, img = hit
+                t_enc = time.time()
+                path = save_frame(img, path, self.codec)
+                when = f"{1000 * (t - ft):.0f} ms before" if ft <= t else f"{1000 * (ft - t):.0f} ms after"
+                print(f"[DEBUG] Screenshot saved: {path} (frame {when} event, "
+                      f"{self.codec} {1000 * (time.time() - t_enc):.0f} ms)")
+                if on_saved is not None:
+                    on_saved(path, img.size, ft)
+            except Exception as e:
+                print(f"[ERROR] Failed to save screenshot: {e}")
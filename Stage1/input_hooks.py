@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+input_hooks.py
+
+录制用的常驻输入钩子：程序启动时创建一次 pynput 鼠标/键盘监听器，一直运行到程序退出。
+原来每录一个 step (start_motion_recording) 和每次 Retry Record 都新建、再停止一对监听器，
+每次启动都有延迟，刚启动时的第一个事件有时还会丢；现在各录制模式只是订阅 / 取消订阅：
+- 钩子线程里只给事件打时间戳，追加到每个订阅者自己的队列（collections.deque 的 append / popleft 是原子操作，不加锁）；
+- Tk 主线程用 root.after 每 INPUT_POLL_MS 毫秒取出各队列里的事件，交给订阅者的处理函数，界面只在主线程更新；
+- 需要立刻响应的轻量操作（如通知后台预处理让出）可以传 on_event，在钩子线程里直接调用，不能操作 Tk。
+
+用法：
+    hooks = InputHooks().start(root)                       # main() 里创建一次
+    sub = hooks.subscribe(handle_events)                   # handle_events([InputEvent, ...]) 在主线程调用
+    sub.close()                                            # 取消订阅，之后不再收到事件
+"""
+import time
+from collections import deque, namedtuple
+
+from pynput import keyboard, mouse
+
+INPUT_POLL_MS = 15   # 主线程取事件的间隔（毫秒）
+
+# kind: 'click'（鼠标按下/松开，见 pressed）、'press'（按键按下）、'release'（按键松开）
+InputEvent = namedtuple('InputEvent', 't kind x y button pressed key')
+
+
+class Subscription:
+    def __init__(self, hooks, handler, on_event=None):
+        self.hooks = hooks
+        self.handler = handler
+        self.on_event = on_event
+        self.events = deque()
+        self.active = True
+
+    def drain(self):
+        out = []
+        while True:
+            try:
+                out.append(self.events.popleft())
+            except IndexError:
+                return out
+
+    def close(self):
+        """取消订阅（在主线程或处理函数里调用都可以），队列里还没处理的事件丢弃"""
+        self.active = False
+        self.hooks._remove(self)
+        self.events.clear()
+
+
+class InputHooks:
+    def __init__(self, poll_ms=INPUT_POLL_MS):
+        self.poll_ms = poll_ms
+        self.subs = ()        # 订阅者；变化时整体替换，钩子线程遍历时不需要加锁
+        self.root = None
+        self.mouse_listener = None
+        self.keyboard_listener = None
+
+    def start(self, root):
+        self.root = root
+        self.mouse_listener = mouse.Listener(on_click=self._on_click)
+        self.keyboard_listener = keyboard.Listener(on_press=self._on_press, on_release=self._on_release)
+        self.mouse_listener.start()
+        self.keyboard_listener.start()
+        root.after(self.poll_ms, self._pump)
+        print("[DEBUG] Input hooks started.")
+        return self
+
+    def stop(self):
+        for listener in (self.mouse_listener, self.keyboard_listener):
+            if listener is not None:
+                listener.stop()
+
+    def subscribe(self, handler, on_event=None):
+        sub = Subscription(self, handler, on_event)
+        self.subs = self.subs + (sub,)
+        return sub
+
+    def _remove(self, sub):
+        self.subs = tuple(s for s in self.subs if s is not sub)
+
+    # ---- 钩子线程 ----
+    def _emit(self, ev):
+        for sub in self.subs:
+            sub.events.append(ev)
+            if sub.on_event is not None:
+                sub.on_event(ev)
+
+    def _on_click(self, x, y, button, pressed):
+        self._emit(InputEvent(time.time(), 'click', x, y, button, pressed, None))
+
+    def _on_press(self, key):
+        self._emit(InputEvent(time.time(), 'press', None, None, None, True, key))
+
+    def _on_release(self, key):
+        self._emit(InputEvent(time.time(), 'release', None, None, None, False, key))
+
+    # ---- 主线程 ----
+    def _pump(self):
+        for sub in self.subs:
+            if sub.events:
+                events = sub.drain()
+                try:
+                    sub.handler(events)
+                except Exception as e:
+                    print(f"[ERROR] Input handler failed: {e}")
+        self.root.after(self.poll_ms, self._pump)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+llm-hedge-benchmark.py
+
+用本地假提供方 (llm_router.MockProvider) 测对冲请求对尾延迟的效果，不需要网络和密钥：
+同样的延迟分布下，分别不对冲、对冲各调用 --calls 次，比较端到端耗时的 p50/p90/p99、
+额外发出的请求比例，以及由备用提供方返回的比例。
+前 HEDGE_MIN_SAMPLES 次调用只积累首选提供方的历史耗时（之后才有 p90 可用），不计入结果。
+
+延迟分布的写法见 llm_router.parse_latency；@ 后是失败率。
+
+用法：
+    python llm-hedge-benchmark.py
+    python llm-hedge-benchmark.py --primary tail:0.05:0.3:0.1:8 --backup lognorm:0.06:0.3 --calls 300
+    python llm-hedge-benchmark.py --primary lognorm:0.05:0.5@0.05 --kind stt --json hedge-report.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import llm_router  # noqa: E402
+
+
+def run(args, hedge):
+    providers = llm_router.mock_providers(f"openai={args.primary},anthropic={args.backup},google={args.backup}")
+    router = llm_router.LLMRouter(providers, llm_router.LatencyStats(None), hedge=hedge,
+                                  hedge_quantile=args.quantile, verbose=False)
+    messages = [{'role': 'user', 'content': 'benchmark'}]
+    call = (lambda: router.chat(messages, 'openai')) if args.kind == 'chat' else \
+           (lambda: router.transcribe('benchmark.wav', 'openai'))
+
+    lat, hedged, backup, failed = [], 0, 0, 0
+    for i in range(llm_router.HEDGE_MIN_SAMPLES + args.calls):
+        t0 = time.time()
+        try:
+            call()
+        except RuntimeError:
+            failed += 1
+            continue
+        if i < llm_router.HEDGE_MIN_SAMPLES:
+            continue
+        lat.append(time.time() - t0)
+        hedged += router.last['hedged']
+        backup += router.last['winner'] != 'openai'
+    n = max(1, len(lat))
+    return {
+        'hedge': hedge,
+        'calls': len(lat),
+        'p50_ms': 1000 * float(np.percentile(lat, 50)) if lat else None,
+        'p90_ms': 1000 * float(np.percentile(lat, 90)) if lat else None,
+        'p99_ms': 1000 * float(np.percentile(lat, 99)) if lat else None,
+        'extra_requests': hedged / n,
+        'backup_wins': backup / n,
+        'failed': failed,
+        'requests': {name: p.calls for name, p in providers.items()},
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Measure hedged LLM requests against mock providers.")
+    ap.add_argument('--primary', default='tail:0.05:0.3:0.1:8', help="latency distribution of the chosen provider")
+    ap.add_argument('--backup', default='lognorm:0.06:0.3', help="latency distribution of the hedge provider")
+    ap.add_argument('--kind', default='chat', choices=['chat', 'stt'])
+    ap.add_argument('--calls', type=int, default=200)
+    ap.add_argument('--quantile', type=float, default=llm_router.HEDGE_QUANTILE, help="hedge after this quantile")
+    ap.add_argument('--json', default=None, help="also write the results to this json file")
+    args = ap.parse_args()
+
+    print(f"[INFO] primary={args.primary} backup={args.backup} kind={args.kind} calls={args.calls}")
+    rows = [run(args, hedge) for hedge in (False, True)]
+    print(f"{'mode':<9} {'p50':>9} {'p90':>9} {'p99':>9} {'extra req':>10} {'backup won':>11} {'failed':>7}")
+    for r in rows:
+        if not r['calls']:
+            print(f"{'hedge' if r['hedge'] else 'single':<9} all calls failed")
+            continue
+        print(f"{'hedge' if r['hedge'] else 'single':<9} {r['p50_ms']:>7.0f}ms {r['p90_ms']:>7.0f}ms "
+              f"{r['p99_ms']:>7.0f}ms {100 * r['extra_requests']:>9.0f}% {100 * r['backup_wins']:>10.0f}% "
+              f"{r['failed']:>7}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': rows}, f, indent=2)
+        print(f"[INFO] Report saved: {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+llm_router.py
+
+大模型 / 语音转文字调用的路由层：界面上 LLM_model_combobox、STT_model_combobox 选的是哪家，就调用哪家，
+不再全部写死为 OpenAI 客户端。
+- 每次调用按 "类型:提供方"（如 'chat:openai'、'stt:google'）记录耗时，保存到 LLM_LATENCY_FILE，重启后仍可用；
+- 对冲（hedge）：首选提供方的耗时超过它自己历史的 p90 还没返回时，再向下一家已配置的提供方发一个请求，
+  取先返回的结果（落后的请求无法中途取消，让它跑完，耗时照样记录）；
+- 首选失败时按顺序换下一家（failover）；全部失败时抛出最后一个异常；
+- MockProvider 按给定的延迟分布 sleep 后返回，不需要网络和密钥；设置环境变量 RPA_LLM_MOCK 即可让界面和构建用假提供方，
+  对冲效果可用 llm-hedge-benchmark.py 测。
+
+各家的密钥从环境变量读取（OPENAI_API_KEY、ANTHROPIC_API_KEY、GEMINI_API_KEY、GOOGLE_STT_API_KEY、
+AZURE_SPEECH_KEY / AZURE_SPEECH_REGION）；没有配置密钥的提供方不参与对冲和 failover。
+
+依赖：真实提供方用 requests 发 HTTP 请求（pip install requests），第一次真正发请求时才导入；
+只用 MockProvider（RPA_LLM_MOCK、llm-hedge-benchmark.py）时不需要安装。
+
+用法：
+    router = get_router()
+    provider, model = resolve_llm(LLM_model_var.get())
+    text = router.chat([{"role": "user", "content": "..."}], provider, model)
+    text = router.transcribe('recorded_step1.wav', resolve_stt(STT_model_var.get()))
+    RPA_LLM_MOCK="openai=lognorm:1.0:0.6,anthropic=const:0.8" python main_function_full.py
+"""
+import base64
+import json
+import os
+import random
+import threading
+import time
+import wave
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+LLM_LATENCY_FILE   = 'llm-latency.json'   # 各提供方的历史耗时；None => 只在内存里统计
+LATENCY_WINDOW     = 200    # 每个 "类型:提供方" 保留最近多少次成功调用的耗时
+HEDGE_QUANTILE     = 0.9    # 首选提供方超过这个分位数的耗时还没返回 => 对冲
+HEDGE_MIN_SAMPLES  = 5      # 历史不够时不对冲（分位数不可靠）
+LLM_HEDGE          = True
+LLM_TIMEOUT_SEC    = 120    # 单个 HTTP 请求的超时
+STT_LANGUAGE       = os.environ.get('RPA_STT_LANGUAGE', 'en-US')
+
+# MockProvider 的延迟分布 => 写法（参数个数按冒号数检查）
+LATENCY_ARGS = {
+    'const':   'const:S',
+    'uniform': 'uniform:A:B',
+    'lognorm': 'lognorm:MEDIAN:SIGMA',
+    'tail':    'tail:MEDIAN:SIGMA:SLOW_RATE:SLOW_FACTOR',
+}
+
+# 对冲 / failover 时依次尝试的提供方
+LLM_FALLBACK_ORDER = ['openai', 'anthropic', 'gemini']
+STT_FALLBACK_ORDER = ['openai', 'google', 'azure']
+
+# 界面下拉框的选项 => (提供方, 模型)；没有选择时仍用原来的 OpenAI gpt-4
+LLM_CHOICES = {
+    'Gpt 4o':     ('openai', 'gpt-4o'),
+    'Claude 3.5': ('anthropic', 'claude-3-5-sonnet-latest'),
+    'Gemini2.0':  ('gemini', 'gemini-2.0-flash'),
+}
+STT_CHOICES = {
+    'OpenAI Whisper':              'openai',
+    'Google Cloud Speech-to-Text': 'google',
+    'Microsoft Azure Speech':      'azure',
+}
+
+
+def resolve_llm(choice):
+    return LLM_CHOICES.get(choice, ('openai', None))
+
+
+def resolve_stt(choice):
+    return STT_CHOICES.get(choice, 'openai')
+
+
+def _has_key(key):
+    return bool(key) and not key.startswith('YOUR_')
+
+
+def _post_json(url, payload=None, headers=None, data=None, params=None):
+    import requests
+    r = requests.post(url, json=payload, data=data, headers=headers, params=params, timeout=LLM_TIMEOUT_SEC)
+    r.raise_for_status()
+    return r.json()
+
+
+def _split_system(messages):
+    system = "\n".join(m['content'] for m in messages if m['role'] == 'system')
+    return system, [m for m in messages if m['role'] != 'system']
+
+
+#######################
+# 提供方
+#######################
+class OpenAIProvider:
+    kinds = ('chat', 'stt')
+
+    def __init__(self, name='openai', key=None, model='gpt-4'):
+        from openai import OpenAI
+        self.name = name
+        self.key = key or os.environ.get('OPENAI_API_KEY', 'YOUR_OPENAI_KEY')
+        self.model = model
+        self.available = _has_key(self.key)
+        self.client = OpenAI(api_key=self.key, timeout=LLM_TIMEOUT_SEC)
+
+    def chat(self, messages, model=None):
+        resp = self.client.chat.completions.create(model=model or self.model, messages=messages)
+        return resp.choices[0].message.content.strip()
+
+    def transcribe(self, path):
+        with open(path, 'rb') as audio_file:
+            response = self.client.audio.transcriptions.create(model='whisper-1', file=audio_file)
+        return response.text if hasattr(response, 'text') else response['text']
+
+
+class AnthropicProvider:
+    kinds = ('chat',)
+
+    def __init__(self, name='anthropic', key=None, model='claude-3-5-sonnet-latest', max_tokens=4096):
+        self.name = name
+        self.key = key or os.environ.get('ANTHROPIC_API_KEY', '')
+        self.model = model
+        self.max_tokens = max_tokens
+        self.available = _has_key(self.key)
+
+    def chat(self, messages, model=None):
+        system, rest = _split_system(messages)
+        payload = {'model': model or self.model, 'max_tokens': self.max_tokens, 'messages': rest}
+        if system:
+            payload['system'] = system
+        out = _post_json('https://api.anthropic.com/v1/messages', payload,
+                         headers={'x-api-key': self.key, 'anthropic-version': '2023-06-01'})
+        return "".join(b.get('text', '') for b in out['content']).strip()
+
+
+class GeminiProvider:
+    kinds = ('chat',)
+
+    def __init__(self, name='gemini', key=None, model='gemini-2.0-flash'):
+        self.name = name
+        self.key = key or os.environ.get('GEMINI_API_KEY', '')
+        self.model = model
+        self.available = _has_key(self.key)
+
+    def chat(self, messages, model=None):
+        system, rest = _split_system(messages)
+        payload = {'contents': [{'role': 'model' if m['role'] == 'assistant' else 'user',
+                                 'parts': [{'text': m['content']}]} for m in rest]}
+        if system:
+            payload['systemInstruction'] = {'parts': [{'text': system}]}
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model or self.model}:generateContent"
+        out = _post_json(url, payload, params={'key': self.key})
+        return "".join(p.get('text', '') for p in out['candidates'][0]['content']['parts']).strip()
+
+
+class GoogleSTTProvider:
+    kinds = ('stt',)
+
+    def __init__(self, name='google', key=None, language=STT_LANGUAGE):
+        self.name = name
+        self.key = key or os.environ.get('GOOGLE_STT_API_KEY', '')
+        self.language = language
+        self.available = _has_key(self.key)
+
+    def transcribe(self, path):
+        with wave.open(path, 'rb') as wf:
+            rate = wf.getframerate()
+            pcm = wf.readframes(wf.getnframes())
+        payload = {'config': {'encoding': 'LINEAR16', 'sampleRateHertz': rate, 'languageCode': self.language},
+                   'audio': {'content': base64.b64encode(pcm).decode('ascii')}}
+        out = _post_json('https://speech.googleapis.com/v1/speech:recognize', payload, params={'key': self.key})
+        return " ".join(r['alternatives'][0]['transcript'] for r in out.get('results', []) if r.get('alternatives'))
+
+
+class AzureSTTProvider:
+    kinds = ('stt',)
+
+    def __init__(self, name='azure', key=None, region=None, language=STT_LANGUAGE):
+        self.name = name
+        self.key = key or os.environ.get('AZURE_SPEECH_KEY', '')
+        self.region = region or os.environ.get('AZURE_SPEECH_REGION', 'eastus')
+        self.language = language
+        self.available = _has_key(self.key)
+
+    def transcribe(self, path):
+        with wave.open(path, 'rb') as wf:
+            rate = wf.getframerate()
+        with open(path, 'rb') as f:
+            body = f.read()
+        url = (f"https://{self.region}.stt.speech.microsoft.com/speech/recognition/"
+               f"conversation/cognitiveservices/v1")
+        out = _post_json(url, data=body, params={'language': self.language},
+                         headers={'Ocp-Apim-Subscription-Key': self.key,
+                                  'Content-Type': f'audio/wav; codecs=audio/pcm; samplerate={rate}'})
+        return out.get('DisplayText', '')
+
+
+def parse_latency(spec):
+    """
+    延迟分布 => 返回秒数的函数：
+    'const:S'、'uniform:A:B'、'lognorm:中位数:sigma'、'tail:中位数:sigma:慢请求比例:慢倍数'（偶尔整体变慢）
+    写法不对（未知分布、参数个数不对、不是非负数）时抛出 ValueError。
+    """
+    kind, *args = spec.strip().split(':')
+    if kind not in LATENCY_ARGS:
+        raise ValueError(f"Unknown latency distribution {spec!r}; use one of: {', '.join(LATENCY_ARGS.values())}")
+    if len(args) != LATENCY_ARGS[kind].count(':'):
+        raise ValueError(f"Latency distribution {spec!r} needs the form {LATENCY_ARGS[kind]}")
+    try:
+        a = [float(x) for x in args]
+    except ValueError:
+        raise ValueError(f"Latency distribution {spec!r} has a non-numeric value; use {LATENCY_ARGS[kind]}") from None
+    if any(x < 0 for x in a):
+        raise ValueError(f"Latency distribution {spec!r} has a negative value")
+    if kind == 'const':
+        return lambda: a[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(a[0], a[1])
+    if kind == 'lognorm':
+        return lambda: a[0] * random.lognormvariate(0.0, a[1])
+    return lambda: a[0] * random.lognormvariate(0.0, a[1]) * (a[3] if random.random() < a[2] else 1.0)
+
+
+class MockProvider:
+    """本地假提供方：按延迟分布 sleep，按 fail_rate 随机失败；不访问网络"""
+    kinds = ('chat', 'stt')
+
+    def __init__(self, name, latency='const:0.1', fail_rate=0.0, reply=None):
+        self.name = name
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.fail_rate = fail_rate
+        self.reply = reply
+        self.available = True
+        self.calls = 0
+
+    def _respond(self, what):
+        self.calls += 1
+        time.sleep(max(0.0, self.latency()))
+        if random.random() < self.fail_rate:
+            raise RuntimeError(f"{self.name} mock failure")
+        return self.reply if self.reply is not None else f"# {self.name} mock reply ({what})"
+
+    def chat(self, messages, model=None):
+        return self._respond(f"{sum(len(m['content']) for m in messages)} prompt chars")
+
+    def transcribe(self, path):
+        return self._respond(os.path.basename(path))
+
+
+#######################
+# 耗时统计
+#######################
+class LatencyStats:
+    def __init__(self, path=LLM_LATENCY_FILE, window=LATENCY_WINDOW):
+        self.path = path
+        self.window = window
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                self.samples = {k: deque(v, maxlen=window) for k, v in saved.get('samples', {}).items()}
+                self.errors = saved.get('errors', {})
+            except Exception as e:
+                print(f"[WARNING] Failed to load {path}: {e}")
+
+    def record(self, key, sec, ok):
+        with self.lock:
+            if ok:
+                self.samples.setdefault(key, deque(maxlen=self.window)).append(round(sec, 4))
+            else:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if self.path:
+                snapshot = {'samples': {k: list(v) for k, v in self.samples.items()}, 'errors': dict(self.errors)}
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp, self.path)
+
+    def quantile(self, key, q):
+        """最近耗时的分位数；样本不足 HEDGE_MIN_SAMPLES 时返回 None"""
+        with self.lock:
+            xs = sorted(self.samples.get(key, ()))
+        if len(xs) < HEDGE_MIN_SAMPLES:
+            return None
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+    def summary(self):
+        keys = sorted(set(self.samples) | set(self.errors))
+        return {k: {'n': len(self.samples.get(k, ())), 'errors': self.errors.get(k, 0),
+                    'p50': self.quantile(k, 0.5), 'p90': self.quantile(k, 0.9)} for k in keys}
+
+
+#######################
+# 路由
+#######################
+class LLMRouter:
+    def __init__(self, providers, stats=None, hedge=LLM_HEDGE, hedge_quantile=HEDGE_QUANTILE,
+                 llm_order=LLM_FALLBACK_ORDER, stt_order=STT_FALLBACK_ORDER, verbose=True):
+        self.providers = providers
+        self.verbose = verbose
+        self.stats = stats if stats is not None else LatencyStats()
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.orders = {'chat': llm_order, 'stt': stt_order}
+        self.pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='llm')
+        self.last = {}   # 最近一次调用：{'winner', 'latency', 'hedged', 'attempts'}
+
+    def chat(self, messages, provider='openai', model=None):
+        """返回回复文本；model 只用于首选提供方，对冲 / failover 的提供方用各自默认模型"""
+        return self._route('chat', provider, lambda p: p.chat(messages, model if p.name == provider else None))
+
+    def transcribe(self, path, provider='openai'):
+        return self._route('stt', provider, lambda p: p.transcribe(path))
+
+    def _candidates(self, kind, primary):
+        if primary not in self.providers:
+            raise ValueError(f"Unknown {kind} provider: {primary}")
+        rest = [n for n in self.orders[kind] if n != primary and n in self.providers
+                and self.providers[n].available and kind in self.providers[n].kinds]
+        return [primary] + rest
+
+    def _route(self, kind, primary, call):
+        order = self._candidates(kind, primary)
+        t0 = time.time()
+        pending = {}
+
+        def run(name):
+            p = self.providers[name]
+            ts = time.time()
+            try:
+                out = call(p)
+            except Exception:
+                self.stats.record(f"{kind}:{name}", time.time() - ts, False)
+                raise
+            self.stats.record(f"{kind}:{name}", time.time() - ts, True)
+            return out
+
+        def submit(i):
+            pending[self.pool.submit(run, order[i])] = order[i]
+
+        submit(0)
+        next_i, hedged, last_err = 1, False, None
+        delay = self.stats.quantile(f"{kind}:{primary}", self.hedge_quantile) if self.hedge else None
+        while pending:
+            timeout = None
+            if delay is not None and not hedged and next_i < len(order):
+                timeout = max(0.0, t0 + delay - time.time())
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 首选超过 p90 还没返回 => 再发一个请求给下一家
+                if self.verbose:
+                    print(f"[INFO] {kind}:{primary} slower than p{int(100 * self.hedge_quantile)} "
+                          f"({delay:.2f}s), hedging with {order[next_i]}")
+                submit(next_i)
+                next_i, hedged = next_i + 1, True
+                continue
+            for f in done:
+                name = pending.pop(f)
+                try:
+                    out = f.result()
+                except Exception as e:
+                    last_err = e
+                    if self.verbose:
+                        print(f"[WARNING] {kind}:{name} failed: {e}")
+                    continue
+                latency = time.time() - t0
+                self.last = {'winner': name, 'latency': latency, 'hedged': hedged, 'attempts': next_i}
+                if self.verbose:
+                    print(f"[INFO] {kind} answered by {name} in {latency:.2f}s"
+                          f"{' (hedged)' if hedged else ''}")
+                return out
+            if not pending and next_i < len(order):
+                submit(next_i)   # 全部失败 => 换下一家
+                next_i += 1
+        raise RuntimeError(f"All {kind} providers failed ({', '.join(order)}): {last_err}") from last_err
+
+
+def mock_providers(spec):
+    """
+    'openai=lognorm:1.0:0.6,anthropic=const:0.8@0.1' => {名称: MockProvider}；@ 后是失败率（0 到 1）。
+    写法不对时抛出 ValueError，说明是哪一项、应该怎么写。
+    """
+    out = {}
+    for item in filter(None, (s.strip() for s in spec.split(','))):
+        name, sep, dist = item.partition('=')
+        name = name.strip()
+        if not sep or not name or not dist.strip():
+            raise ValueError(f"Mock provider item {item!r} should look like 'openai=lognorm:1.0:0.6' or "
+                             f"'openai=const:0.8@0.1'")
+        dist, _, fail = dist.partition('@')
+        try:
+            fail = float(fail or 0.0)
+        except ValueError:
+            raise ValueError(f"Mock provider item {item!r}: failure rate after '@' must be a number") from None
+        if not 0.0 <= fail <= 1.0:
+            raise ValueError(f"Mock provider item {item!r}: failure rate after '@' must be between 0 and 1")
+        try:
+            out[name] = MockProvider(name, dist, fail)
+        except ValueError as e:
+            raise ValueError(f"Mock provider item {item!r}: {e}") from None
+    return out
+
+
+def make_router(stats_path=LLM_LATENCY_FILE, hedge=LLM_HEDGE, openai_key=None):
+    """按环境变量创建各家提供方；RPA_LLM_MOCK 里列出的提供方换成 MockProvider"""
+    try:
+        mocks = mock_providers(os.environ.get('RPA_LLM_MOCK', ''))
+    except ValueError as e:
+        raise ValueError(f"Invalid RPA_LLM_MOCK: {e}") from None  # 创建路由时就报错，而不是调用时才失败
+    real = {
+        'openai':    lambda: OpenAIProvider(key=openai_key),
+        'anthropic': AnthropicProvider,
+        'gemini':    GeminiProvider,
+        'google':    GoogleSTTProvider,
+        'azure':     AzureSTTProvider,
+    }
+    providers = {name: mocks[name] if name in mocks else make() for name, make in real.items()}
+    if mocks:
+        print(f"[INFO] Using mock LLM providers: {', '.join(sorted(mocks))}")
+    return LLMRouter(providers, LatencyStats(stats_path), hedge=hedge)
+
+
+_ROUTER = None
+
+
+def get_router(**kwargs):
+    """进程内共用一个路由（界面和在同一进程里运行的构建共用耗时统计）；第一次调用时按 kwargs 创建"""
+    global _ROUTER
+    if _ROUTER is None:
+        _ROUTER = make_router(**kwargs)
+    return _ROUTER
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+prompt_compiler.py
+
+把发给大模型的内容编译成紧凑的提示词，并限制在明确的 token 预算内：
+- compile_steps(data, budget)：build_data 的结果 => 每个 step 一行紧凑摘要（step 编号、动作、条件），
+  各次录制里相近的点击坐标合并成一个（附次数），阈值/区域等细节和少见的坐标放在低优先级行；
+- compile_text(text, budget)：界面里整理好的命令文本 => 去掉多余空白和紧接着重复的说明行（命令行不去重），
+  过长的行截断，命令类的行优先保留；
+- 超出预算时按优先级从低到高整行丢弃（同一优先级先丢后面的），最后注明省略了多少行，不会在行中间截断。
+原来 build_prompt_for_gpt1 只给各 step 的数量统计且截取前 2000 个字符，standardize_and_generate_commands 则整段不限长度发送；
+现在两处都只发预算内最重要的信息，每次调用打印提示词的 token 数。
+
+token 数用 tiktoken（可选）计算；没有安装时按字符估算（ASCII 约 4 字符 1 个 token，其他字符各算 1 个）。
+
+用法：
+    text, report = compile_steps(data, budget=900)
+    print_prompt_report('gpt1 script', report)
+"""
+import re
+
+try:
+    import tiktoken  # 可选：精确计算 token 数
+except ImportError:
+    tiktoken = None
+
+import rpa_runtime
+
+PROMPT_BUDGET_SCRIPT      = 1200   # 生成 gpt1 脚本的整个提示词
+PROMPT_BUDGET_STANDARDIZE = 1500   # 标准化命令时发送的文本
+TOKEN_ENCODING            = 'cl100k_base'
+COORD_MERGE_PX            = 12     # 同一 step 不同录制的点击坐标相差不超过此值 => 视为同一位置
+TEXT_MAX_CHARS            = 80     # 摘要里输入文字的最大长度
+LINE_MAX_CHARS            = 300    # compile_text 里单行的最大长度
+
+# 优先级：数字越小越重要，超出预算时先丢数字大的
+P_HEADER, P_ACTION, P_DETAIL, P_EXTRA = 0, 1, 2, 3
+
+_encoder = None
+
+
+def count_tokens(text):
+    global _encoder
+    if tiktoken is not None and _encoder is None:
+        try:
+            _encoder = tiktoken.get_encoding(TOKEN_ENCODING)
+        except Exception:
+            _encoder = False   # 编码表下载失败 => 以后都按字符估算
+    if _encoder:
+        return len(_encoder.encode(text))
+    ascii_n = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_n + 3) // 4 + (len(text) - ascii_n)
+
+
+def fit_budget(items, budget):
+    """
+    items: [(优先级, 文本)]，按显示顺序排列 => (保留的行, 丢弃的行数)。
+    按 (优先级, 顺序) 依次放入；某一优先级有放不下的行后，不再放更低优先级的行。
+    """
+    costs = [count_tokens(text) + 1 for (_, text) in items]   # +1：换行
+    if sum(costs) <= budget:
+        return [text for (_, text) in items], 0
+    budget -= count_tokens(omitted_note(len(items))) + 1
+    keep, used, cutoff = set(), 0, None
+    for i in sorted(range(len(items)), key=lambda i: (items[i][0], i)):
+        prio = items[i][0]
+        if cutoff is not None and prio > cutoff:
+            break
+        if used + costs[i] <= budget:
+            keep.add(i)
+            used += costs[i]
+        else:
+            cutoff = prio
+    lines = [items[i][1] for i in range(len(items)) if i in keep]
+    dropped = len(items) - len(keep)
+    return lines + [omitted_note(dropped)], dropped
+
+
+def omitted_note(n):
+    return f"({n} lower-priority lines omitted to fit the token budget)"
+
+
+def _report(items, lines, dropped, budget, **extra):
+    text = "\n".join(lines)
+    return text, dict(extra, tokens=count_tokens(text), budget=budget, items=len(items), dropped=dropped,
+                      counter='tiktoken' if _encoder else 'approx')
+
+
+def print_prompt_report(name, report):
+    extra = f", {report['dropped']}/{report['items']} lines dropped" if report['dropped'] else ""
+    dedup = f", {report['duplicates']} duplicate lines removed" if report.get('duplicates') else ""
+    print(f"[INFO] Prompt '{name}': {report['tokens']} tokens ({report['counter']}) "
+          f"of budget {report['budget']}{extra}{dedup}")
+
+
+#######################
+# build_data => 步骤摘要
+#######################
+def merge_coords(points):
+    """[(x, y)] => [((x, y), 次数)]，相近的坐标合并到第一次出现的位置，按次数从多到少排列"""
+    groups = []
+    for (x, y) in points:
+        for g in groups:
+            if abs(g[0][0] - x) <= COORD_MERGE_PX and abs(g[0][1] - y) <= COORD_MERGE_PX:
+                g[1] += 1
+                break
+        else:
+            groups.append([(x, y), 1])
+    return sorted(((p, n) for (p, n) in groups), key=lambda g: -g[1])
+
+
+def _clip(text, n=TEXT_MAX_CHARS):
+    return text if len(text) <= n else text[:n - 3] + '...'
+
+
+def step_lines(sid, info):
+    """一个 step => [(优先级, 文本)]；连续重复的按键/输入合并成一项并注明次数（如 press tab x2），不删除"""
+    actions = info.get('actions') or [rpa_runtime.compile_command(c) for c in info.get('commands', [])]
+    clicks, parts, extra = {}, [], []
+    for cmd, a in zip(info.get('commands', []), actions):
+        if a is None:
+            desc = f"raw {_clip(cmd)!r}"
+        elif a['op'] == 'click':
+            if a['button'] not in clicks:
+                clicks[a['button']] = []
+                parts.append(('click', a['button']))
+            clicks[a['button']].append((a['x'], a['y']))
+            continue
+        elif a['op'] == 'press':
+            desc = f"press {a['key']}"
+        else:
+            desc = f"write {_clip(a['text'])!r}"
+        if parts and isinstance(parts[-1], list) and parts[-1][0] == desc:
+            parts[-1][1] += 1
+        else:
+            parts.append([desc, 1])
+
+    shown = []
+    for p in parts:
+        if isinstance(p, tuple):
+            groups = merge_coords(clicks[p[1]])
+            (x, y), n = groups[0]
+            shown.append(f"click {p[1]} ({x},{y})" + (f" x{n}" if n > 1 else ""))
+            if len(groups) > 1:
+                extra.append(f"{p[1]} " + " ".join(f"({x},{y})x{n}" for ((x, y), n) in groups[1:]))
+        else:
+            shown.append(p[0] + (f" x{p[1]}" if p[1] > 1 else ""))
+
+    out = [(P_ACTION, f"S{sid}: " + (" | ".join(shown) if shown else "no action"))]
+    if info.get('conditions'):
+        out.append((P_ACTION, f"S{sid} when: " + "; ".join(_clip(c) for c in info['conditions'])))
+    th = info.get('thresholds') or {}
+    detail = [f"refs={len(info.get('overall_imgs', []))}"]
+    if 'overall' in th:
+        detail.append(f"overall>={th['overall']:g}")
+    if 'local' in th:
+        detail.append(f"local>={th['local']:g}")
+    if info.get('region'):
+        detail.append("region=({},{},{},{})".format(*info['region']))
+    out.append((P_DETAIL, f"S{sid} match: " + " ".join(detail)))
+    if extra:
+        out.append((P_EXTRA, f"S{sid} other click spots: " + "; ".join(extra)))
+    return out
+
+
+def compile_steps(data, budget=PROMPT_BUDGET_SCRIPT):
+    """build_data 的结果 => (摘要文本, 报告 dict)"""
+    ref = next((info.get('ref_size') for info in data.values() if info.get('ref_size')), None)
+    header = f"{len(data)} steps, run in order"
+    if ref:
+        header += f"; coordinates are pixels on a {ref[0]}x{ref[1]} reference screen"
+    items = [(P_HEADER, header)]
+    for sid in sorted(data, key=lambda s: int(s) if str(s).isdigit() else s):
+        items += step_lines(sid, data[sid])
+    lines, dropped = fit_budget(items, budget)
+    return _report(items, lines, dropped, budget)
+
+
+#######################
+# 整理好的命令文本 => 紧凑文本
+#######################
+_COMMAND_LINE = re.compile(r'step\s*\d+|click|press|type|typed|write|key|\(\s*-?\d+\s*,\s*-?\d+\s*\)', re.IGNORECASE)
+
+
+def compile_text(text, budget=PROMPT_BUDGET_STANDARDIZE):
+    """
+    去掉空白和紧接着重复的说明行，命令类的行优先 => (文本, 报告 dict)。
+    命令类的行一律保留（连按两次 tab 就是两行相同的命令）；不相邻的重复行也保留。
+    """
+    items, prev, duplicates = [], None, 0
+    for line in text.splitlines():
+        line = re.sub(r'\s+', ' ', line).strip()
+        if not line:
+            continue
+        is_command = bool(_COMMAND_LINE.search(line))
+        if not is_command and line == prev:
+            duplicates += 1
+            continue
+        prev = line
+        prio = P_ACTION if is_command else P_DETAIL
+        items.append((prio, _clip(line, LINE_MAX_CHARS)))
+    lines, dropped = fit_budget(items, budget)
+    return _report(items, lines, dropped, budget, duplicates=duplicates)
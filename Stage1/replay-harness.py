@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+replay-harness.py
+
+无头回放：用录制好的截图代替真实屏幕，运行 form-execute-script.py 生成的运行时脚本。
+- 虚拟屏幕：按顺序提供 retryN/stepM 截图（或脚本文件里列出的帧，任意 frame_codec 格式），运行时每执行一次动作就前进一帧；
+- 虚拟执行器：替换 pyautogui，只记录 click / press / typewrite 等动作，不操作真实鼠标键盘；
+- 虚拟时钟：运行时里的 time.sleep 不真正等待，只累计等待时间和轮询次数；time.monotonic 返回累计的等待时间。
+因此可以在没有显示器的 Linux 上一分钟回放上百次流程，并统计每个 step 的端到端延迟。
+
+用法（在 retry* 所在目录运行，先用 form-execute-script.py 生成 train-model）：
+    python replay-harness.py --session retry2
+    python replay-harness.py --all-sessions --runs 200 --workers 4
+    python replay-harness.py --script replay.json      # [{"frame": "retry1/step1.png", "expect": "Mouse clicked at (1499, 20) with Button.left"}, ...]
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import types
+
+import cv2
+import numpy as np
+
+from frame_codec import FRAME_RE, read_frame
+
+DEFAULT_RUNTIME = os.path.join('train-model', 'train-pyautogui-nogpt.py')
+MAX_POLLS       = 50     # 同一帧上轮询超过这么多次仍无动作 => 判定回放失败
+CLICK_TOLERANCE = 30     # 点击位置与录制位置的允许误差（像素）
+
+
+class ReplayAbort(Exception):
+    """回放卡住（同一帧轮询次数过多）时从虚拟屏幕抛出，结束运行时的 main()"""
+
+
+#######################
+# 虚拟屏幕 + 执行器
+#######################
+_FRAME_CACHE = {}
+
+def load_frame(path):
+    """读取帧（RGB，与 pyautogui.screenshot() 一致），每个进程只读一次"""
+    img = _FRAME_CACHE.get(path)
+    if img is None:
+        bgr = read_frame(path)
+        if bgr is None:
+            raise FileNotFoundError(path)
+        img = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        _FRAME_CACHE[path] = img
+    return img
+
+
+class VirtualScreen:
+    """
+    frames: [{'frame': 绝对路径, 'expect': 录制的命令或 None}]
+    每次动作 => 记录动作并前进到下一帧；记录每帧从出现到动作的耗时。
+    """
+
+    def __init__(self, frames, max_polls=MAX_POLLS):
+        self.frames = frames
+        self.max_polls = max_polls
+        self.idx = 0
+        self.polls = 0
+        self.actions = []
+        self.step_latency = []   # 每帧从出现到触发动作的真实耗时（秒，不含虚拟等待）
+        self.virtual_wait = 0.0  # 运行时调用 time.sleep 的总时长（秒）
+        self.t_frame = time.perf_counter()
+        self.mouse = (0, 0)
+
+    # ---- 屏幕 ----
+    def current(self):
+        return self.frames[min(self.idx, len(self.frames) - 1)]
+
+    def screenshot(self, region=None, **kwargs):
+        self.polls += 1
+        if self.polls > self.max_polls:
+            raise ReplayAbort(f"frame {self.idx} polled {self.polls} times without action")
+        img = load_frame(self.current()['frame'])
+        if region is not None:
+            x, y, w, h = [int(v) for v in region]
+            img = img[max(0, y):y + h, max(0, x):x + w]
+        return img
+
+    def size(self):
+        h, w = load_frame(self.frames[0]['frame']).shape[:2]
+        return w, h
+
+    # ---- 执行器 ----
+    def act(self, kind, *args):
+        now = time.perf_counter()
+        self.actions.append({'frame': self.idx, 'kind': kind, 'args': list(args)})
+        self.step_latency.append(now - self.t_frame)
+        self.idx += 1
+        self.polls = 0
+        self.t_frame = now
+
+    def sleep(self, secs):
+        self.virtual_wait += secs
+
+    def monotonic(self):
+        """虚拟时钟：只随 sleep 前进，回放结果与机器快慢无关"""
+        return self.virtual_wait
+
+    def done(self):
+        return self.idx >= len(self.frames)
+
+
+def make_pyautogui(screen):
+    """构造一个替身 pyautogui 模块，接口与运行时用到的部分一致"""
+    pg = types.ModuleType('pyautogui')
+    pg.PAUSE = 0.0
+    pg.FAILSAFE = False
+    pg.screenshot = screen.screenshot
+    pg.size = screen.size
+
+    def click(x=None, y=None, clicks=1, interval=0.0, button='left', **kwargs):
+        if x is None:
+            x, y = screen.mouse
+        screen.mouse = (int(x), int(y))
+        screen.act('click', int(x), int(y), button)
+
+    def move_to(x=None, y=None, *args, **kwargs):
+        screen.mouse = (int(x), int(y))
+
+    def press(keys, presses=1, interval=0.0, **kwargs):
+        screen.act('press', keys)
+
+    def hotkey(*keys, **kwargs):
+        screen.act('hotkey', *keys)
+
+    def typewrite(message, interval=0.0, **kwargs):
+        screen.act('type', message)
+
+    pg.click = click
+    pg.moveTo = move_to
+    pg.press = press
+    pg.hotkey = hotkey
+    pg.typewrite = typewrite
+    pg.write = typewrite
+    pg.position = lambda: screen.mouse
+    return pg
+
+
+def make_time_shim(screen):
+    """运行时里的 time 模块替身：sleep / monotonic 走虚拟时钟，其余函数照旧"""
+    shim = types.SimpleNamespace(**{k: getattr(time, k) for k in dir(time) if not k.startswith('_')})
+    shim.sleep = screen.sleep
+    shim.monotonic = screen.monotonic
+    return shim
+
+
+#######################
+# 帧序列
+#######################
+def parse_motion(folder):
+    """retryN/motion-record.txt => {'1': 'Mouse clicked at (...)', ...}"""
+    out = {}
+    path = os.path.join(folder, 'motion-record.txt')
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                m = re.match(r'^Step\s+(\d+):\s*(.*)$', line.strip())
+                if m:
+                    out.setdefault(m.group(1), m.group(2))
+    return out
+
+def session_frames(folder):
+    """一次录制 => 按 step 顺序的帧列表"""
+    steps = []
+    for fname in os.listdir(folder):
+        m = FRAME_RE.match(fname)
+        if m:
+            steps.append((int(m.group(1)), fname))
+    motion = parse_motion(folder)
+    return [{'frame': os.path.abspath(os.path.join(folder, fname)), 'expect': motion.get(str(n))}
+            for n, fname in sorted(steps)]
+
+def script_frames(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    return [{'frame': os.path.join(base, it['frame']), 'expect': it.get('expect')} for it in items]
+
+
+def action_matches(action, expect):
+    """动作是否与录制的命令一致；没有录制命令时视为一致"""
+    if not expect:
+        return True
+    xy = re.search(r'\((-?\d+),\s*(-?\d+)\)', expect)
+    if xy:
+        if action['kind'] != 'click':
+            return False
+        return (abs(action['args'][0] - int(xy.group(1))) <= CLICK_TOLERANCE
+                and abs(action['args'][1] - int(xy.group(2))) <= CLICK_TOLERANCE)
+    if expect.startswith('Typed text:'):
+        return action['kind'] == 'type' and action['args'][0] == json.loads(expect.split(':', 1)[1])
+    if 'key pressed:' in expect.lower():
+        key = expect.split(':', 1)[1].strip().lower()
+        key = key.split('.', 1)[1] if key.startswith('key.') else key
+        return action['kind'] == 'press' and str(action['args'][0]).lower() == key
+    return True
+
+
+#######################
+# 回放
+#######################
+def load_runtime(path):
+    """按路径加载生成的脚本（__name__ 不是 '__main__'，不会自动运行 main()）"""
+    spec = importlib.util.spec_from_file_location('replay_runtime', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def replay_once(runtime_path, frames, trace=False, max_polls=MAX_POLLS):
+    """在当前进程里回放一次，返回结果 dict"""
+    screen = VirtualScreen(frames, max_polls)
+    sys.modules['pyautogui'] = make_pyautogui(screen)
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(runtime_path)))
+    t0 = time.perf_counter()
+    error = None
+    try:
+        runtime = load_runtime(os.path.basename(runtime_path))
+        runtime.time = make_time_shim(screen)
+        if not trace:
+            runtime.start_tracing = lambda *a, **k: None
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                runtime.main()
+            finally:
+                sys.stdout = stdout
+    except ReplayAbort as e:
+        error = str(e)
+    finally:
+        os.chdir(cwd)
+    wall = time.perf_counter() - t0
+
+    correct = all(action_matches(a, frames[a['frame']]['expect'])
+                  for a in screen.actions if a['frame'] < len(frames))
+    return {
+        'ok': error is None and screen.done() and correct,
+        'error': error or ('' if correct else 'action mismatch'),
+        'wall_s': wall,
+        'virtual_wait_s': screen.virtual_wait,
+        'step_latency_s': screen.step_latency,
+        'actions': screen.actions,
+    }
+
+def _worker(job):
+    runtime_path, frames, trace, max_polls = job
+    return replay_once(runtime_path, frames, trace, max_polls)
+
+
+def percentile(values, q):
+    return float(np.percentile(np.array(values), q)) if values else 0.0
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay recorded frames through a generated runtime without a screen.")
+    ap.add_argument('--runtime', default=DEFAULT_RUNTIME, help="generated runtime script")
+    src = ap.add_mutually_exclusive_group()
+    src.add_argument('--session', help="replay one recording folder, e.g. retry2")
+    src.add_argument('--all-sessions', action='store_true', help="cycle through every retry* folder")
+    src.add_argument('--script', help="json list of {frame, expect}")
+    ap.add_argument('--runs', type=int, default=1, help="number of replays")
+    ap.add_argument('--workers', type=int, default=1, help="parallel worker processes")
+    ap.add_argument('--max-polls', type=int, default=MAX_POLLS)
+    ap.add_argument('--trace', action='store_true', help="keep the runtime's span trace")
+    ap.add_argument('--verbose', action='store_true', help="print every replay's actions")
+    args = ap.parse_args()
+
+    if args.script:
+        sequences = [script_frames(args.script)]
+    elif args.session:
+        sequences = [session_frames(args.session)]
+    else:
+        folders = sorted(d for d in os.listdir('.') if os.path.isdir(d) and d.startswith('retry'))
+        if not args.all_sessions:
+            folders = folders[:1]
+        sequences = [session_frames(d) for d in folders]
+    sequences = [s for s in sequences if s]
+    if not sequences:
+        print("[ERROR] No frames to replay.")
+        return 1
+    if not os.path.exists(args.runtime):
+        print(f"[ERROR] Runtime not found: {args.runtime}")
+        return 1
+
+    jobs = [(args.runtime, sequences[i % len(sequences)], args.trace, args.max_polls) for i in range(args.runs)]
+    t0 = time.perf_counter()
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            results = pool.map(_worker, jobs)
+    else:
+        results = [_worker(j) for j in jobs]
+    total = time.perf_counter() - t0
+
+    lat = [x for r in results for x in r['step_latency_s']]
+    ok = sum(1 for r in results if r['ok'])
+    for i, r in enumerate(results):
+        if args.verbose or not r['ok']:
+            print(f"[{'OK' if r['ok'] else 'FAIL'}] replay {i}: {r['error']} actions={[(a['kind'], a['args']) for a in r['actions']]}")
+    print(f"[INFO] replays={len(results)} ok={ok} failed={len(results) - ok} "
+          f"in {total:.1f}s => {60.0 * len(results) / total:.1f} replays/min")
+    print(f"[INFO] step latency p50={1000 * percentile(lat, 50):.1f} ms "
+          f"p90={1000 * percentile(lat, 90):.1f} ms p99={1000 * percentile(lat, 99):.1f} ms "
+          f"(virtual wait per replay={np.mean([r['virtual_wait_s'] for r in results]):.1f}s)")
+    return 0 if ok == len(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
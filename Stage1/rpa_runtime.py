@@ -0,0 +1,948 @@
+# -*- coding: utf-8 -*-
+"""
+rpa_runtime.py
+
+生成脚本（train-pyautogui-nogpt.py / train-pyautogui-gpt2.py）共用的运行时函数。
+form-execute-script.py 会把本文件源码原样嵌入生成的脚本，因此生成脚本仍然可以单独运行；
+本文件只允许依赖 cv2 / numpy / 标准库（pytesseract 为可选依赖，缺失时文字条件交回原有逻辑判断）。
+
+匹配分为两级：
+1. 模板匹配（归一化互相关），在缩小的灰度图上进行，速度快，适合像素完全一致的 UI 元素（如浏览器标签页）。
+2. 分数不明确时，再升级为 SIFT 特征匹配 + RANSAC 单应性。
+定位成功后记住 bbox，之后的截图先在该位置附近的小窗口内确认（跟踪），跟丢时才重新全图检测。
+
+参考图统一为录制时的分辨率（构建时把不同分辨率的录制缩放到这一分辨率），并预先算好几个缩放比例下的特征。
+运行时启动时检测一次屏幕相对参考图的缩放比例（分辨率 / DPI 缩放不同），选用最接近的一层特征，
+局部截图和学习区域也按该比例缩放一次；之后每次截图的匹配开销与同分辨率时相同。
+
+train-model 下有 workflow bundle (workflow.rpab，见 workflow_bundle.py) 时，data、参考图特征和局部截图都从这一个文件读取：
+整个文件 mmap 一次并校验内容哈希，数组直接是映射上的视图，不再读取 ../retry* 和零散的特征 / 图片文件。
+"""
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import re
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+try:
+    import pytesseract  # 本地离线 OCR，用于判断文字类条件
+except ImportError:
+    pytesseract = None
+
+TM_SCALE   = 0.5    # 模板匹配时的缩放比例
+TM_ACCEPT  = 0.95   # 相关系数 >= 此值且与次高峰差距足够 => 直接命中
+TM_REJECT  = 0.55   # 相关系数 <  此值 => 直接判定不匹配
+TM_MARGIN  = 0.10   # 最高峰与次高峰至少相差多少才算不歧义
+
+TRACK_PAD    = 48    # 跟踪时在上次 bbox 周围多少像素的窗口内搜索
+TRACK_ACCEPT = 0.90  # 窗口内相关系数 >= 此值 => 跟踪成功，不再全图检测
+
+OCR_TILE_W     = 480   # OCR 分块宽度（原图像素）
+OCR_TILE_H     = 96    # OCR 分块高度
+OCR_TILE_STEP  = 320   # 分块水平步长，相邻分块重叠，避免短语被切断
+OCR_TILE_STEP_Y = 64   # 分块垂直步长（< OCR_TILE_H），上下分块重叠 32 像素，每一行文字都完整落在某个分块里
+OCR_UPSCALE    = 2.0   # 标签页文字很小，放大后再 OCR
+OCR_CACHE_MAX  = 1024  # 缓存的分块数量上限
+
+# 分块内容哈希 => OCR 文本；未变化的分块不会重复 OCR
+OCR_CACHE = OrderedDict()
+OCR_STATS = {'hit': 0, 'miss': 0}
+
+TRACE_FILE        = 'runtime-trace.jsonl'  # 计时 span 写入的 JSONL 文件；None => 不写文件
+TRACE_UDP         = None                   # ('127.0.0.1', 8125) => 同时以 UDP 发送到本地 metrics 端点
+TRACE_FLUSH_EVERY = 256                    # 攒够多少条 span 再写一次，降低开销
+
+ORB_DEFAULT_FEATURES = 500  # 与 cv2.ORB_create() 默认值一致
+ORB_GRID_OVERSAMPLE  = 3    # 网格模式下先多检测几倍的关键点，再按格筛选
+
+LOOKAHEAD_STEPS   = 2     # 每次截图除了当前 step，还与后面几个 step 比较
+LOOKAHEAD_RATIO   = 1.5   # 后续 step 得分至少是当前 step 的多少倍才跳转
+
+TYPED_PREFIX  = 'Typed text: '   # 录制时合并的连续输入，文字部分为 JSON 字符串
+TYPE_INTERVAL = 0.0              # 回放输入文字时每个字符之间的间隔（秒）
+ACTION_PAUSE  = 0.02             # 每次 pyautogui 调用之后的停顿（秒），pyautogui 默认 0.1
+
+SETTLE_INTERVAL = 0.05   # 动作后检查界面是否稳定的间隔（秒）
+SETTLE_STABLE   = 3      # 连续多少次检查没有变化 => 稳定
+SETTLE_DIFF     = 1.5    # 两次截图的平均灰度差 < 此值 => 没有变化
+SETTLE_MIN_WAIT = 0.2    # 界面一直没变化时，至少等这么久才认为稳定（界面可能还没开始响应）
+SETTLE_TIMEOUT  = 3.0    # 最多等待多久（秒）
+SETTLE_PAD      = 150    # 点击位置周围多大的区域（像素）
+
+BUNDLE_NAME  = 'workflow.rpab'   # train-model 下的 workflow bundle；环境变量 RPA_BUNDLE 可指定其他路径
+BUNDLE_MAGIC = b'RPAB0001'
+BUNDLE_HEAD  = struct.Struct('<8s32sQ')   # 魔数 + 内容 SHA-256 + 清单 JSON 长度
+BUNDLE_ALIGN = 64                         # 数组按 64 字节对齐
+
+SCALE_LEVELS = (0.5, 0.667, 0.8, 1.0, 1.25, 1.5, 2.0)   # 构建时预先提取特征的屏幕缩放比例（相对参考图）
+# 运行时屏幕：scale = 截图宽度 / 参考图宽度，level = 最接近的特征层，click = 鼠标坐标 / 截图像素
+SCREEN = {'scale': 1.0, 'level': 1.0, 'click': 1.0}
+
+# 各级匹配的判定次数，用于统计模板匹配能独立决定的比例
+MATCH_STATS = {'template_hit': 0, 'template_miss': 0, 'feature_hit': 0, 'feature_miss': 0,
+               'track_hit': 0, 'track_miss': 0}
+
+
+#######################
+# 计时 span
+#######################
+class _NullSpan:
+    """未开启 tracing 时使用的空 span，几乎没有开销"""
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def set(self, **attrs):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'attrs', 't0')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        t1 = time.perf_counter()
+        rec = {'span': self.name, 'ms': round(1000 * (t1 - self.t0), 3), 't': round(self.tracer.t_base + t1, 6)}
+        rec.update(self.tracer.ctx)
+        rec.update(self.attrs)
+        self.tracer.emit(rec)
+        return False
+
+    def set(self, **attrs):
+        """span 结束前补充属性，如 score"""
+        self.attrs.update(attrs)
+
+
+class Tracer:
+    """把 span 缓存在内存里，批量写入 JSONL 文件和/或发送到 UDP 端点"""
+
+    def __init__(self, path=TRACE_FILE, udp=TRACE_UDP, flush_every=TRACE_FLUSH_EVERY):
+        self.path = path
+        self.udp = udp
+        self.flush_every = flush_every
+        self.ctx = {}
+        self.buf = []
+        self.t_base = time.time() - time.perf_counter()  # perf_counter => 墙上时间
+        self.fh = open(path, 'a', encoding='utf-8') if path else None
+        self.sock = None
+        if udp:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+
+    def span(self, name, attrs):
+        return _Span(self, name, attrs)
+
+    def emit(self, rec):
+        self.buf.append(rec)
+        if len(self.buf) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        lines = [json.dumps(r, ensure_ascii=False, default=str) for r in self.buf]
+        self.buf = []
+        if self.fh:
+            self.fh.write("\n".join(lines) + "\n")
+            self.fh.flush()
+        if self.sock:
+            for line in lines:
+                try:
+                    self.sock.sendto(line.encode('utf-8'), self.udp)
+                except OSError:
+                    pass  # metrics 端点不可用时丢弃，不影响运行
+
+    def close(self):
+        self.flush()
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+TRACER = None
+
+
+def start_tracing(path=TRACE_FILE, udp=TRACE_UDP):
+    """开启 tracing；path 和 udp 都为空时保持关闭"""
+    global TRACER
+    if path or udp:
+        TRACER = Tracer(path, udp)
+        atexit.register(stop_tracing)  # Ctrl+C 退出时也把缓存的 span 写出去
+    return TRACER
+
+
+def stop_tracing():
+    global TRACER
+    if TRACER is not None:
+        TRACER.close()
+        TRACER = None
+
+
+def span(name, **attrs):
+    """with span('capture') as sp: ... ; sp.set(score=...)"""
+    if TRACER is None:
+        return _NULL_SPAN
+    return TRACER.span(name, attrs)
+
+
+def trace_context(**ctx):
+    """设置之后所有 span 都带上的字段（step id / 参考图 id），值为 None 的字段会被移除"""
+    if TRACER is None:
+        return
+    for k, v in ctx.items():
+        if v is None:
+            TRACER.ctx.pop(k, None)
+        else:
+            TRACER.ctx[k] = v
+
+
+_ORB_CACHE = {}
+
+def orb_config(cfg):
+    """step 的 ORB 设置 => (特征数, (网格行, 网格列) 或 None)；未设置时与 cv2.ORB_create() 默认一致"""
+    if not cfg:
+        return ORB_DEFAULT_FEATURES, None
+    grid = cfg.get('grid')
+    return int(cfg.get('nfeatures', ORB_DEFAULT_FEATURES)), (tuple(grid) if grid else None)
+
+
+def orb_features(img, nfeatures=ORB_DEFAULT_FEATURES, grid=None):
+    """
+    ORB 特征 => (关键点坐标 Nx2 float32, 描述子)；同一张图只需提取一次。
+    grid=(行, 列) 时按网格分桶，每格只保留响应最强的若干个关键点，避免特征点都挤在文字密集的区域。
+    """
+    with span('features', kind='orb') as sp:
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        key = (nfeatures, grid)
+        orb = _ORB_CACHE.get(key)
+        if orb is None:
+            orb = cv2.ORB_create(nfeatures * ORB_GRID_OVERSAMPLE if grid else nfeatures)
+            _ORB_CACHE[key] = orb
+        if grid:
+            kp = orb.detect(gray, None)
+            rows, cols = grid
+            h, w = gray.shape[:2]
+            per_cell = max(1, -(-nfeatures // (rows * cols)))
+            cells = {}
+            for k in kp:
+                cell = (min(rows - 1, int(k.pt[1] * rows / h)), min(cols - 1, int(k.pt[0] * cols / w)))
+                cells.setdefault(cell, []).append(k)
+            kept = []
+            for lst in cells.values():
+                lst.sort(key=lambda k: k.response, reverse=True)
+                kept.extend(lst[:per_cell])
+            kp, des = orb.compute(gray, kept)
+        else:
+            kp, des = orb.detectAndCompute(gray, None)
+        sp.set(n=len(kp) if kp else 0)
+    pts = np.float32([k.pt for k in kp]) if kp else np.zeros((0, 2), np.float32)
+    return pts, des
+
+
+def orb_score_features(feat_q, feat_t, ransac_thresh=5.0):
+    """用已提取的 ORB 特征计算 RANSAC 内点数"""
+    pts_q_all, des_q = feat_q
+    pts_t_all, des_t = feat_t
+    if des_q is None or des_t is None or len(des_q)<4 or len(des_t)<4:
+        return 0
+    with span('matching', kind='orb'):
+        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        matches = bf.match(des_q, des_t)
+    if len(matches)<4:
+        return 0
+    with span('ransac', kind='orb') as sp:
+        pts_q= np.float32(pts_q_all[[m.queryIdx for m in matches]])
+        pts_t= np.float32(pts_t_all[[m.trainIdx for m in matches]])
+        H, mask= cv2.findHomography(pts_q, pts_t, cv2.RANSAC, ransac_thresh)
+        if H is None:
+            return 0
+        score = int(mask.ravel().sum())
+        sp.set(score=score)
+    return score
+
+
+def orb_homography_score(img_query, img_train, ransac_thresh=5.0):
+    return orb_score_features(orb_features(img_query), orb_features(img_train), ransac_thresh)
+
+
+class FrameFeatures:
+    """一次截图的 ORB 特征；不同 step 的 ORB 设置可能不同，按设置分别提取并缓存"""
+
+    def __init__(self, img):
+        self.img = img
+        self.cache = {}
+
+    def get(self, cfg=None):
+        key = orb_config(cfg)
+        if key not in self.cache:
+            self.cache[key] = orb_features(self.img, *key)
+        return self.cache[key]
+
+
+# 图像路径 => 图像；参考图不会变化，只读取一次
+IMG_CACHE = {}
+# (图像路径, ORB 设置) => ORB 特征
+FEAT_CACHE = {}
+# 特征文件名 => {folder: (pts, des)}
+FEATURE_STORES = {}
+
+def load_image(path):
+    """读取并缓存参考图；文件缺失或无法读取时返回 None"""
+    if path not in IMG_CACHE:
+        img = cv2.imread(path)
+        if img is None:
+            print(f"[ERROR] cannot read {path} => skip.")
+        IMG_CACHE[path] = img
+    return IMG_CACHE[path]
+
+
+def rescale(img, s):
+    """按比例缩放图像；s == 1 时原样返回"""
+    if img is None or abs(s - 1.0) < 1e-3:
+        return img
+    interp = cv2.INTER_AREA if s < 1.0 else cv2.INTER_LINEAR
+    return cv2.resize(img, None, fx=s, fy=s, interpolation=interp)
+
+
+def load_scaled(path):
+    """局部截图按当前屏幕比例缩放后的图像（每个文件只缩放一次）"""
+    key = (path, SCREEN['scale'])
+    if key not in IMG_CACHE:
+        IMG_CACHE[key] = rescale(load_image(path), SCREEN['scale'])
+    return IMG_CACHE[key]
+
+
+def level_key(folder, level):
+    """特征文件里某一层特征的键：原尺寸仍用 folder，其余为 'folder@0.8'"""
+    return folder if abs(level - 1.0) < 1e-3 else f"{folder}@{level:g}"
+
+
+def nearest_level(scale):
+    return min(SCALE_LEVELS, key=lambda lv: abs(np.log(lv / scale)))
+
+
+def detect_screen_scale(pg, data):
+    """
+    启动时调用一次：截一张图与构建时记录的参考分辨率 (info['ref_size']) 比较，得到屏幕缩放比例，
+    选出最接近的特征层；鼠标坐标与截图像素不一致（DPI 缩放）时记下换算比例。
+    """
+    ref = next((info['ref_size'] for info in data.values() if info.get('ref_size')), None)
+    shot = np.asarray(pg.screenshot())
+    h, w = shot.shape[:2]
+    scale = 1.0
+    if ref:
+        scale = w / float(ref[0])
+        if abs(h / float(ref[1]) - scale) > 0.02 * scale:
+            print(f"[WARNING] screen {w}x{h} has a different aspect ratio from references {ref[0]}x{ref[1]}")
+    lw, _ = pg.size()
+    SCREEN.update(scale=round(scale, 4), level=nearest_level(scale), click=lw / float(w))
+    print(f"[INFO] screen {w}x{h} (references {ref[0] if ref else w}x{ref[1] if ref else h}) => "
+          f"scale {SCREEN['scale']:g}, feature level {SCREEN['level']:g}, click scale {SCREEN['click']:g}")
+    return SCREEN
+
+
+def scale_region(region, s):
+    """(x1, y1, x2, y2) 按比例缩放"""
+    if region is None or None in region:
+        return region
+    return tuple(int(round(v * s)) for v in region)
+
+
+def local_click_point(info, folder, bbox):
+    """局部截图定位到的 bbox => 点击位置（截图像素）：bbox 中心加上构建时记录的点击偏移（参考图坐标，按屏幕比例缩放）"""
+    x1, y1, x2, y2 = bbox
+    dx, dy = (info.get('local_offsets') or {}).get(folder, (0, 0))
+    return (x1 + x2) / 2 + dx * SCREEN['scale'], (y1 + y2) / 2 + dy * SCREEN['scale']
+
+
+def screen_point(x, y):
+    """截图像素坐标 => 鼠标坐标"""
+    return int(round(x * SCREEN['click'])), int(round(y * SCREEN['click']))
+
+
+def load_feature_store(fname):
+    """读取构建时保存的参考图特征 (stepX-features.npz)；不存在时返回空 dict"""
+    if fname not in FEATURE_STORES:
+        store = {}
+        if fname and os.path.exists(fname):
+            with np.load(fname) as z:
+                for key in z.files:
+                    if key.endswith('__pts'):
+                        folder = key[:-len('__pts')]
+                        store[folder] = (z[key].astype(np.float32), z[folder + '__des'])
+        FEATURE_STORES[fname] = store
+    return FEATURE_STORES[fname]
+
+
+def save_feature_store(fname, feats):
+    """{folder: (pts, des)} => npz；坐标取整存为 uint16，描述子本身就是 uint8"""
+    arrays = {}
+    for folder, (pts, des) in feats.items():
+        arrays[folder + '__pts'] = np.round(pts).clip(0, 65535).astype(np.uint16)
+        arrays[folder + '__des'] = des if des is not None else np.zeros((0, 32), np.uint8)
+    np.savez_compressed(fname, **arrays)
+
+
+def ref_image_path(rel_png):
+    """data 里的参考图路径 ('retry1/step1.png'，旧脚本里可能是 'retry1\\step1.png') => 运行目录 (train-model) 下的路径"""
+    return os.path.join('..', *re.split(r'[\\/]', rel_png))
+
+
+def open_bundle(path, expect_sha256=None):
+    """
+    读取 workflow bundle：整个文件 mmap 一次，校验内容哈希（与 expect_sha256 不一致或文件被改动过时抛出 ValueError），
+    返回 (data, {名称: 只读数组视图}, 内容哈希十六进制)。
+    """
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(buf) < BUNDLE_HEAD.size:
+        raise ValueError(f"{path}: not a workflow bundle")
+    magic, digest, n = BUNDLE_HEAD.unpack_from(buf)
+    if magic != BUNDLE_MAGIC:
+        raise ValueError(f"{path}: not a workflow bundle")
+    body = memoryview(buf)[BUNDLE_HEAD.size:]
+    if hashlib.sha256(body).digest() != digest:
+        raise ValueError(f"{path}: content hash mismatch (file changed or truncated)")
+    if expect_sha256 and digest.hex() != expect_sha256.lower():
+        raise ValueError(f"{path}: sha256 {digest.hex()} != expected {expect_sha256}")
+    manifest = json.loads(bytes(body[:n]).decode('utf-8'))
+    arrays = {}
+    for name, (dtype, shape, offset, _) in manifest['arrays'].items():
+        count = int(np.prod(shape)) if shape else 1
+        arrays[name] = np.frombuffer(buf, dtype=np.dtype(dtype), count=count, offset=offset).reshape(shape)
+    return manifest['data'], arrays, digest.hex()
+
+
+def load_workflow(data):
+    """
+    有 workflow bundle（环境变量 RPA_BUNDLE 指定，或运行目录下的 BUNDLE_NAME）时：校验后从中载入 data、
+    参考图特征（FEATURE_STORES）和参考图像素（IMG_CACHE），返回 bundle 里的 data；
+    环境变量 RPA_BUNDLE_SHA256 给出时还要求内容哈希一致。没有 bundle 时原样返回 data。
+    """
+    path = os.environ.get('RPA_BUNDLE') or (BUNDLE_NAME if os.path.exists(BUNDLE_NAME) else None)
+    if not path:
+        return data
+    t0 = time.perf_counter()
+    data, arrays, digest = open_bundle(path, os.environ.get('RPA_BUNDLE_SHA256'))
+    for name, arr in arrays.items():
+        kind, _, rest = name.partition('/')
+        if kind == 'features':
+            fname, key = rest.split('/', 1)
+            if key.endswith('__pts'):
+                folder = key[:-len('__pts')]
+                FEATURE_STORES.setdefault(fname, {})[folder] = (arr.astype(np.float32), arrays[f"features/{fname}/{folder}__des"])
+        elif kind == 'local':
+            IMG_CACHE[rest] = arr
+        elif kind == 'overall':
+            IMG_CACHE[ref_image_path(rest)] = arr
+    print(f"[INFO] Loaded {path} (sha256 {digest[:12]}, {len(data)} steps, {len(arrays)} arrays) "
+          f"in {1000 * (time.perf_counter() - t0):.1f} ms")
+    return data
+
+
+def ref_features(info, folder, rel_png):
+    """参考图在当前屏幕比例下的特征：优先用构建时保存的该层特征，否则读取图片缩放后现场提取（结果缓存）"""
+    store = load_feature_store(info.get('features'))
+    name = level_key(folder, SCREEN['level'])
+    if name in store:
+        return store[name]
+    key = (rel_png, orb_config(info.get('orb')), SCREEN['level'])
+    if key not in FEAT_CACHE:
+        img = rescale(load_image(ref_image_path(rel_png)), SCREEN['level'])
+        FEAT_CACHE[key] = None if img is None else orb_features(img, *key[1])
+    return FEAT_CACHE[key]
+
+
+def typed_text(cmd):
+    """录制时合并的连续输入 'Typed text: "..."' => 文字；其他命令返回 None"""
+    if not cmd.startswith(TYPED_PREFIX):
+        return None
+    try:
+        return json.loads(cmd[len(TYPED_PREFIX):])
+    except ValueError:
+        return cmd[len(TYPED_PREFIX):].strip()
+
+
+def step_has_xy(info):
+    return any(typed_text(c) is None and re.search(r'\((\d+),\s*(\d+)\)', c) for c in info.get('commands', []))
+
+
+def step_thresholds(info, overall_thresh, local_thresh, high_thresh):
+    """step 的 (整体, 局部, 高匹配) 阈值：构建时校准写入的 info['thresholds'] 优先，缺失的用脚本全局阈值"""
+    th = info.get('thresholds') or {}
+    return (th.get('overall', overall_thresh), th.get('local', local_thresh), th.get('high', high_thresh))
+
+
+def iter_step_scores(info, frame, cache, ransac_thresh=5.0):
+    """
+    逐个给 step 的整体参考图打分 => 依次产出 (folder, rel_path, score)。
+    构建时聚类过的 step 只给原型打分（info['prototypes']），原型特征是簇内各图合并后的描述子集合。
+    frame 为 FrameFeatures，按该 step 的 ORB 设置提取截图特征；
+    cache 为本次截图的 {rel_path: score}，已经算过的直接复用；调用方可在找到满足条件的参考图后提前停止。
+    """
+    protos = info.get('prototypes')
+    for (folder, rel_png) in info.get('overall_imgs', []):
+        if protos is not None and folder not in protos:
+            continue
+        if rel_png not in cache:
+            feats = ref_features(info, folder, rel_png)
+            if feats is None:
+                cache[rel_png] = None
+            else:
+                frame_feats = frame.get(info.get('orb'))
+                trace_context(ref=rel_png)
+                with span('match', kind='overall') as sp:
+                    cache[rel_png] = orb_score_features(feats, frame_feats, ransac_thresh)
+                    sp.set(score=int(cache[rel_png]))
+        if cache[rel_png] is not None:
+            yield folder, rel_png, cache[rel_png]
+
+
+def step_members(info, folder):
+    """原型 folder => 簇内所有 folder（未聚类时只有它自己）"""
+    return (info.get('prototypes') or {}).get(folder, [folder])
+
+
+def evaluate_lookahead(data, step_ids, idx, frame, cache, k, ransac_thresh, overall_thresh, high_thresh):
+    """
+    一次截图同时与当前 step 和后面 k 个 step 打分（截图特征只提取一次，分数存入 cache 供后续复用）。
+    当前 step 有参考图达到阈值 => 留在当前 step；否则跳到达到阈值且得分最高的后续 step（界面已经前进了）。
+    返回新的 idx。
+    """
+    best_idx, best_sc, cur_sc = idx, -1, 0
+    for j in range(idx, min(len(step_ids), idx + k + 1)):
+        info = data[step_ids[j]]
+        th_ov, _, th_high = step_thresholds(info, overall_thresh, 0, high_thresh)
+        need = th_high if step_has_xy(info) else th_ov
+        top = 0
+        for (_, _, sc) in iter_step_scores(info, frame, cache, ransac_thresh):
+            top = max(top, sc)
+            if j == idx and top >= need:
+                return idx  # 当前 step 已满足，不再看后面的
+        if j == idx:
+            cur_sc = top
+            continue
+        # 相邻 step 的画面往往很像，后续 step 的得分要明显高于当前 step 才跳转
+        if top >= need and top > best_sc and top >= cur_sc * LOOKAHEAD_RATIO:
+            best_idx, best_sc = j, top
+    return best_idx
+
+
+def orb_homography_and_bbox(img_query, img_train, ransac_thresh=5.0, train_feats=None):
+    #使用 SIFT 特征点匹配和单应性矩阵计算图像区域。返回匹配分数和边界框 (x1, y1, x2, y2)
+    #train_feats: 已提取好的 img_train SIFT 特征 (点坐标, 描述子)，构建时由 step_precompute 缓存提供
+    with span('features', kind='sift'):
+        sift = cv2.SIFT_create()
+        kp_q, des_q = sift.detectAndCompute(img_query, None)
+        if train_feats is None:
+            kp_t, des_t = sift.detectAndCompute(img_train, None)
+            pts_all = [k.pt for k in kp_t]
+        else:
+            pts_all, des_t = train_feats
+
+    if des_q is None or des_t is None:
+        return 0, None, None
+
+    with span('matching', kind='sift'):
+        bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=True)
+        matches = bf.match(des_q, des_t)
+
+    if len(matches) < 4:  # 匹配点不足
+        return len(matches), None, None
+
+    with span('ransac', kind='sift'):
+        matches = sorted(matches, key=lambda x: x.distance)
+        pts_q = np.float32([kp_q[m.queryIdx].pt for m in matches])
+        pts_t = np.float32([pts_all[m.trainIdx] for m in matches])
+
+        H, mask = cv2.findHomography(pts_q, pts_t, cv2.RANSAC, ransac_thresh)
+
+    if H is None:
+        return len(matches), None, None
+
+    h, w = img_query.shape[:2]
+    corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
+    transformed_corners = cv2.perspectiveTransform(corners, H)
+
+    x_coords = transformed_corners[:, 0, 0]
+    y_coords = transformed_corners[:, 0, 1]
+    x1, y1, x2, y2 = int(x_coords.min()), int(y_coords.min()), int(x_coords.max()), int(y_coords.max())
+
+    # 计算中心点
+    cx = (x1 + x2) // 2
+    cy = (y1 + y2) // 2
+
+    return int(mask.ravel().sum()), (x1, y1, x2, y2), (cx, cy)
+
+
+def to_small_gray(img, scale=TM_SCALE):
+    """BGR/灰度图 => 缩小后的灰度图（每次截图只需计算一次）"""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if scale == 1.0:
+        return img
+    # 先轻微模糊再缩小，避免截取位置的奇偶不同导致细文字的相关系数下降
+    img = cv2.GaussianBlur(img, (5, 5), 1.2)
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def match_template(img_query, img_train, scale=TM_SCALE, train_small=None):
+    """
+    在缩小的灰度图上做归一化互相关。
+    返回 (最高分, 次高分, bbox, center)，bbox/center 为原图坐标；模板比截图大时返回 (0, 0, None, None)。
+    """
+    q = to_small_gray(img_query, scale)
+    t = train_small if train_small is not None else to_small_gray(img_train, scale)
+    qh, qw = q.shape[:2]
+    th, tw = t.shape[:2]
+    if qh < 4 or qw < 4 or qh > th or qw > tw:
+        return 0.0, 0.0, None, None
+
+    with span('matching', kind='template') as sp:
+        res = cv2.matchTemplate(t, q, cv2.TM_CCOEFF_NORMED)
+        _, best, _, loc = cv2.minMaxLoc(res)
+        sp.set(score=round(float(best), 4))
+
+    # 抹掉最高峰附近一个模板大小的区域，再找次高峰（判断是否有多个相同元素）
+    x, y = loc
+    res[max(0, y - qh // 2):y + qh // 2 + 1, max(0, x - qw // 2):x + qw // 2 + 1] = -1.0
+    _, second, _, _ = cv2.minMaxLoc(res)
+
+    x1, y1 = int(x / scale), int(y / scale)
+    x2, y2 = int((x + qw) / scale), int((y + qh) / scale)
+    return float(best), float(second), (x1, y1, x2, y2), ((x1 + x2) // 2, (y1 + y2) // 2)
+
+
+def tiered_match(img_query, img_train, ransac_thresh=5.0, local_thresh=10.0, train_small=None, train_feats=None):
+    """
+    分级匹配局部截图：先模板匹配，分数不明确时再用 SIFT + RANSAC。
+    返回 (是否命中, bbox, center, tier, score)，tier 为 'template' 或 'feature'。
+    train_small / train_feats 为 img_train 已算好的缩小灰度图 / SIFT 特征（构建时复用）。
+    """
+    best, second, bbox, center = match_template(img_query, img_train, TM_SCALE, train_small)
+    if best >= TM_ACCEPT and best - second >= TM_MARGIN:
+        MATCH_STATS['template_hit'] += 1
+        return True, bbox, center, 'template', best
+    if best < TM_REJECT:
+        MATCH_STATS['template_miss'] += 1
+        return False, None, None, 'template', best
+
+    sc, bbox, center = orb_homography_and_bbox(img_query, img_train, ransac_thresh, train_feats)
+    if sc >= local_thresh and bbox is not None:
+        MATCH_STATS['feature_hit'] += 1
+        return True, bbox, center, 'feature', float(sc)
+    MATCH_STATS['feature_miss'] += 1
+    return False, None, None, 'feature', float(sc)
+
+
+# 局部截图 => 上次定位到的 bbox（原图坐标）
+TRACKS = {}
+
+def track_match(key, img_query, img_train):
+    """
+    跟踪：只在上次 bbox 周围 TRACK_PAD 像素的窗口内做原图灰度模板匹配，确认元素还在原处（或只移动了一点）。
+    返回 (是否命中, bbox, center, score)；没有上次位置或分数低于 TRACK_ACCEPT 时不命中并丢弃该轨迹。
+    """
+    last = TRACKS.get(key)
+    if last is None:
+        return False, None, None, 0.0
+    x1, y1, x2, y2 = last
+    h, w = img_train.shape[:2]
+    qh, qw = img_query.shape[:2]
+    wx1, wy1 = max(0, x1 - TRACK_PAD), max(0, y1 - TRACK_PAD)
+    wx2, wy2 = min(w, x2 + TRACK_PAD), min(h, y2 + TRACK_PAD)
+    if wy2 - wy1 < qh or wx2 - wx1 < qw:
+        del TRACKS[key]
+        return False, None, None, 0.0
+    with span('matching', kind='track') as sp:
+        win = img_train[wy1:wy2, wx1:wx2]
+        win = cv2.cvtColor(win, cv2.COLOR_BGR2GRAY) if win.ndim == 3 else win
+        q = cv2.cvtColor(img_query, cv2.COLOR_BGR2GRAY) if img_query.ndim == 3 else img_query
+        res = cv2.matchTemplate(win, q, cv2.TM_CCOEFF_NORMED)
+        _, best, _, loc = cv2.minMaxLoc(res)
+        sp.set(score=round(float(best), 4))
+    if best < TRACK_ACCEPT:
+        del TRACKS[key]
+        return False, None, None, float(best)
+    bbox = (wx1 + loc[0], wy1 + loc[1], wx1 + loc[0] + qw, wy1 + loc[1] + qh)
+    TRACKS[key] = bbox
+    return True, bbox, ((bbox[0] + bbox[2]) // 2, (bbox[1] + bbox[3]) // 2), float(best)
+
+
+def tracked_match(key, img_query, img_train, ransac_thresh=5.0, local_thresh=10.0, train_small=None):
+    """
+    先按上次位置跟踪（小窗口模板匹配），跟踪失败时才回到 tiered_match 全图检测，检测成功后重新开始跟踪。
+    key 为局部截图的文件名；返回值与 tiered_match 相同，跟踪命中时 tier 为 'track'。
+    """
+    tracking = key in TRACKS
+    ok, bbox, center, sc = track_match(key, img_query, img_train)
+    if ok:
+        MATCH_STATS['track_hit'] += 1
+        return True, bbox, center, 'track', sc
+    if tracking:
+        MATCH_STATS['track_miss'] += 1
+    ok, bbox, center, tier, sc = tiered_match(img_query, img_train, ransac_thresh, local_thresh, train_small)
+    if ok:
+        TRACKS[key] = tuple(int(v) for v in bbox)
+    return ok, bbox, center, tier, sc
+
+
+def report_match_stats():
+    """打印各级匹配的命中率"""
+    tm = MATCH_STATS['template_hit'] + MATCH_STATS['template_miss']
+    ft = MATCH_STATS['feature_hit'] + MATCH_STATS['feature_miss']
+    tr = MATCH_STATS['track_hit']
+    total = tm + ft + tr
+    if not total:
+        return
+    print(f"[STATS] local matches={total}, "
+          f"tracked={tr} ({100.0 * tr / total:.1f}%, lost={MATCH_STATS['track_miss']}), "
+          f"template decided={tm} ({100.0 * tm / total:.1f}%, hit={MATCH_STATS['template_hit']}), "
+          f"escalated to feature={ft} ({100.0 * ft / total:.1f}%, hit={MATCH_STATS['feature_hit']})")
+
+
+def extract_quoted_phrases(cond):
+    """从条件中取出引号内的文字，如 "has the words 'DeepL Transla' on it" => ['DeepL Transla']"""
+    return [p.strip() for p in re.findall(r"['\u2018\u201c\"]([^'\u2019\u201d\"]{2,})['\u2019\u201d\"]", cond) if p.strip()]
+
+
+def is_pure_text_condition(cond):
+    """条件只要求画面上出现某些文字（而不是"被选中""高亮"之类的状态）时，才能完全由 OCR 判断"""
+    low = cond.lower()
+    if any(w in low for w in ('selected', 'highlight', 'framed', 'color', 'colour', 'checked')):
+        return False
+    return any(w in low for w in ('word', 'text', 'contain', 'show', 'display', 'has ', 'with '))
+
+
+def normalize_text(text):
+    """小写并去掉非字母数字，容忍 OCR 的空格/标点误差"""
+    return re.sub(r'[^0-9a-z\u4e00-\u9fff]', '', text.lower())
+
+
+def ocr_tile(tile):
+    """OCR 一个灰度分块，按分块内容哈希缓存结果"""
+    key = (tile.shape, hashlib.blake2b(tile.tobytes(), digest_size=16).digest())
+    text = OCR_CACHE.get(key)
+    if text is not None:
+        OCR_CACHE.move_to_end(key)
+        OCR_STATS['hit'] += 1
+        return text
+    OCR_STATS['miss'] += 1
+    big = cv2.resize(tile, None, fx=OCR_UPSCALE, fy=OCR_UPSCALE, interpolation=cv2.INTER_CUBIC)
+    text = normalize_text(pytesseract.image_to_string(big, config='--psm 11'))
+    OCR_CACHE[key] = text
+    if len(OCR_CACHE) > OCR_CACHE_MAX:
+        OCR_CACHE.popitem(last=False)
+    return text
+
+
+def ocr_region_text(img, region=None):
+    """对学习区域分块 OCR，返回各分块文本（已规范化）的列表；region 为 None 时使用整张截图"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    h, w = gray.shape[:2]
+    if region is not None and None not in region:
+        x1, y1, x2, y2 = scale_region(region, SCREEN['scale'])  # 学习区域是参考图坐标
+        gray = gray[max(0, y1):min(h, y2), max(0, x1):min(w, x2)]
+        h, w = gray.shape[:2]
+    texts = []
+    for y in range(0, max(1, h - OCR_TILE_H + OCR_TILE_STEP_Y), OCR_TILE_STEP_Y):
+        for x in range(0, max(1, w - OCR_TILE_W + OCR_TILE_STEP), OCR_TILE_STEP):
+            tile = gray[y:y + OCR_TILE_H, x:x + OCR_TILE_W]
+            if tile.size:
+                texts.append(ocr_tile(tile))
+    return texts
+
+
+def check_text_conditions(conds, img, region=None):
+    """
+    用本地 OCR 判断文字类条件，只在学习区域内进行。
+    返回 False => 条件中引号内的文字没有出现在画面上；
+    返回 True  => 文字都出现了，且所有条件都只是文字条件；
+    返回 None  => 没有 OCR 引擎 / 没有文字条件 / 还需要其他方式（GPT）进一步判断。
+    """
+    if pytesseract is None or not conds:
+        return None
+    phrases = [normalize_text(p) for c in conds for p in extract_quoted_phrases(c)]
+    phrases = [p for p in phrases if p]
+    if not phrases:
+        return None
+    t0 = time.perf_counter()
+    with span('ocr') as sp:
+        texts = ocr_region_text(img, region)
+        found = all(any(p in t for t in texts) for p in phrases)
+        sp.set(score=int(found))
+    print(f"   => OCR text check {'ok' if found else 'failed'} in {1000 * (time.perf_counter() - t0):.1f} ms "
+          f"(tile cache hit={OCR_STATS['hit']}, miss={OCR_STATS['miss']})")
+    if not found:
+        return False
+    if all(is_pure_text_condition(c) for c in conds if extract_quoted_phrases(c)):
+        return True
+    return None
+
+
+# pynput 键名 => pyautogui 键名（其余同名）
+KEY_NAMES = {
+    'ctrl_l': 'ctrlleft', 'ctrl_r': 'ctrlright', 'alt_l': 'altleft', 'alt_r': 'altright',
+    'alt_gr': 'altright', 'shift_l': 'shiftleft', 'shift_r': 'shiftright',
+    'cmd': 'win', 'cmd_l': 'winleft', 'cmd_r': 'winright',
+    'page_up': 'pageup', 'page_down': 'pagedown', 'caps_lock': 'capslock',
+    'num_lock': 'numlock', 'scroll_lock': 'scrolllock', 'print_screen': 'printscreen',
+}
+
+ACTION_STATS = {'actions': 0, 'ms': 0.0}
+
+
+def compile_command(cmd):
+    """
+    录制的命令字符串 => 动作 dict（构建时调用一次，运行时不再解析字符串）：
+    {'op': 'click', 'x', 'y', 'button'} / {'op': 'press', 'key'} / {'op': 'write', 'text'}；无法识别时返回 None。
+    """
+    text = typed_text(cmd)
+    if text is not None:
+        return {'op': 'write', 'text': text}
+    m = re.search(r'\((-?\d+),\s*(-?\d+)\)', cmd)
+    if m:
+        b = re.search(r'Button\.(\w+)', cmd)
+        return {'op': 'click', 'x': int(m.group(1)), 'y': int(m.group(2)), 'button': b.group(1) if b else 'left'}
+    m = re.search(r'key pressed:\s*(.+)$', cmd, flags=re.IGNORECASE)
+    if m:
+        key = m.group(1).strip().strip("'")
+        if key.lower().startswith('key.'):
+            key = key[4:]
+        key = key if len(key) == 1 else key.lower()
+        return {'op': 'press', 'key': KEY_NAMES.get(key, key)}
+    return None
+
+
+def step_actions(info):
+    """
+    step 的动作列表（与 commands 一一对应）；旧的 data 没有 'actions' 时现场编译。
+    录制的坐标是参考图坐标，屏幕比例不同时换算成当前屏幕的鼠标坐标。
+    """
+    if 'actions' not in info:
+        info['actions'] = [compile_command(c) for c in info.get('commands', [])]
+    s = SCREEN['scale'] * SCREEN['click']
+    if abs(s - 1.0) < 1e-3:
+        return info['actions']
+    return [dict(a, x=int(round(a['x'] * s)), y=int(round(a['y'] * s))) if a and 'x' in a else a
+            for a in info['actions']]
+
+
+class ActionExecutor:
+    """按编译好的动作调用 pyautogui；pause 为每次调用后的停顿（pyautogui 默认 0.1s）"""
+
+    def __init__(self, pg, pause=ACTION_PAUSE):
+        self.pg = pg
+        self.pg.PAUSE = pause
+        self.last = []   # 最近一次执行的动作，用于决定动作后监视哪个区域
+
+    def run(self, actions):
+        actions = [a for a in actions if a]
+        self.last = actions
+        for a in actions:
+            t0 = time.perf_counter()
+            with span('action', op=a['op']):
+                if a['op'] == 'click':
+                    print(f"pyautogui.click({a['x']}, {a['y']}, button='{a['button']}')")
+                    self.pg.click(a['x'], a['y'], button=a['button'])
+                elif a['op'] == 'press':
+                    print(f"pyautogui.press({a['key']!r})")
+                    self.pg.press(a['key'])
+                elif a['op'] == 'write':
+                    print(f"pyautogui.write({a['text']!r})")
+                    self.pg.write(a['text'], interval=TYPE_INTERVAL)
+            ACTION_STATS['actions'] += 1
+            ACTION_STATS['ms'] += 1000 * (time.perf_counter() - t0)
+        return bool(actions)
+
+    def run_once(self, actions):
+        """各 retry 录到的命令互为备选 => 只执行第一个能执行的动作"""
+        for a in actions:
+            if a:
+                return self.run([a])
+        return False
+
+
+def report_action_stats():
+    """打印动作执行次数与每个动作的平均耗时（含 pyautogui.PAUSE）"""
+    if not ACTION_STATS['actions']:
+        return
+    print(f"[STATS] actions={ACTION_STATS['actions']}, "
+          f"avg={ACTION_STATS['ms'] / ACTION_STATS['actions']:.1f} ms/action")
+
+
+def settle_region(actions, next_info, screen_size):
+    """
+    动作后要监视的区域 (x, y, w, h)：点击 => 点击位置周围；按键/输入 => 下一个 step 的学习区域；
+    都没有时返回 None（监视整个屏幕）。
+    """
+    w, h = screen_size
+    for a in reversed(actions or []):
+        if a and a['op'] == 'click':
+            x1, y1 = max(0, a['x'] - SETTLE_PAD), max(0, a['y'] - SETTLE_PAD)
+            return (x1, y1, min(w, a['x'] + SETTLE_PAD) - x1, min(h, a['y'] + SETTLE_PAD) - y1)
+    region = (next_info or {}).get('region')
+    if region:
+        x1, y1, x2, y2 = scale_region(region, SCREEN['scale'] * SCREEN['click'])  # 参考图坐标 => 鼠标坐标
+        return (x1, y1, x2 - x1, y2 - y1)
+    return None
+
+
+def wait_settle(pg, region=None, timeout=SETTLE_TIMEOUT):
+    """
+    动作后等待界面稳定：每隔 SETTLE_INTERVAL 截取监视区域（缩小的灰度图）与上一张比较，
+    界面出现过变化（或已等了 SETTLE_MIN_WAIT）之后，连续 SETTLE_STABLE 次平均灰度差 < SETTLE_DIFF => 稳定。
+    等待时间用 time.monotonic() 计算（含截图本身的耗时），超过 timeout 也返回。返回 (是否稳定, 等待秒数)。
+    """
+    def grab():
+        img = np.array(pg.screenshot(region=region) if region else pg.screenshot())
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+        return gray if region else cv2.resize(gray, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+
+    with span('settle') as sp:
+        t0 = time.monotonic()
+        prev = grab()
+        waited, stable, changed = 0.0, 0, False
+        while waited < timeout:
+            time.sleep(SETTLE_INTERVAL)
+            cur = grab()
+            waited = time.monotonic() - t0
+            diff = float(cv2.absdiff(cur, prev).mean()) if cur.shape == prev.shape else 255.0
+            prev = cur
+            if diff >= SETTLE_DIFF:
+                changed, stable = True, 0
+            elif changed or waited >= SETTLE_MIN_WAIT:
+                stable += 1
+                if stable >= SETTLE_STABLE:
+                    sp.set(waited=round(waited, 2), changed=changed)
+                    return True, waited
+        sp.set(waited=round(waited, 2), changed=changed, timeout=True)
+    return False, waited
+
+
+def settle_after(pg, actions, next_info):
+    """执行动作之后调用：在合适的区域上等待界面稳定，并打印等待时间"""
+    ok, waited = wait_settle(pg, settle_region(actions, next_info, pg.size()))
+    print(f"   => screen {'settled' if ok else 'still changing (timeout)'} after {waited:.2f}s")
+    return ok
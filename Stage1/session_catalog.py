@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+session_catalog.py
+
+录制会话的本地目录库（SQLite，只依赖标准库）：
+- sessions: 每次 Retry Record 一行（retryN 文件夹名、编号、创建时间、截图编码格式）；
+- events:   每个 step 录到的操作（motion-record.txt 中的一行）；
+- frames:   每个 step 的截图路径、分辨率、时间；
+- transcriptions: 语音转写的文字（Start A Step Record）。
+Retry_Record 录制时直接写入，录完用 mark_synced() 记下文件夹的修改时间；
+手动拷贝进来的 retry* 文件夹用 sync() 补录（只列一次根目录，不进入已登记的文件夹），
+sync(rescan=True) 再检查已登记文件夹的修改时间，有变化的重新索引。
+下一个 retry 编号、build_data 需要的 step/截图/点击坐标、后台预处理要找的截图都从库里查询，不必每次遍历目录。
+截图可以是 frame_codec 支持的任意格式（stepN.png / .webp / .raw），读取时用 frame_codec.read_frame。
+
+用法：
+    cat = SessionCatalog()
+    name = cat.next_session_name()                       # 'retry5'
+    cat.frames(step=3, since=time.time() - 7 * 86400)    # 最近一周各 retry 的 step3 截图
+    cat.events(session='retry2', step=1)                 # retry2 的 step1 操作
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from frame_codec import FRAME_RE, frame_codec_of, frame_size
+
+CATALOG_FILE = "sessions.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id      INTEGER PRIMARY KEY,
+    name    TEXT UNIQUE NOT NULL,
+    number  INTEGER,
+    created REAL,
+    mtime   REAL,
+    codec   TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id         INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    step       INTEGER NOT NULL,
+    text       TEXT NOT NULL,
+    t          REAL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    id         INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    step       INTEGER NOT NULL,
+    path       TEXT UNIQUE NOT NULL,
+    width      INTEGER,
+    height     INTEGER,
+    t          REAL
+);
+CREATE TABLE IF NOT EXISTS transcriptions (
+    id         INTEGER PRIMARY KEY,
+    session_id INTEGER REFERENCES sessions(id) ON DELETE CASCADE,
+    step       INTEGER,
+    text       TEXT,
+    audio      TEXT,
+    t          REAL
+);
+CREATE INDEX IF NOT EXISTS idx_events_step ON events(step, session_id);
+CREATE INDEX IF NOT EXISTS idx_frames_step ON frames(step, t);
+"""
+
+
+def session_number(name):
+    m = re.match(r'^retry(\d+)$', name)
+    return int(m.group(1)) if m else None
+
+
+class SessionCatalog:
+    def __init__(self, path=CATALOG_FILE, root='.'):
+        self.root = root
+        # pynput 的鼠标、键盘回调在不同线程里写入 => 共用一个连接，写入时加锁
+        self.db = sqlite3.connect(os.path.join(root, path), check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.execute("ALTER TABLE sessions ADD COLUMN codec TEXT")  # 旧版本建的库没有 codec 列
+        except sqlite3.OperationalError:
+            pass
+
+    def close(self):
+        self.db.close()
+
+    # ---- 写入 ----
+    def add_session(self, name, created=None, codec=None):
+        """登记一个会话（已存在时直接返回其 id）；codec 为录制截图的编码格式"""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO sessions(name, number, created) VALUES (?, ?, ?)",
+                            (name, session_number(name), created or time.time()))
+            if codec:
+                self.db.execute("UPDATE sessions SET codec=? WHERE name=?", (codec, name))
+        return self.session_id(name)
+
+    def session_id(self, name):
+        row = self.db.execute("SELECT id FROM sessions WHERE name=?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def next_session_name(self):
+        """下一个 retry 文件夹名 = 已登记的最大编号 + 1"""
+        row = self.db.execute("SELECT MAX(number) FROM sessions").fetchone()
+        return f"retry{(row[0] or 0) + 1}"
+
+    def add_event(self, session, step, text, frame_path=None, size=None, t=None):
+        """登记一次操作及其截图；size 为 (宽, 高)，缺省时读取截图文件头"""
+        t = t or time.time()
+        with self.lock, self.db:
+            sid = self.add_session(session)
+            self.db.execute("INSERT INTO events(session_id, step, text, t) VALUES (?, ?, ?, ?)",
+                            (sid, int(step), text, t))
+            if frame_path:
+                w, h = size or frame_size(os.path.join(self.root, frame_path))
+                self.db.execute("INSERT OR REPLACE INTO frames(session_id, step, path, width, height, t) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", (sid, int(step), frame_path, w, h, t))
+
+    def remove_step(self, session, step):
+        """删除会话中某个 step 的操作和截图记录（录制结束时去掉停止热键那一步）"""
+        with self.lock, self.db:
+            sid = self.session_id(session)
+            if sid is None:
+                return
+            self.db.execute("DELETE FROM events WHERE session_id=? AND step=?", (sid, int(step)))
+            self.db.execute("DELETE FROM frames WHERE session_id=? AND step=?", (sid, int(step)))
+
+    def add_transcription(self, session, step, text, audio=None):
+        with self.lock, self.db:
+            sid = self.add_session(session)
+            self.db.execute("INSERT INTO transcriptions(session_id, step, text, audio, t) VALUES (?, ?, ?, ?, ?)",
+                            (sid, step, text, audio, time.time()))
+
+    def mark_synced(self, name):
+        """录制写完（motion-record.txt 已保存）后调用：记下文件夹当前的修改时间，sync(rescan=True) 不会再重新索引它"""
+        folder = os.path.join(self.root, name)
+        mtime = max(os.stat(folder).st_mtime, self._motion_mtime(folder))
+        with self.lock, self.db:
+            self.db.execute("UPDATE sessions SET mtime=? WHERE name=?", (mtime, name))
+
+    def sync(self, rescan=False):
+        """
+        把 root 下的 retry* 文件夹补录进库：只列一次根目录，索引还没登记的会话；
+        rescan=True 时再比较已登记会话的文件夹修改时间，有变化的重新索引。
+        文件夹已被删除的 retry 会话从库中移除。返回重新索引的会话数。
+        """
+        with self.lock:
+            known = dict(self.db.execute("SELECT name, mtime FROM sessions").fetchall())
+        n, seen = 0, set()
+        for entry in os.scandir(self.root):
+            if session_number(entry.name) is None or not entry.is_dir():
+                continue
+            seen.add(entry.name)
+            if entry.name in known and not rescan:
+                continue
+            mtime = max(entry.stat().st_mtime, self._motion_mtime(entry.path))
+            if known.get(entry.name) == mtime:
+                continue
+            self._index_session(entry.name, entry.path, mtime)
+            n += 1
+        gone = [name for name in known if session_number(name) is not None and name not in seen]
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM sessions WHERE name=?", [(name,) for name in gone])
+        return n
+
+    def _motion_mtime(self, folder):
+        path = os.path.join(folder, 'motion-record.txt')
+        return os.stat(path).st_mtime if os.path.exists(path) else 0.0
+
+    def _index_session(self, name, folder, mtime):
+        sid = self.add_session(name, created=os.stat(folder).st_mtime)
+        events, frames, codec = [], [], None
+        motion = os.path.join(folder, 'motion-record.txt')
+        if os.path.exists(motion):
+            t = os.stat(motion).st_mtime
+            with open(motion, 'r', encoding='utf-8') as f:
+                for line in f:
+                    m = re.match(r'^Step\s+(\d+):\s*(.*)$', line.strip())
+                    if m:
+                        events.append((sid, int(m.group(1)), m.group(2), t))
+        for fname in os.listdir(folder):
+            m = FRAME_RE.match(fname)
+            if m:
+                path = os.path.join(name, fname)
+                full = os.path.join(folder, fname)
+                w, h = frame_size(full)
+                codec = codec or frame_codec_of(full)
+                frames.append((sid, int(m.group(1)), path, w, h, os.stat(full).st_mtime))
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM events WHERE session_id=?", (sid,))
+            self.db.execute("DELETE FROM frames WHERE session_id=?", (sid,))
+            self.db.executemany("INSERT INTO events(session_id, step, text, t) VALUES (?, ?, ?, ?)", events)
+            self.db.executemany("INSERT OR REPLACE INTO frames(session_id, step, path, width, height, t) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", frames)
+            self.db.execute("UPDATE sessions SET mtime=?, codec=COALESCE(codec, ?) WHERE id=?", (mtime, codec, sid))
+
+    # ---- 查询 ----
+    def sessions(self):
+        """[(name, number, created)]；number 为 None 的是 retry 以外的会话（如 Start A Step Record）"""
+        with self.lock:
+            return self.db.execute("SELECT name, number, created FROM sessions ORDER BY number").fetchall()
+
+    def session_codec(self, name):
+        """会话录制截图的编码格式（未登记时返回 None）"""
+        row = self.db.execute("SELECT codec FROM sessions WHERE name=?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def frames(self, step=None, since=None, session=None):
+        """[(session, step, path, width, height, t)]，可按 step / 时间 / 会话过滤"""
+        sql = ("SELECT s.name, f.step, f.path, f.width, f.height, f.t FROM frames f "
+               "JOIN sessions s ON s.id = f.session_id WHERE 1=1")
+        args = []
+        if step is not None:
+            sql += " AND f.step=?"
+            args.append(int(step))
+        if since is not None:
+            sql += " AND f.t>=?"
+            args.append(since)
+        if session is not None:
+            sql += " AND s.name=?"
+            args.append(session)
+        with self.lock:  # 后台预处理线程也在查询
+            return self.db.execute(sql + " ORDER BY f.step, s.number", args).fetchall()
+
+    def events(self, session=None, step=None):
+        """[(session, step, text)]，按会话内的录制顺序"""
+        sql = ("SELECT s.name, e.step, e.text FROM events e "
+               "JOIN sessions s ON s.id = e.session_id WHERE 1=1")
+        args = []
+        if session is not None:
+            sql += " AND s.name=?"
+            args.append(session)
+        if step is not None:
+            sql += " AND e.step=?"
+            args.append(int(step))
+        with self.lock:
+            return self.db.execute(sql + " ORDER BY s.number, e.step, e.id", args).fetchall()
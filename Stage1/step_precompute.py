@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+step_precompute.py
+
+录制过程中的后台预处理：每张 step 截图写盘后交给一个低优先级的后台线程，提前算好构建时最耗时的部分。
+- 单张截图 => 截图旁边的缓存文件 stepN-cache.npz：
+  各候选 ORB 设置 × 各屏幕比例 (SCALE_LEVELS) 的特征、整图 SIFT 特征、模板匹配用的缩小灰度图（缩略图）、
+  点击位置周围各候选局部截图框的 SIFT 特征点数；
+- 与之前已处理的截图两两之间 => precompute.sqlite：
+  各 ORB 设置下的 RANSAC 内点数（两个方向）、候选局部截图框在其他 step 截图上的混淆度。
+两两之间的结果用的是构建模块 (form-execute-script.py) 里的同一批函数计算的；构建时先查缓存
+（截图修改时间、分辨率一致才用），录制结束 (Stop Record) 后只剩依赖全部截图的少量计算。
+
+后台线程自我限速，不与鼠标/键盘回调争抢：
+- 线程优先级调低（Windows: THREAD_PRIORITY_LOWEST；Linux: 线程 nice +10）；
+- 最近一次输入后空闲 PRECOMPUTE_IDLE_SEC 秒才开始处理，每算完一小块都重新检查，有输入时立刻让出；
+- 每块之间再停顿 PRECOMPUTE_PAUSE 秒。
+
+要处理哪些截图、点击位置在哪里都从录制目录库 (session_catalog.SessionCatalog) 查询，不遍历 retry* 文件夹。
+
+用法：
+    pre = StepPrecomputer(build, catalog).start() # build: 加载好的 form-execute-script.py 模块
+    pre.backfill()                                # 之前录制、还没有缓存的截图也排进队列
+    pre.touch()                                   # 在输入回调里调用
+    pre.submit('retry5/step1.png', click=(x, y))  # 截图写盘后调用，立即返回
+    pre.drain()                                   # 等待所有截图处理完（构建之前）
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import rpa_runtime
+from frame_codec import FRAME_RE, read_frame
+
+PRECOMPUTE_IDLE_SEC = 0.3                  # 最近一次输入之后至少空闲这么久才开始处理
+PRECOMPUTE_PAUSE    = 0.02                 # 每算完一小块之后让出的时间（秒）
+PRECOMPUTE_DB       = "precompute.sqlite"  # 截图两两之间的计算结果
+
+# 缓存文件 => {键: 数组}，每个文件只读取一次
+_CACHE = {}
+# 当前进程使用的 PairStore（第一次用到时打开）
+_PAIRS = None
+
+
+def cache_path(frame_path):
+    """retry5/step1.png => retry5/step1-cache.npz"""
+    return os.path.splitext(frame_path)[0] + '-cache.npz'
+
+
+def frame_step(frame_path):
+    """retry5/step3.png => '3'"""
+    m = FRAME_RE.match(os.path.basename(frame_path))
+    return m.group(1) if m else None
+
+
+def orb_tuple(cfg):
+    """ORB 设置（dict 或 orb_config 返回的元组）=> (特征数, 网格或 None)"""
+    return cfg if isinstance(cfg, tuple) else rpa_runtime.orb_config(cfg)
+
+
+def feature_key(cfg, level):
+    nfeatures, grid = orb_tuple(cfg)
+    g = 'x'.join(str(v) for v in grid) if grid else 'none'
+    return f"orb{nfeatures}_{g}@{level:g}"
+
+
+def lower_thread_priority():
+    """把当前线程的调度优先级调低；不支持时忽略"""
+    try:
+        if os.name == 'nt':
+            import ctypes
+            k32 = ctypes.windll.kernel32
+            k32.SetThreadPriority(k32.GetCurrentThread(), -2)  # THREAD_PRIORITY_LOWEST
+        else:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (AttributeError, OSError):
+        pass
+
+
+#######################
+# 单张截图的缓存
+#######################
+def load_cache(frame_path, shape=None):
+    """
+    读取截图的预处理缓存 => {键: 数组}；缓存不存在、截图在缓存之后被修改、或分辨率与 shape 不一致时返回 None
+    """
+    path = cache_path(frame_path)
+    if path not in _CACHE:
+        arrays = None
+        try:
+            if os.path.getmtime(path) >= os.path.getmtime(frame_path):
+                with np.load(path) as z:
+                    arrays = {k: z[k] for k in z.files}
+        except (OSError, ValueError):
+            arrays = None
+        _CACHE[path] = arrays
+    arrays = _CACHE[path]
+    if arrays is None or (shape is not None and tuple(arrays['shape'][:2]) != tuple(shape[:2])):
+        return None
+    return arrays
+
+
+def cached_small(frame_path, shape=None):
+    """缓存中的缩小灰度图（与 rpa_runtime.to_small_gray 一致）；没有时返回 None"""
+    arrays = load_cache(frame_path, shape)
+    return None if arrays is None else arrays['small']
+
+
+def cached_sift(frame_path, shape=None):
+    """缓存中的整图 SIFT 特征 (pts, des)，可直接传给 rpa_runtime.orb_homography_and_bbox；没有时返回 None"""
+    arrays = load_cache(frame_path, shape)
+    if arrays is None or 'sift__pts' not in arrays:
+        return None
+    des = arrays['sift__des']
+    return arrays['sift__pts'], (des.astype(np.float32) if len(des) else None)
+
+
+def cached_crop_keypoints(frame_path, shape=None):
+    """缓存中各候选局部截图框的 SIFT 特征点数 => {框: 特征点数}"""
+    arrays = load_cache(frame_path, shape)
+    if arrays is None or 'crop_boxes' not in arrays:
+        return {}
+    return {tuple(int(v) for v in b): int(n) for b, n in zip(arrays['crop_boxes'], arrays['crop_keypoints'])}
+
+
+def cached_features(frame_path, cfg, level, shape=None):
+    """缓存中某 ORB 设置、某屏幕比例下的特征 (pts, des)；没有时返回 None"""
+    arrays = load_cache(frame_path, shape)
+    key = feature_key(cfg, level)
+    if arrays is None or key + '__pts' not in arrays:
+        return None
+    des = arrays[key + '__des']
+    return arrays[key + '__pts'], (des if len(des) else None)
+
+
+#######################
+# 截图两两之间的结果
+#######################
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class PairStore:
+    """(种类, 参数, 截图 a, 截图 b) => 数值；同时记下两张截图当时的修改时间，截图变了结果作废"""
+
+    def __init__(self, path=PRECOMPUTE_DB):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS pairs (kind TEXT, key TEXT, a TEXT, b TEXT, "
+                            "a_mtime REAL, b_mtime REAL, value REAL, PRIMARY KEY (kind, key, a, b))")
+
+    def get(self, kind, key, a, b):
+        with self.lock:
+            row = self.db.execute("SELECT a_mtime, b_mtime, value FROM pairs "
+                                  "WHERE kind = ? AND key = ? AND a = ? AND b = ?", (kind, key, a, b)).fetchone()
+        if row is None or row[0] != _mtime(a) or row[1] != _mtime(b):
+            return None
+        return row[2]
+
+    def put(self, kind, key, a, b, value):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (kind, key, a, b, _mtime(a), _mtime(b), float(value)))
+
+
+def pair_store():
+    global _PAIRS
+    if _PAIRS is None:
+        _PAIRS = PairStore()
+    return _PAIRS
+
+
+def pair_value(kind, key, a, b, compute):
+    """查 precompute.sqlite；没有（或截图已修改）时调用 compute() 计算并记下"""
+    a, b = os.path.normpath(a), os.path.normpath(b)
+    store = pair_store()
+    value = store.get(kind, key, a, b)
+    if value is None:
+        value = compute()
+        store.put(kind, key, a, b, value)
+    return value
+
+
+#######################
+# 后台线程
+#######################
+class StepPrecomputer:
+    def __init__(self, build, catalog, levels=rpa_runtime.SCALE_LEVELS, idle_sec=PRECOMPUTE_IDLE_SEC,
+                 pause=PRECOMPUTE_PAUSE):
+        """
+        build: form-execute-script.py 模块，用到其中的 ORB_CANDIDATES、crop_candidates、click_point、
+               pair_score、crop_pair_confusion（与构建时同一套计算，结果才能直接复用）
+        catalog: SessionCatalog，已登记的截图及其分辨率、点击位置从这里查询
+        """
+        self.build = build
+        self.catalog = catalog
+        self.configs = [orb_tuple(c) for c in build.ORB_CANDIDATES]
+        self.levels = levels
+        self.idle_sec = idle_sec
+        self.pause = pause
+        self.last_input = 0.0
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.stats = {'frames': 0, 'busy_s': 0.0, 'yield_s': 0.0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def touch(self):
+        """输入回调里调用：记下最近一次输入的时间，后台线程会先让出"""
+        self.last_input = time.time()
+
+    def submit(self, frame_path, click=None):
+        """提交一张截图（写盘之后）；click 为录制坐标，用于预计算候选局部截图框"""
+        self.jobs.put(('frame', frame_path, click))
+
+    def backfill(self):
+        """目录库里之前录制的、还没有缓存的截图也排进队列（点击位置同样从目录库查询），返回排队的张数"""
+        n = 0
+        for (session, step, path, _, _, _) in self.catalog.frames():
+            if load_cache(path) is None:
+                self.submit(path, self.build.click_point(self.catalog, session, step))
+                n += 1
+        return n
+
+    def discard(self, frame_path):
+        """删除某张截图的缓存（录制结束时去掉的最后一步）"""
+        self.jobs.put(('discard', frame_path, None))
+
+    def drain(self, timeout=None):
+        """等待已提交的截图全部处理完；超时返回 False"""
+        done = threading.Event()
+        self.jobs.put(('drain', done, None))
+        return done.wait(timeout)
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def _yield(self):
+        """最近有输入时等到空闲，再停顿一下"""
+        t0 = time.time()
+        while time.time() - self.last_input < self.idle_sec:
+            time.sleep(self.idle_sec / 3)
+        time.sleep(self.pause)
+        self.stats['yield_s'] += time.time() - t0
+
+    def _run(self):
+        lower_thread_priority()
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            kind, arg, click = job
+            if kind == 'drain':
+                arg.set()
+            elif kind == 'discard':
+                path = cache_path(arg)
+                _CACHE.pop(path, None)
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                t0, yielded = time.time(), self.stats['yield_s']
+                try:
+                    n_pairs = self._process(os.path.normpath(arg), click)
+                except Exception as e:
+                    print(f"[ERROR] Precompute failed for {arg}: {e}")
+                    continue
+                busy = time.time() - t0 - (self.stats['yield_s'] - yielded)
+                self.stats['frames'] += 1
+                self.stats['busy_s'] += busy
+                print(f"[DEBUG] Precomputed {arg} (+{n_pairs} earlier frames) in {busy:.2f}s")
+
+    def _process(self, frame_path, click):
+        """处理一张截图，返回与之两两计算过的已有截图张数"""
+        self._yield()
+        img = read_frame(frame_path)
+        if img is None:
+            return 0
+        h, w = img.shape[:2]
+        others = self._cached_frames(frame_path, img.shape)
+
+        arrays = {'shape': np.array(img.shape[:2], np.int32), 'small': rpa_runtime.to_small_gray(img)}
+        for cfg in self.configs:
+            for level in self.levels:
+                self._yield()
+                pts, des = rpa_runtime.orb_features(rpa_runtime.rescale(img, level), *cfg)
+                key = feature_key(cfg, level)
+                arrays[key + '__pts'] = np.asarray(pts, np.float32).reshape(-1, 2)
+                arrays[key + '__des'] = des if des is not None else np.zeros((0, 32), np.uint8)
+        self._yield()
+        sift = cv2.SIFT_create()
+        kp, des = sift.detectAndCompute(img, None)
+        arrays['sift__pts'] = np.float32([k.pt for k in kp]).reshape(-1, 2)
+        # SIFT 描述子都是 0~255 的整数，按 uint8 保存不损失精度
+        arrays['sift__des'] = des.astype(np.uint8) if des is not None else np.zeros((0, 128), np.uint8)
+        boxes = []
+        if click is not None:
+            self._yield()
+            boxes = self.build.crop_candidates(int(click[0]), int(click[1]), w, h)
+            arrays['crop_boxes'] = np.array(boxes, np.int32).reshape(-1, 4)
+            arrays['crop_keypoints'] = np.array(
+                [len(sift.detect(cv2.cvtColor(img[b[1]:b[3], b[0]:b[2]], cv2.COLOR_BGR2GRAY), None)) for b in boxes],
+                np.int32)
+        path = cache_path(frame_path)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+        _CACHE.pop(path, None)
+
+        # 与之前处理过的截图两两计算：ORB 内点数（两个方向）
+        mine = {cfg: cached_features(frame_path, cfg, 1.0) for cfg in self.configs}
+        for other in others:
+            for cfg in self.configs:
+                self._yield()
+                theirs = cached_features(other, cfg, 1.0)
+                self.build.pair_score(frame_path, other, mine[cfg], theirs, cfg, img.shape)
+                self.build.pair_score(other, frame_path, theirs, mine[cfg], cfg, img.shape)
+        # 局部截图候选框的混淆度：本截图的框 × (本截图 + 其他 step 的截图)，其他 step 截图的框 × 本截图
+        step = frame_step(frame_path)
+        negs = [frame_path] + [o for o in others if frame_step(o) != step]
+        for box in boxes:
+            self._yield()
+            for neg in negs:
+                self.build.crop_pair_confusion(frame_path, img, box, neg, cached_small(neg))
+        for other in others:
+            old_boxes = cached_crop_keypoints(other) if frame_step(other) != step else {}
+            if old_boxes:
+                self._yield()
+                old_img = read_frame(other)
+                for box in old_boxes:
+                    self.build.crop_pair_confusion(other, old_img, box, frame_path, arrays['small'])
+        return len(others)
+
+    def _cached_frames(self, frame_path, shape):
+        """目录库里已有缓存、分辨率相同的其他截图"""
+        out = []
+        for (_, _, path, w, h, _) in self.catalog.frames():
+            path = os.path.normpath(path)
+            if (h, w) == tuple(shape[:2]) and path != frame_path and load_cache(path, shape) is not None:
+                out.append(path)
+        return out
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+trace-summary.py
+
+汇总运行时写出的 runtime-trace.jsonl：按 (step, span) 统计次数、总耗时和 p50/p90，
+按总耗时排序，找出每个流程里最耗时的阶段。
+
+用法（在 Stage1 目录运行；生成的脚本在 train-model 里运行，trace 写在那里）：
+    python trace-summary.py
+    python trace-summary.py path/to/runtime-trace.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+
+DEFAULT_TRACE = os.path.join('train-model', 'runtime-trace.jsonl')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, max(0, int(round(q / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def summarize(path):
+    groups = defaultdict(list)
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            name = rec['span'] + (f"/{rec['kind']}" if 'kind' in rec else '')
+            groups[(str(rec.get('step', '-')), name)].append(rec['ms'])
+    rows = []
+    for (step, name), ms in groups.items():
+        rows.append((step, name, len(ms), sum(ms), percentile(ms, 50), percentile(ms, 90)))
+    rows.sort(key=lambda r: r[3], reverse=True)
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Summarize the per-step timing spans written by the generated runtimes.")
+    ap.add_argument('path', nargs='?', default=DEFAULT_TRACE, help=f"trace file (default: {DEFAULT_TRACE})")
+    args = ap.parse_args()
+
+    if not os.path.isfile(args.path):
+        print(f"[ERROR] Trace file not found: {args.path}")
+        return 1
+    rows = summarize(args.path)
+    if not rows:
+        print(f"[WARNING] No spans in {args.path}.")
+        return 0
+    print(f"{'step':<6}{'span':<22}{'count':>7}{'total ms':>12}{'p50 ms':>10}{'p90 ms':>10}")
+    for step, name, n, total, p50, p90 in rows:
+        print(f"{step:<6}{name:<22}{n:>7}{total:>12.1f}{p50:>10.2f}{p90:>10.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
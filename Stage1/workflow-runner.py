@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+workflow-runner.py
+
+同一个录制好的工作流并行跑很多份：协调进程 (coordinator) 排队分发任务，工作进程 (worker) 各自领取执行，
+执行结果（成功/失败、每个 step 的延迟、失败原因）通过本地 socket 汇报回来。
+- 协议：TCP 上每行一个 JSON（见下方"协议"），本机和其他机器上的 worker 用同一套协议；
+- 文件：运行时脚本、workflow bundle（train-model/workflow.rpab）和回放帧都按 SHA-256 寻址，
+  worker 本地没有时通过同一个连接向协调进程取，缓存在 --cache 目录；
+- worker 模式：
+  xvfb    每个 worker 启动自己的虚拟 X 显示 (Xvfb -displayfd 自动选空闲编号)，在该显示上运行生成的运行时脚本，
+          可选先运行 --setup 命令（例如打开目标程序）；每个 step 的延迟从运行时写出的 runtime-trace.jsonl 汇总；
+  replay  不需要显示器：用 replay-harness.py 的虚拟屏幕回放录制帧，适合压测和没有 X 的机器。
+任务 worker 断线时重新排队（最多 MAX_ATTEMPTS 次）。
+
+协议（worker => 协调进程 / 协调进程 => worker）：
+    {"type": "hello", "worker": ..., "host": ...}               => {"type": "welcome"}
+    {"type": "next"}                => {"type": "job", "job": {...}} / {"type": "wait", "sec": 1} / {"type": "shutdown"}
+    {"type": "fetch", "sha256": ...} => {"type": "file", "sha256": ..., "data": base64}
+    {"type": "status", "job": id, "state": "running", ...}     => （无回复）
+    {"type": "result", "job": id, "ok": ..., "error": ..., "wall_s": ..., "step_latency_s": {step: 秒}, ...}
+                                    => {"type": "ack"}
+
+用法（在 retry* 所在目录运行，先用 form-execute-script.py 生成 train-model）：
+    python workflow-runner.py coordinator --runs 100 --local-workers 8                    # 本机 8 个 Xvfb worker
+    python workflow-runner.py coordinator --runs 400 --mode replay --replay-session retry2
+    python workflow-runner.py coordinator --runs 100 --listen 0.0.0.0 --local-workers 0   # 只等其他机器连接
+    python workflow-runner.py worker --connect 10.0.0.5:8765                              # 其他机器上
+"""
+import argparse
+import base64
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from rpa_runtime import BUNDLE_NAME, TRACE_FILE, open_bundle  # noqa: E402
+
+DEFAULT_RUNTIME = os.path.join('train-model', 'train-pyautogui-nogpt.py')
+DEFAULT_BUNDLE  = os.path.join('train-model', BUNDLE_NAME)
+DEFAULT_PORT    = 8765
+DEFAULT_SCREEN  = '1920x1200x24'   # Xvfb 屏幕，与录制分辨率一致时运行时不需要缩放
+JOB_TIMEOUT     = 300.0            # 单个任务最长运行时间（秒），超时视为失败
+MAX_ATTEMPTS    = 3                # worker 断线时任务最多重试几次
+SETUP_WAIT      = 3.0              # 运行 --setup 命令之后等待多久再开始回放（秒）
+
+
+#######################
+# 协议
+#######################
+class Channel:
+    """socket 上每行一个 JSON 的收发"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        data = (json.dumps(msg, ensure_ascii=False) + "\n").encode('utf-8')
+        with self.lock:
+            self.sock.sendall(data)
+
+    def recv(self):
+        """下一条消息；连接关闭时返回 None"""
+        line = self.rfile.readline()
+        return json.loads(line) if line else None
+
+    def request(self, msg):
+        self.send(msg)
+        reply = self.recv()
+        if reply is None:
+            raise ConnectionError("coordinator closed the connection")
+        return reply
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def percentile(values, q):
+    return float(np.percentile(np.array(values), q)) if values else 0.0
+
+
+#######################
+# 协调进程
+#######################
+class Coordinator:
+    """任务队列 + 进行中的任务 + 结果；各连接的处理线程共用，用锁保护"""
+
+    def __init__(self, jobs, files, results_path=None):
+        self.pending = deque(jobs)
+        self.total = len(jobs)
+        self.files = files            # sha256 => 本地路径
+        self.running = {}             # job id => (worker, job)
+        self.results = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.results_fh = open(results_path, 'w', encoding='utf-8') if results_path else None
+        self.t0 = time.time()
+        if not jobs:
+            self.done.set()
+
+    def next_job(self, worker):
+        with self.lock:
+            if self.pending:
+                job = self.pending.popleft()
+                job['attempt'] = job.get('attempt', 0) + 1
+                self.running[job['id']] = (worker, job)
+                return {'type': 'job', 'job': job}
+            if self.done.is_set():
+                return {'type': 'shutdown'}
+            return {'type': 'wait', 'sec': 1}
+
+    def fetch(self, sha):
+        path = self.files.get(sha)
+        if path is None:
+            return {'type': 'error', 'error': f"unknown file {sha}"}
+        with open(path, 'rb') as f:
+            return {'type': 'file', 'sha256': sha, 'data': base64.b64encode(f.read()).decode('ascii')}
+
+    def record(self, worker, msg):
+        with self.lock:
+            if self.running.pop(msg['job'], None) is None:
+                return  # 已经按断线重新排队、又被别的 worker 完成的重复结果
+            msg = dict(msg, worker=worker)
+            msg.pop('type', None)
+            self.results.append(msg)
+            if self.results_fh:
+                self.results_fh.write(json.dumps(msg, ensure_ascii=False) + "\n")
+                self.results_fh.flush()
+            n = len(self.results)
+            if n == self.total:
+                self.done.set()
+        lat = msg.get('step_latency_s') or {}
+        print(f"[{'OK' if msg['ok'] else 'FAIL'}] job {msg['job']} on {worker} ({n}/{self.total}) "
+              f"wall={msg.get('wall_s', 0):.1f}s steps={len(lat)}" + ("" if msg['ok'] else f" error={msg.get('error')}"))
+
+    def lost(self, worker):
+        """worker 断线：它手上的任务重新排队，超过重试次数记为失败"""
+        with self.lock:
+            jobs = [job for (w, job) in self.running.values() if w == worker]
+        for job in jobs:
+            if job['attempt'] < MAX_ATTEMPTS:
+                with self.lock:
+                    self.running.pop(job['id'], None)
+                    self.pending.appendleft(job)
+                print(f"[WARNING] {worker} disconnected => job {job['id']} requeued")
+            else:
+                self.record(worker, {'job': job['id'], 'ok': False, 'error': f"worker lost {job['attempt']} times",
+                                     'wall_s': 0.0, 'step_latency_s': {}})
+
+    def summary(self):
+        ok = sum(1 for r in self.results if r['ok'])
+        wall = time.time() - self.t0
+        lat = defaultdict(list)
+        for r in self.results:
+            for step, s in (r.get('step_latency_s') or {}).items():
+                lat[step].append(s)
+        workers = len({r['worker'] for r in self.results})
+        print(f"[INFO] jobs={len(self.results)} ok={ok} failed={len(self.results) - ok} on {workers} workers "
+              f"in {wall:.1f}s => {60.0 * len(self.results) / max(wall, 1e-6):.1f} runs/min")
+        for step in sorted(lat, key=lambda s: (len(s), s)):
+            print(f"[INFO] step{step} latency p50={1000 * percentile(lat[step], 50):.0f} ms "
+                  f"p90={1000 * percentile(lat[step], 90):.0f} ms (n={len(lat[step])})")
+        failures = defaultdict(int)
+        for r in self.results:
+            if not r['ok']:
+                failures[r.get('error') or 'unknown'] += 1
+        for err, n in sorted(failures.items(), key=lambda kv: -kv[1]):
+            print(f"[INFO] failure x{n}: {err}")
+        return ok == len(self.results)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        coord = self.server.coord
+        ch = Channel(self.request)
+        worker = f"{self.client_address[0]}:{self.client_address[1]}"
+        try:
+            while True:
+                msg = ch.recv()
+                if msg is None:
+                    break
+                kind = msg.get('type')
+                if kind == 'hello':
+                    worker = f"{msg.get('host', self.client_address[0])}/{msg.get('worker')}"
+                    print(f"[INFO] worker {worker} connected")
+                    ch.send({'type': 'welcome'})
+                elif kind == 'next':
+                    ch.send(coord.next_job(worker))
+                elif kind == 'fetch':
+                    ch.send(coord.fetch(msg['sha256']))
+                elif kind == 'status':
+                    print(f"[DEBUG] job {msg['job']} on {worker}: {msg.get('state')}")
+                elif kind == 'result':
+                    coord.record(worker, msg)
+                    ch.send({'type': 'ack'})
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] connection to {worker} failed: {e}")
+        finally:
+            coord.lost(worker)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_jobs(args):
+    """命令行参数 => (任务列表, {sha256: 路径})"""
+    files = {}
+
+    def register(path):
+        sha = sha256_file(path)
+        files[sha] = os.path.abspath(path)
+        return {'sha256': sha, 'name': os.path.basename(path)}
+
+    base = {'mode': args.mode, 'timeout': args.timeout, 'runtime': register(args.runtime)}
+    if os.path.exists(args.bundle):
+        _, _, digest = open_bundle(args.bundle)  # 排队前先校验一次；worker 运行时要求内容哈希与之一致
+        base['bundle'] = dict(register(args.bundle), content_sha256=digest)
+    else:
+        print(f"[WARNING] {args.bundle} not found => workers read features/local crops next to the runtime only.")
+    if args.setup:
+        base['setup'], base['setup_wait'] = args.setup, args.setup_wait
+    if args.mode == 'replay':
+        harness = load_replay_harness()
+        seq = (harness.script_frames(args.replay_script) if args.replay_script
+               else harness.session_frames(args.replay_session))
+        base['frames'] = [dict(register(f['frame']), expect=f['expect']) for f in seq]
+        if not base['frames']:
+            raise SystemExit("[ERROR] No frames to replay.")
+    return [dict(base, id=i) for i in range(args.runs)], files
+
+
+def run_coordinator(args):
+    if not os.path.exists(args.runtime):
+        print(f"[ERROR] Runtime not found: {args.runtime}")
+        return 1
+    jobs, files = make_jobs(args)
+    coord = Coordinator(jobs, files, args.results)
+    server = _Server((args.listen, args.port), _Handler)
+    server.coord = coord
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] {len(jobs)} jobs ({args.mode}) queued, listening on {args.listen}:{port}")
+
+    n_local = args.local_workers if args.local_workers is not None else (os.cpu_count() or 1)
+    procs = []
+    for i in range(n_local):
+        cmd = [sys.executable, os.path.abspath(__file__), 'worker', '--connect', f"127.0.0.1:{port}",
+               '--name', f"local{i}", '--cache', args.cache, '--screen', args.screen]
+        procs.append(subprocess.Popen(cmd))
+    print(f"[INFO] started {n_local} local workers")
+
+    try:
+        coord.done.wait()
+    except KeyboardInterrupt:
+        print("[WARNING] interrupted => stopping workers")
+        with coord.lock:
+            coord.pending.clear()
+    coord.done.set()
+    for p in procs:
+        try:
+            p.wait(timeout=args.timeout + 10)  # 领到 shutdown 后自行退出
+        except subprocess.TimeoutExpired:
+            p.kill()
+    server.shutdown()
+    if coord.results_fh:
+        coord.results_fh.close()
+        print(f"[INFO] Results saved: {args.results}")
+    return 0 if coord.summary() else 1
+
+
+#######################
+# 工作进程
+#######################
+_HARNESS = None
+
+def load_replay_harness():
+    """replay-harness.py 文件名带连字符，只能按路径导入（只导入一次）"""
+    global _HARNESS
+    if _HARNESS is None:
+        spec = importlib.util.spec_from_file_location("replay_harness", os.path.join(HERE, "replay-harness.py"))
+        _HARNESS = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_HARNESS)
+    return _HARNESS
+
+
+def start_xvfb(screen):
+    """启动虚拟 X 显示，由 Xvfb 自己挑空闲的显示编号 => (进程, ':N')"""
+    if shutil.which('Xvfb') is None:
+        raise RuntimeError("Xvfb not found (install xvfb, or use --mode replay)")
+    r, w = os.pipe()
+    proc = subprocess.Popen(['Xvfb', '-displayfd', str(w), '-screen', '0', screen, '-nolisten', 'tcp'],
+                            pass_fds=(w,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(w)
+    with os.fdopen(r) as f:
+        num = f.readline().strip()
+    if not num:
+        proc.kill()
+        raise RuntimeError("Xvfb failed to start")
+    return proc, f":{num}"
+
+
+def step_latency_from_trace(path):
+    """runtime-trace.jsonl => {step: 从该 step 第一个 span 开始到最后一个 span 结束的秒数}"""
+    first, last = {}, {}
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if 'step' not in rec:
+                continue
+            step = str(rec['step'])
+            first[step] = min(first.get(step, rec['t']), rec['t'] - rec['ms'] / 1000.0)
+            last[step] = max(last.get(step, rec['t']), rec['t'])
+    return {s: round(last[s] - first[s], 4) for s in first}
+
+
+class Worker:
+    def __init__(self, ch, cache, name, screen):
+        self.ch = ch
+        self.cache = cache
+        self.name = name
+        self.screen = screen
+        self.xvfb = None
+        self.display = None
+
+    def file(self, ref):
+        """按 SHA-256 取文件：本地缓存没有时向协调进程取 => 本地路径"""
+        folder = os.path.join(self.cache, ref['sha256'][:2])
+        path = os.path.join(folder, ref['sha256'][:16] + '-' + ref['name'])
+        if not os.path.exists(path):
+            reply = self.ch.request({'type': 'fetch', 'sha256': ref['sha256']})
+            if reply.get('type') != 'file':
+                raise RuntimeError(reply.get('error', 'fetch failed'))
+            data = base64.b64decode(reply['data'])
+            if hashlib.sha256(data).hexdigest() != ref['sha256']:
+                raise RuntimeError(f"corrupted transfer of {ref['name']}")
+            os.makedirs(folder, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return os.path.abspath(path)
+
+    def run(self, job):
+        t0 = time.time()
+        runtime = self.file(job['runtime'])
+        env = {}
+        if job.get('bundle'):
+            env = {'RPA_BUNDLE': self.file(job['bundle']), 'RPA_BUNDLE_SHA256': job['bundle']['content_sha256']}
+        self.ch.send({'type': 'status', 'job': job['id'], 'state': 'running'})
+        if job['mode'] == 'replay':
+            res = self.run_replay(job, runtime, env)
+        else:
+            res = self.run_xvfb(job, runtime, env)
+        res.update(type='result', job=job['id'], attempt=job.get('attempt', 1), wall_s=round(time.time() - t0, 3))
+        return res
+
+    def run_replay(self, job, runtime, env):
+        """虚拟屏幕回放（replay-harness.py），不需要显示器"""
+        harness = load_replay_harness()
+        frames = [{'frame': self.file(f), 'expect': f.get('expect')} for f in job['frames']]
+        os.environ.update(env)
+        try:
+            r = harness.replay_once(runtime, frames)
+        except Exception as e:
+            return {'ok': False, 'error': f"{type(e).__name__}: {e}", 'step_latency_s': {}}
+        lat = {str(a['frame'] + 1): round(s, 4) for a, s in zip(r['actions'], r['step_latency_s'])}
+        return {'ok': r['ok'], 'error': r['error'], 'step_latency_s': lat, 'actions': len(r['actions'])}
+
+    def run_xvfb(self, job, runtime, env):
+        """在本 worker 的虚拟显示上运行生成的运行时脚本；每个任务一个临时目录（trace 文件互不干扰）"""
+        if self.xvfb is None:
+            self.xvfb, self.display = start_xvfb(self.screen)
+        env = dict(os.environ, DISPLAY=self.display, **env)
+        workdir = tempfile.mkdtemp(prefix=f"rpa-{self.name}-")
+        setup = None
+        try:
+            if job.get('setup'):
+                setup = subprocess.Popen(job['setup'], shell=True, cwd=workdir, env=env,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+                time.sleep(job.get('setup_wait', SETUP_WAIT))
+            log_path = os.path.join(workdir, 'runtime.log')
+            with open(log_path, 'w', encoding='utf-8') as log:
+                proc = subprocess.Popen([sys.executable, runtime], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+                try:
+                    code = proc.wait(timeout=job.get('timeout', JOB_TIMEOUT))
+                    error = '' if code == 0 else f"runtime exited with {code}"
+                except subprocess.TimeoutExpired:
+                    proc.send_signal(signal.SIGINT)  # KeyboardInterrupt => 运行时在 atexit 里把 trace 写出去
+                    try:
+                        proc.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        proc.kill()
+                    error = f"timeout after {job.get('timeout', JOB_TIMEOUT):.0f}s"
+            lat = step_latency_from_trace(os.path.join(workdir, TRACE_FILE))
+            if error and lat:
+                error += f" at step{max(lat, key=int)}"
+            if error:
+                with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+                    tail = f.read().strip().splitlines()[-1:]
+                error += f" ({tail[0][:200]})" if tail else ''
+            return {'ok': not error, 'error': error, 'step_latency_s': lat}
+        finally:
+            if setup is not None:
+                try:
+                    os.killpg(setup.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def close(self):
+        if self.xvfb is not None:
+            self.xvfb.terminate()
+            self.xvfb.wait()
+
+
+def run_worker(args):
+    host, _, port = args.connect.rpartition(':')
+    sock = socket.create_connection((host or '127.0.0.1', int(port)))
+    ch = Channel(sock)
+    worker = Worker(ch, args.cache, args.name or f"pid{os.getpid()}", args.screen)
+    ch.request({'type': 'hello', 'worker': worker.name, 'host': socket.gethostname()})
+    n = 0
+    try:
+        while True:
+            reply = ch.request({'type': 'next'})
+            if reply['type'] == 'shutdown':
+                break
+            if reply['type'] == 'wait':
+                time.sleep(reply.get('sec', 1))
+                continue
+            try:
+                res = worker.run(reply['job'])
+            except Exception as e:
+                res = {'type': 'result', 'job': reply['job']['id'], 'ok': False,
+                       'error': f"{type(e).__name__}: {e}", 'wall_s': 0.0, 'step_latency_s': {}}
+            ch.request(res)
+            n += 1
+    except ConnectionError as e:
+        print(f"[WARNING] {e}")
+    finally:
+        worker.close()
+        sock.close()
+    print(f"[INFO] worker {worker.name} finished {n} jobs")
+    return 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run many copies of a recorded workflow on a pool of workers.")
+    sub = ap.add_subparsers(dest='command', required=True)
+
+    co = sub.add_parser('coordinator', help="queue jobs and hand them to workers")
+    co.add_argument('--runtime', default=DEFAULT_RUNTIME, help="generated runtime script")
+    co.add_argument('--bundle', default=DEFAULT_BUNDLE, help="workflow bundle shipped with the runtime")
+    co.add_argument('--runs', type=int, default=1, help="number of workflow runs to queue")
+    co.add_argument('--mode', choices=['xvfb', 'replay'], default='xvfb')
+    co.add_argument('--setup', default=None, help="xvfb mode: shell command started on the display before each run")
+    co.add_argument('--setup-wait', type=float, default=SETUP_WAIT, help="seconds to wait after --setup")
+    src = co.add_mutually_exclusive_group()
+    src.add_argument('--replay-session', default='retry1', help="replay mode: recording folder to replay")
+    src.add_argument('--replay-script', default=None, help="replay mode: json list of {frame, expect}")
+    co.add_argument('--timeout', type=float, default=JOB_TIMEOUT, help="seconds before a run counts as failed")
+    co.add_argument('--listen', default='127.0.0.1', help="address to listen on (0.0.0.0 for remote workers)")
+    co.add_argument('--port', type=int, default=DEFAULT_PORT, help="0 picks a free port")
+    co.add_argument('--local-workers', type=int, default=None, help="workers started on this machine (default: cores)")
+    co.add_argument('--results', default='runner-results.jsonl', help="one json line per finished job")
+    co.add_argument('--cache', default='runner-cache', help="file cache of the local workers")
+    co.add_argument('--screen', default=DEFAULT_SCREEN, help="Xvfb screen of the local workers")
+
+    wo = sub.add_parser('worker', help="take jobs from a coordinator")
+    wo.add_argument('--connect', default=f"127.0.0.1:{DEFAULT_PORT}", help="coordinator host:port")
+    wo.add_argument('--name', default=None)
+    wo.add_argument('--cache', default='runner-cache', help="where fetched runtimes/bundles/frames are kept")
+    wo.add_argument('--screen', default=DEFAULT_SCREEN, help="Xvfb screen WxHxDEPTH")
+    args = ap.parse_args()
+    return run_coordinator(args) if args.command == 'coordinator' else run_worker(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+workflow_bundle.py
+
+把 form-execute-script.py 构建好的工作流打包成单个文件 train-model/workflow.rpab。
+部署到其他运行机器时只需复制运行时脚本和这一个文件，不再需要 retry* 文件夹和 train-model 下的零散文件：
+- 步骤数据 data（步骤顺序、动作、阈值、原型、局部截图偏移、参考分辨率等）；
+- 各 step 的参考图特征（stepX-features.npz 的全部数组，含各屏幕比例层）；
+- 局部截图的像素（去重后的文件）；整体参考图只有在特征文件缺少某一层、运行时需要现场提取时才打包像素。
+
+文件格式（读取见 rpa_runtime.open_bundle / load_workflow）：
+    头部   魔数 'RPAB0001' | 内容 SHA-256（32 字节）| 清单长度（uint64）
+    清单   JSON {'version': 1, 'data': ..., 'arrays': {名称: [dtype, shape, 文件偏移, 字节数]}}
+    数组   原始字节，按 BUNDLE_ALIGN 对齐；运行时 mmap 整个文件后直接取视图，不解码、不复制
+SHA-256 覆盖头部之后的全部内容，运行前校验；同样的构建结果得到同样的哈希，
+部署时记下哈希，运行机器上设置 RPA_BUNDLE_SHA256 即可确认运行的是这一版。
+
+用法：
+    digest = write_bundle('train-model/workflow.rpab', data, 'train-model')
+"""
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+import rpa_runtime
+from frame_codec import read_frame
+from rpa_runtime import BUNDLE_ALIGN, BUNDLE_HEAD, BUNDLE_MAGIC
+
+BUNDLE_VERSION = 1
+
+
+def bundle_arrays(data, out_dir):
+    """data（局部截图已保存为文件之后）=> {名称: 数组}：特征 'features/文件名/键'，局部截图 'local/文件名'，整体参考图 'overall/路径'"""
+    arrays = {}
+    for sid, info in data.items():
+        fname, keys = info.get('features'), set()
+        if fname and os.path.exists(os.path.join(out_dir, fname)):
+            with np.load(os.path.join(out_dir, fname)) as z:
+                for key in z.files:
+                    arrays[f"features/{fname}/{key}"] = z[key]
+                keys = set(z.files)
+        for (_, name) in info.get('local_imgs', []):
+            if f"local/{name}" not in arrays:
+                img = cv2.imread(os.path.join(out_dir, name))
+                if img is None:
+                    print(f"[WARNING] step{sid} => local image {name} not found, not bundled.")
+                    continue
+                arrays[f"local/{name}"] = img
+        protos = info.get('prototypes')
+        for (folder, rel_png) in info.get('overall_imgs', []):
+            if protos is not None and folder not in protos:
+                continue  # 运行时只给原型打分
+            if all(rpa_runtime.level_key(folder, lv) + '__pts' in keys for lv in rpa_runtime.SCALE_LEVELS):
+                continue  # 各层特征都有，运行时不读取像素
+            img = read_frame(rel_png)
+            if img is not None:
+                arrays[f"overall/{rel_png}"] = img
+    return arrays
+
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def write_bundle(path, data, out_dir):
+    """把工作流写成单个 bundle 文件（先写临时文件再替换），返回内容 SHA-256 十六进制"""
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in bundle_arrays(data, out_dir).items()}
+
+    # 先排好各数组的位置：清单长度取决于偏移量的位数，偏移量又取决于清单长度 => 按清单长度迭代到不变
+    index, n = {}, 0
+    while True:
+        offset = BUNDLE_HEAD.size + n
+        for name, arr in arrays.items():
+            offset += -offset % BUNDLE_ALIGN
+            index[name] = [arr.dtype.str, list(arr.shape), offset, arr.nbytes]
+            offset += arr.nbytes
+        manifest = json.dumps({'version': BUNDLE_VERSION, 'data': data, 'arrays': index},
+                              ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+        if len(manifest) == n:
+            break
+        n = len(manifest)
+
+    sha = hashlib.sha256()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(BUNDLE_HEAD.pack(BUNDLE_MAGIC, b'\0' * 32, n))
+
+        def put(chunk):
+            sha.update(chunk)
+            f.write(chunk)
+
+        put(manifest)
+        for name, arr in arrays.items():
+            put(b'\0' * (index[name][2] - f.tell()))
+            put(arr.tobytes())
+        f.seek(0)
+        f.write(BUNDLE_HEAD.pack(BUNDLE_MAGIC, sha.digest(), n))
+    os.replace(tmp, path)
+    return sha.hexdigest()